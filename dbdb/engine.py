@@ -1,4 +1,6 @@
 from dbdb.operators.operator_stats import set_stats_callback
+from dbdb.operators.exchange import ExchangeOperator
+from dbdb.io.spill import MemoryBudget
 from dbdb.logger import logger
 import dbdb.lang.lang
 
@@ -7,7 +9,6 @@ import networkx as nx
 import time
 import json
 
-
 # Store events and query results globally
 EVENTS = {}
 QUERY_CACHE = {}
@@ -56,9 +57,54 @@ def unset_query(query_id):
     del EVENTS[query_id]
 
 
+def waits_on_io(plan, node):
+    "True if node, or any operator that its rows come from, waits on I/O"
+    if node.waits_on_io():
+        return True
+
+    return any(ancestor.waits_on_io() for ancestor in nx.ancestors(plan, node))
+
+
+def add_exchanges(plan):
+    """
+    Operators with more than one input (joins and unions) read them one at
+    a time. Inputs which wait on I/O are read through an exchange instead,
+    so that they are produced at the same time as the other inputs. Inputs
+    which don't wait are left alone, since they could only take turns with
+    the others anyway.
+    """
+    for node in list(plan.nodes):
+        in_edges = list(plan.in_edges(node, data=True))
+        if len(in_edges) < 2:
+            continue
+
+        # Edges are re-added in the same order, which unions rely on
+        for parent, _, edge in in_edges:
+            if not waits_on_io(plan, parent):
+                plan.remove_edge(parent, node)
+                plan.add_edge(parent, node, **edge)
+                continue
+
+            exchange_op = ExchangeOperator()
+            plan.add_node(exchange_op, label="Exchange")
+            plan.remove_edge(parent, node)
+            plan.add_edge(parent, exchange_op, input_arg="rows")
+            plan.add_edge(exchange_op, node, **edge)
+
+
 async def run_query(query_id, plan, nodes):
+    try:
+        return await execute_query(query_id, plan, nodes)
+    finally:
+        # Stop exchanges whose rows were not read to the end
+        for node in nodes:
+            if isinstance(node, ExchangeOperator):
+                node.close()
+
+
+async def execute_query(query_id, plan, nodes):
     start_time = time.time()
-    row_iterators: Dict[str, List] = {}
+    consumers: Dict[str, List] = {}
 
     # Sample stats
     add_event(
@@ -76,11 +122,16 @@ async def run_query(query_id, plan, nodes):
 
     set_stats_callback(on_stat)
 
+    # Operators which hold on to rows all spill against the same budget
+    memory_budget = MemoryBudget()
+    for node in nodes:
+        node.set_memory_budget(memory_budget)
+
     for node in nodes:
         args = {}
         for parent, _, edge in plan.in_edges(node, data=True):
             key = edge["input_arg"]
-            row_iter = row_iterators[parent].consume()
+            row_iter = consumers[(parent, node)]
             if edge.get("list_args"):
                 if key not in args:
                     args[key] = []
@@ -90,15 +141,23 @@ async def run_query(query_id, plan, nodes):
 
         # logger.info("Running operator", node, "with args", args)
         rows = await node.run(**args)
-        row_iterators[node] = rows
 
-    leaf_node = nodes[-1]
+        # If this operator stops reading early, its inputs can stop too
+        for arg in args.values():
+            for row_iter in arg if isinstance(arg, list) else [arg]:
+                rows.add_source(row_iter)
 
-    output = row_iterators[leaf_node]
+        # Rows are only buffered until every consumer has read them, so
+        # every consumer needs to exist before any of them starts reading
+        for _, child in plan.out_edges(node):
+            consumers[(node, child)] = rows.consume()
+
+    leaf_node = nodes[-1]
+    output = rows
     output_consumer = output.consume()
 
+    columns = [f.name for f in output.fields]
     if not leaf_node.is_mutation():
-        columns = [f.name for f in output.fields]
         add_event(
             query_id,
             {
@@ -110,8 +169,11 @@ async def run_query(query_id, plan, nodes):
             },
         )
 
+    # The result is collected while it is sent, rather than read twice
+    data = []
     async for batch in output_consumer.iter_rows_batches(take=100):
         batched_rows = [r.as_tuple() for r in batch]
+        data.extend(dict(zip(columns, row)) for row in batched_rows)
         if len(batched_rows) > 0:
             add_event(
                 query_id,
@@ -122,15 +184,12 @@ async def run_query(query_id, plan, nodes):
             )
         await asyncio.sleep(0.1)
 
-    # await output.display()
-
-    data = await output.as_table()
     push_cache(query_id, data)
 
     total_bytes_read = 0
     for node in nodes:
         if node.name() == "Table Scan":
-            total_bytes_read += node.stats.custom_stats["bytes_read"]
+            total_bytes_read += node.stats.custom_stats.get("bytes_read", 0)
 
     end_time = time.time()
     elapsed = end_time - start_time
@@ -205,6 +264,8 @@ def plan_query(sql):
     statement = dbdb.lang.lang.parse_query(sql)
 
     plan = statement._plan
+    add_exchanges(plan)
+
     nodes = list(nx.topological_sort(plan))
     edges = {}
     for node in nodes:
@@ -0,0 +1,256 @@
+from dbdb.expressions.expressions import (
+    ColumnIdentifier,
+    Literal,
+    BinaryOperator,
+    NegationOperator,
+    ScalarFunctionCall,
+    CaseWhen,
+    CastExpr,
+)
+from dbdb.expressions.functions.scalar_functions import (
+    FunctionSin,
+    FunctionCos,
+    FunctionSquare,
+    FunctionIff,
+    FunctionPow,
+)
+from dbdb.tuples.context import ExecutionContext
+from dbdb.tuples.rows import find_field_index
+
+import math
+import os
+
+
+"""
+Evaluating an expression tree means a chain of virtual eval() calls, a
+dict lookup in OP_MAP and a nullcheck wrapper for every node, for every
+row. Instead, the expression compiler generates the source for a single
+python function which evaluates the whole tree, eg:
+
+    select a + b * 2 from ...
+
+becomes
+
+    def compiled(row, context):
+        _t1 = None if row[1] is None or _c0 is None else row[1] * _c0
+        _t2 = None if row[0] is None or _t1 is None else row[0] + _t1
+        return _t2
+
+Column references are compiled to positions in the input row, so the
+function takes the row's data tuple directly. Expressions which can't
+be compiled (aggregates, window functions, etc) are evaluated with
+their regular eval() method. Those need an ExecutionContext, so callers
+should check `needs_context` before skipping it.
+
+Set DBDB_COMPILE_EXPRESSIONS=0 to use the interpreter instead.
+"""
+
+ENABLED = os.getenv("DBDB_COMPILE_EXPRESSIONS", "1") != "0"
+
+# Operators which return null if either side is null
+NULLABLE_OPERATORS = {
+    "+": "+",
+    "-": "-",
+    "*": "*",
+    "/": "/",
+    "=": "==",
+    "!=": "!=",
+    "<": "<",
+    ">": ">",
+    "<=": "<=",
+    ">=": ">=",
+}
+
+
+class ExpressionCompiler:
+    def __init__(self, fields):
+        self.fields = fields
+
+        self.lines = []
+        self.namespace = {"_math": math}
+        self.num_temps = 0
+        self.needs_context = False
+
+    def temp(self):
+        self.num_temps += 1
+        return f"_t{self.num_temps}"
+
+    def constant(self, value):
+        name = f"_c{len(self.namespace) - 1}"
+        self.namespace[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def compile(self, expr):
+        result = self.visit(expr, indent=1)
+        self.emit(1, f"return {result}")
+
+        body = "\n".join(self.lines)
+        source = f"def compiled(row, context):\n{body}\n"
+
+        exec(compile(source, "<compiled expression>", "exec"), self.namespace)
+        return source, self.namespace["compiled"]
+
+    def visit(self, expr, indent):
+        # Returns a python expression (a name or row index) for the result
+        if type(expr) is ColumnIdentifier:
+            return self.visit_column(expr, indent)
+        elif isinstance(expr, Literal):
+            return self.constant(expr.val)
+        elif type(expr) is CastExpr:
+            return self.constant(expr.ttype)
+        elif type(expr) is BinaryOperator:
+            return self.visit_binary(expr, indent)
+        elif type(expr) is NegationOperator:
+            value = self.visit(expr.expr, indent)
+            result = self.temp()
+            self.emit(indent, f"{result} = -{value}")
+            return result
+        elif type(expr) is CaseWhen:
+            return self.visit_case_when(expr, indent)
+        elif type(expr) is ScalarFunctionCall:
+            return self.visit_function(expr, indent)
+        else:
+            return self.visit_fallback(expr, indent)
+
+    def visit_fallback(self, expr, indent):
+        self.needs_context = True
+        node = self.constant(expr)
+        result = self.temp()
+        self.emit(indent, f"{result} = {node}.eval(context)")
+        return result
+
+    def visit_column(self, expr, indent):
+        try:
+            index = find_field_index(self.fields, expr.qualify())
+        except RuntimeError:
+            # Raise the usual error if this is ever evaluated
+            return self.visit_fallback(expr, indent)
+
+        return f"row[{index}]"
+
+    def visit_binary(self, expr, indent):
+        operator = expr.operator
+        result = self.temp()
+
+        # AND short-circuits, so only evaluate the rhs if needed
+        if operator == "AND":
+            lhs = self.visit(expr.lhs, indent)
+            self.emit(indent, f"{result} = bool({lhs})")
+            self.emit(indent, f"if {result}:")
+            rhs = self.visit(expr.rhs, indent + 1)
+            self.emit(indent + 1, f"{result} = bool({rhs})")
+            return result
+
+        lhs = self.visit(expr.lhs, indent)
+        rhs = self.visit(expr.rhs, indent)
+        is_null = f"{lhs} is None or {rhs} is None"
+
+        if operator in NULLABLE_OPERATORS:
+            py_op = NULLABLE_OPERATORS[operator]
+            self.emit(indent, f"{result} = None if {is_null} else {lhs} {py_op} {rhs}")
+        elif operator == "OR":
+            self.emit(indent, f"{result} = None if {is_null} else ({lhs} or {rhs})")
+        elif operator == "IS":
+            self.emit(indent, f"{result} = {lhs} is {rhs}")
+        elif operator == "IS_NOT":
+            self.emit(indent, f"{result} = {lhs} is not {rhs}")
+        elif operator == "::":
+            self.emit(indent, f"{result} = None if {is_null} else {rhs}({lhs})")
+        else:
+            return self.visit_fallback(expr, indent)
+
+        return result
+
+    def visit_case_when(self, expr, indent):
+        result = self.temp()
+        for when_cond, when_value in expr.when_exprs:
+            cond = self.visit(when_cond, indent)
+            self.emit(indent, f"if {cond}:")
+            value = self.visit(when_value, indent + 1)
+            self.emit(indent + 1, f"{result} = {value}")
+            self.emit(indent, "else:")
+            indent += 1
+
+        value = self.visit(expr.else_expr, indent)
+        self.emit(indent, f"{result} = {value}")
+        return result
+
+    def visit_function(self, expr, indent):
+        processor = type(expr.processor)
+        args = expr.func_expr
+
+        if processor in (FunctionSin, FunctionCos, FunctionSquare):
+            value = self.visit(args[0], indent)
+            result = self.temp()
+            if processor is FunctionSin:
+                self.emit(indent, f"{result} = _math.sin({value})")
+            elif processor is FunctionCos:
+                self.emit(indent, f"{result} = _math.cos({value})")
+            else:
+                self.emit(indent, f"{result} = 1 if _math.sin({value}) > 0 else -1")
+            return result
+
+        elif processor is FunctionPow and len(args) == 2:
+            base = self.visit(args[0], indent)
+            exp = self.visit(args[1], indent)
+            result = self.temp()
+            self.emit(indent, f"{result} = {base} ** {exp}")
+            return result
+
+        elif processor is FunctionIff and len(args) == 3:
+            result = self.temp()
+            cond = self.visit(args[0], indent)
+            self.emit(indent, f"if {cond}:")
+            value = self.visit(args[1], indent + 1)
+            self.emit(indent + 1, f"{result} = {value}")
+            self.emit(indent, "else:")
+            value = self.visit(args[2], indent + 1)
+            self.emit(indent + 1, f"{result} = {value}")
+            return result
+
+        return self.visit_fallback(expr, indent)
+
+
+class CompiledExpression:
+    def __init__(self, expr, fields):
+        self.expr = expr
+
+        if ENABLED:
+            compiler = ExpressionCompiler(fields)
+            self.source, self.func = compiler.compile(expr)
+            self.needs_context = compiler.needs_context
+        else:
+            self.source = None
+            self.func = self.interpret
+            self.needs_context = True
+
+    def interpret(self, row, context):
+        return self.expr.eval(context)
+
+    def eval_row(self, row, context=None):
+        "Evaluate the expression for a RowTuple"
+        if self.needs_context and context is None:
+            context = ExecutionContext(row=row)
+
+        return self.func(row.data, context)
+
+    def eval_records(self, fields, records, rows=None):
+        "Evaluate the expression for a list of records with the given fields"
+        func = self.func
+        if not self.needs_context:
+            return [func(record, None) for record in records]
+
+        # Imported here to avoid a circular import
+        from dbdb.tuples.rows import RowTuple
+
+        return [
+            func(record, ExecutionContext(row=RowTuple(fields, record), rows=rows))
+            for record in records
+        ]
+
+
+def compile_expression(expr, fields):
+    return CompiledExpression(expr, fields)
@@ -1,5 +1,13 @@
 from __future__ import annotations
 from dbdb.expressions.math import OP_MAP
+from dbdb.expressions.vector_math import (
+    VECTOR_OP_MAP,
+    CannotVectorize,
+    load_column,
+    make_constant,
+    vec_negate,
+)
+from dbdb.tuples.rows import find_field_index
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -30,6 +38,21 @@ class Expression:
     def eval(self, context: ExecutionContext):
         raise NotImplementedError()
 
+    def can_eval_batch(self):
+        return False
+
+    def eval_batch(self, batch):
+        "Evaluate this expression for a RecordBatch. Returns (values, validity)"
+        raise CannotVectorize(f"Cannot vectorize {type(self).__name__}")
+
+    def bind(self, fields):
+        "Resolve column references in this expression to positions in `fields`"
+        for expr in self.walk(lambda e: e):
+            if isinstance(expr, ColumnIdentifier):
+                expr.bind_field(fields)
+
+        return self
+
     def result(self):
         # Only implemented for aggregate types
         raise NotImplementedError()
@@ -42,6 +65,10 @@ class ColumnIdentifier(Expression):
 
         self._qualified = self.qualify()
 
+        # Set by bind_field()
+        self._bound_fields = None
+        self._index = None
+
     def make_name(self):
         return self.column
 
@@ -49,7 +76,23 @@ class ColumnIdentifier(Expression):
         return True
 
     def copy(self):
-        return ColumnIdentifier(table=self.table, column=self.column)
+        copied = ColumnIdentifier(table=self.table, column=self.column)
+        copied._bound_fields = self._bound_fields
+        copied._index = self._index
+        return copied
+
+    def bind_field(self, fields):
+        # Find this column's position in the input schema once, rather
+        # than searching the fields by name for every row
+        try:
+            index = find_field_index(fields, self._qualified)
+        except RuntimeError:
+            # Leave missing or ambiguous columns unbound. Evaluating them
+            # raises a helpful error (but only if there are rows!)
+            return
+
+        self._bound_fields = fields
+        self._index = index
 
     def walk(self, func):
         yield func(self)
@@ -63,7 +106,25 @@ class ColumnIdentifier(Expression):
         return name
 
     def eval(self, context: ExecutionContext):
-        return context.row.field(self._qualified)
+        row = context.row
+        if row.fields is self._bound_fields:
+            return row.data[self._index]
+
+        return row.field(self._qualified)
+
+    def can_eval_batch(self):
+        return True
+
+    def eval_batch(self, batch):
+        if batch.fields is self._bound_fields:
+            index = self._index
+        else:
+            try:
+                index = find_field_index(batch.fields, self._qualified)
+            except RuntimeError:
+                raise CannotVectorize(f"Cannot find column {self._qualified}")
+
+        return load_column(batch.columns[index], batch.validity[index])
 
     def get_aggregated_fields(self):
         return set()
@@ -89,6 +150,12 @@ class Literal(Expression):
     def eval(self, context: ExecutionContext):
         return self.val
 
+    def can_eval_batch(self):
+        return True
+
+    def eval_batch(self, batch):
+        return make_constant(self.val, len(batch))
+
     def value(self):
         return self.val
 
@@ -150,6 +217,14 @@ class ScalarFunctionCall(Expression):
     def eval(self, context: ExecutionContext):
         return self.processor.eval(context)
 
+    def can_eval_batch(self):
+        return self.processor.can_eval_batch() and all(
+            expr.can_eval_batch() for expr in self.func_expr
+        )
+
+    def eval_batch(self, batch):
+        return self.processor.eval_batch(batch)
+
     def walk(self, func):
         for expr in self.func_expr:
             yield from expr.walk(func)
@@ -182,7 +257,6 @@ class AggregateFunctionCall(Expression):
         self.func_class = func_class
         self.is_distinct = is_distinct
 
-        self.is_started = False
         self.processor = func_class(
             expr=self.func_expr, modifiers={"DISTINCT": is_distinct}
         )
@@ -201,11 +275,11 @@ class AggregateFunctionCall(Expression):
         yield func(self)
 
     def eval(self, context: ExecutionContext):
-        if not self.is_started:
-            self.is_started = True
-            self.processor.start()
+        # The aggregate operator computes the value of each call up-front
+        if context is None or context.aggregates is None:
+            raise RuntimeError(f"Aggregate {self.func_name} used outside of GROUP BY")
 
-        return self.processor.eval(context)
+        return context.aggregates[id(self)]
 
     def result(self):
         return self.processor.result()
@@ -255,6 +329,9 @@ class WindowFunctionCall(Expression):
         yield func(self)
 
     def eval(self, context: ExecutionContext):
+        if context.windows is not None:
+            return context.windows[id(self)]
+
         return self.processor.eval(context)
 
     def result(self):
@@ -286,6 +363,12 @@ class NegationOperator(Expression):
     def eval(self, context: ExecutionContext):
         return -self.expr.eval(context)
 
+    def can_eval_batch(self):
+        return self.expr.can_eval_batch()
+
+    def eval_batch(self, batch):
+        return vec_negate(self.expr.eval_batch(batch))
+
     def get_aggregated_fields(self):
         return self.expr.get_aggregated_fields()
 
@@ -330,6 +413,19 @@ class BinaryOperator(Expression):
 
         return op(self.lhs.eval(context), self.rhs.eval(context))
 
+    def can_eval_batch(self):
+        return (
+            self.operator in VECTOR_OP_MAP
+            and self.lhs.can_eval_batch()
+            and self.rhs.can_eval_batch()
+        )
+
+    def eval_batch(self, batch):
+        # Unlike eval(), AND evaluates both sides for every row. If the
+        # rhs fails where the lhs is false, the row path takes over
+        op = VECTOR_OP_MAP[self.operator]
+        return op(self.lhs.eval_batch(batch), self.rhs.eval_batch(batch))
+
     def get_aggregated_fields(self):
         return self.lhs.get_aggregated_fields().union(self.rhs.get_aggregated_fields())
 
@@ -396,6 +492,13 @@ class CastExpr(Expression):
     def eval(self, context: ExecutionContext):
         return self.ttype
 
+    def can_eval_batch(self):
+        return True
+
+    def eval_batch(self, batch):
+        # Only meaningful as the rhs of a `::` cast, like eval()
+        return self.ttype, None
+
     def walk(self, func):
         yield func(self)
 
@@ -419,3 +522,23 @@ class CastExpr(Expression):
             raise RuntimeError(f"Unknown type: {ttype}")
 
         return CastExpr(ttype)
+
+
+def split_conjuncts(expr):
+    "Split `a AND b AND c` into [a, b, c]"
+    if isinstance(expr, BinaryOperator) and expr.operator == "AND":
+        return split_conjuncts(expr.lhs) + split_conjuncts(expr.rhs)
+    else:
+        return [expr]
+
+
+def join_conjuncts(exprs):
+    "Combine [a, b, c] into `a AND b AND c`"
+    if len(exprs) == 0:
+        return None
+
+    joined = exprs[0]
+    for expr in exprs[1:]:
+        joined = BinaryOperator(joined, "AND", expr)
+
+    return joined
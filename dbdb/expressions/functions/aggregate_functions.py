@@ -1,82 +1,111 @@
 from dbdb.expressions.functions.base import AggregateFunction
 from dbdb.expressions.expressions import Literal
-from dbdb.tuples.context import ExecutionContext
 
 
 class AggregationMin(AggregateFunction):
     NAMES = ["MIN"]
 
-    def eval(self, context: ExecutionContext):
-        value = self.expr[0].eval(context)
-        if self.accum is None:
-            self.accum = value
+    def update(self, state, value):
+        if state is None or value < state:
+            return value
 
-        elif value < self.accum:
-            self.accum = value
+        return state
 
-        return self.accum
+    def merge(self, state, other):
+        if other is None:
+            return state
+
+        return self.update(state, other)
 
 
 class AggregationMax(AggregateFunction):
     NAMES = ["MAX"]
 
-    def eval(self, context: ExecutionContext):
-        value = self.expr[0].eval(context)
-        if self.accum is None:
-            self.accum = value
+    def update(self, state, value):
+        if state is None or value > state:
+            return value
+
+        return state
 
-        elif value > self.accum:
-            self.accum = value
+    def merge(self, state, other):
+        if other is None:
+            return state
 
-        return self.accum
+        return self.update(state, other)
 
 
 class AggregationSum(AggregateFunction):
     NAMES = ["SUM"]
 
-    def eval(self, context: ExecutionContext):
-        value = self.expr[0].eval(context)
-        if self.accum is None:
-            self.accum = value
+    def update(self, state, value):
+        if state is None:
+            return value
 
-        else:
-            self.accum += value
+        return state + value
 
-        return self.accum
+    def merge(self, state, other):
+        if other is None:
+            return state
+
+        return self.update(state, other)
 
 
 class AggregationAverage(AggregateFunction):
     NAMES = ["AVG"]
 
-    def start(self):
-        self.accum = 0
-        self.seen = 0
+    def init(self):
+        # [total, count]
+        return [0, 0]
+
+    def update(self, state, value):
+        state[0] += value
+        state[1] += 1
+        return state
 
-    def eval(self, context: ExecutionContext):
-        value = self.expr[0].eval(context)
-        self.accum += value
-        self.seen += 1
+    def merge(self, state, other):
+        state[0] += other[0]
+        state[1] += other[1]
+        return state
 
-        return self.accum / self.seen
+    def finalize(self, state):
+        total, seen = state
+        if seen == 0:
+            return None
+
+        return total / seen
 
 
 class AggregationCount(AggregateFunction):
     NAMES = ["COUNT"]
 
-    def start(self):
-        self.accum = []
+    # This counts every value, including nulls. COUNT(*) is a count of
+    # null values, one per row
 
-    def eval(self, context: ExecutionContext):
-        # This is a dumb implementation for normal COUNT(), but
-        # I don't want to try to connect the sql parser to two
-        # different functions both called "count" rn - TODO
-        value = self.expr[0].eval(context)
-        self.accum.append(value)
+    def init(self):
+        if self.is_distinct():
+            return set()
 
-        if self.modifiers.get("DISTINCT"):
-            return len(set(self.accum))
-        else:
-            return len(self.accum)
+        return 0
+
+    def update(self, state, value):
+        if self.is_distinct():
+            state.add(value)
+            return state
+
+        return state + 1
+
+    def merge(self, state, other):
+        if self.is_distinct():
+            state.update(other)
+            return state
+
+        return state + other
+
+    def finalize(self, state):
+        if self.is_distinct():
+            return len(state)
+
+        return state
 
 
 class AggregationListAgg(AggregateFunction):
@@ -87,9 +116,6 @@ class AggregationListAgg(AggregateFunction):
 
         self.expr, self.delim = self.make_delim()
 
-    def start(self):
-        self.accum = []
-
     def make_delim(self):
         delim = ","
 
@@ -108,19 +134,31 @@ class AggregationListAgg(AggregateFunction):
 
         return expr, delim
 
-    def eval(self, context: ExecutionContext):
-        value = self.expr.eval(context)
-        self.accum.append(value)
+    def value_expr(self):
+        return self.expr
+
+    def init(self):
+        # DISTINCT keeps values in the order they were first seen
+        if self.is_distinct():
+            return {}
 
-        if self.modifiers.get("DISTINCT"):
-            values = []
-            seen = set()
-            for item in self.accum:
-                if item not in seen:
-                    values.append(item)
-                    seen.add(item)
+        return []
 
+    def update(self, state, value):
+        if self.is_distinct():
+            state[value] = True
         else:
-            values = self.accum
+            state.append(value)
+
+        return state
+
+    def merge(self, state, other):
+        if self.is_distinct():
+            state.update(other)
+        else:
+            state.extend(other)
+
+        return state
 
-        return self.delim.join([str(v) for v in values])
+    def finalize(self, state):
+        return self.delim.join([str(v) for v in state])
@@ -1,8 +1,8 @@
+from dbdb.expressions.vector_math import CannotVectorize
 from dbdb.tuples.context import ExecutionContext
+from dbdb.tuples.rows import find_field_index
 
 import enum
-from collections import defaultdict
-
 
 AGG_FUNCTION_INCOMPLETE = object()
 
@@ -32,24 +32,113 @@ class ScalarFunction(BaseFunction):
     def __init__(self, expr):
         self.expr = expr
 
+    def can_eval_batch(self):
+        return False
+
+    def eval_batch(self, batch):
+        raise CannotVectorize(f"Cannot vectorize {self.NAMES[0]}()")
+
 
 class AggregateFunction:
+    """
+    Aggregates are computed with an accumulator. The function itself holds
+    no state: init() returns the state for a new group, update() folds one
+    value into it, merge() combines the states of two groups computed
+    separately, and finalize() turns a state into the aggregated value.
+    States are plain python values so that they can be pickled.
+    """
+
     NAMES = []
     TYPE = FunctionTypes.AGGREGATE
 
     def __init__(self, expr, modifiers=None):
-        self.accum = None
         self.expr = expr
         self.modifiers = modifiers or dict()
 
-    def start(self):
-        self.accum = None
+    def is_distinct(self):
+        return bool(self.modifiers.get("DISTINCT"))
+
+    def value_expr(self):
+        "The expression whose values are aggregated"
+        return self.expr[0]
+
+    def init(self):
+        return None
+
+    def update(self, state, value):
+        raise NotImplementedError()
+
+    def merge(self, state, other):
+        raise NotImplementedError()
+
+    def finalize(self, state):
+        return state
+
+
+class WindowPartitions:
+    """
+    The input rows of a window, split up by its PARTITION BY columns and
+    sorted by its ORDER BY. This only needs to be done once for every
+    window function with the same PARTITION BY and ORDER BY.
+    """
+
+    def __init__(self, rows, partition_cols, order_cols):
+        key_indexes = []
+        if len(rows) > 0:
+            fields = rows[0].fields
+            key_indexes = [find_field_index(fields, col) for col in partition_cols]
+
+        partitions = {}
+        for index, row in enumerate(rows):
+            key = tuple([row.data[i] for i in key_indexes])
+            if key in partitions:
+                partitions[key].append(index)
+            else:
+                partitions[key] = [index]
+
+        self.partitions = []
+
+        # The (partition, position in partition) of every input row
+        self.positions = [None] * len(rows)
+
+        for indexes in partitions.values():
+            if order_cols:
+                indexes.sort(key=lambda i: order_cols.as_comparator(rows[i]))
+
+            partition_id = len(self.partitions)
+            for position, index in enumerate(indexes):
+                self.positions[index] = (partition_id, position)
+
+            self.partitions.append([rows[i] for i in indexes])
+
+    def locate(self, row_index):
+        "Returns the partition id of the input row at row_index, and its position"
+        return self.positions[row_index]
+
+
+class WindowStream:
+    """
+    Computes a window function over one partition whose rows arrive one at
+    a time, in window order. push() is called with each row and finish()
+    after the last one. Both return the results which have become known
+    since the last call, in row order.
+    """
+
+    def push(self, row):
+        raise NotImplementedError()
+
+    def finish(self):
+        return []
 
 
 class WindowFunction:
     NAMES = []
     TYPE = FunctionTypes.WINDOW
 
+    # Functions like ROW_NUMBER() ignore the frame and only look at the
+    # partition, so they don't need the rows in the frame copied out
+    USES_FRAME = True
+
     def __init__(self, expr, partition_cols, order_cols, frame_start, frame_end):
         self.expr = expr
         self.partition_cols = partition_cols
@@ -59,11 +148,34 @@ class WindowFunction:
 
         self._partitions = None
 
-    def get_partition(self, key):
-        if self._partitions is None:
-            raise RuntimeError("Window partitions are not initialized")
+        # Results of eval_partition(), by partition id
+        self._results = {}
+
+    def window_spec(self):
+        "Window functions with equal specs can share their partitions"
+        order = []
+        if self.order_cols:
+            order = [
+                (sort_field.ascending, sort_field.expression.column)
+                for sort_field in self.order_cols.order_by_list
+            ]
 
-        return self._partitions.get(key, [])
+        return tuple(self.partition_cols), tuple(order)
+
+    def make_partitions(self, rows):
+        return WindowPartitions(rows, self.partition_cols, self.order_cols)
+
+    def set_partitions(self, partitions):
+        self._partitions = partitions
+        self._results = {}
+
+    def can_stream(self):
+        "True if stream() can compute this function from rows in window order"
+        return False
+
+    def stream(self):
+        "Returns a WindowStream for the rows of one partition"
+        raise NotImplementedError()
 
     def get_frame_range(self, index, frame_size):
         start_index = None
@@ -91,48 +203,46 @@ class WindowFunction:
 
         return start_index, end_index
 
-    def make_sorted_partitions(self, rows):
-        partitions = defaultdict(list)
-
-        for row in rows:
-            key = tuple([row.field(c) for c in self.partition_cols])
-            partitions[key].append(row)
-
-        if not self.order_cols:
-            return partitions
-
-        # sort partitions if needed
-        sorted_partitions = {}
-        for key, rows in partitions.items():
-            sorted_partitions[key] = sorted(rows, key=self.order_cols.as_comparator)
-
-        return sorted_partitions
-
-    def partition_key(self, row):
-        return tuple([row.field(c) for c in self.partition_cols])
-
     def _eval(self, context: ExecutionContext):
         raise NotImplementedError()
 
+    def eval_partition(self, partition_rows):
+        """
+        Optional: return the result for every row of a partition at once,
+        in order. Otherwise, _eval() is called with each row's frame
+        """
+        return None
+
     def eval(self, context: ExecutionContext):
-        if self._partitions is None and context.rows:
-            self._partitions = self.make_sorted_partitions(context.rows)
-        elif not context.rows:
+        if not context.rows or context.row_index is None:
             raise RuntimeError(
                 "Rows were not materialized before window function execution"
             )
 
-        key = self.partition_key(context.row)
-        row_id = id(context.row)
+        if self._partitions is None:
+            self._partitions = self.make_partitions(context.rows)
+
+        partition_id, index = self._partitions.locate(context.row_index)
+        partition_rows = self._partitions.partitions[partition_id]
 
-        partition_rows = self.get_partition(key)
-        rows_by_id = [id(row) for row in partition_rows]
-        index = rows_by_id.index(row_id)
+        if partition_id not in self._results:
+            self._results[partition_id] = self.eval_partition(partition_rows)
 
-        start_idx, end_idx = self.get_frame_range(index, len(partition_rows))
-        frame_rows = partition_rows[start_idx : end_idx + 1]
+        results = self._results[partition_id]
+        if results is not None:
+            return results[index]
 
-        context = ExecutionContext(row=context.row, rows=frame_rows, row_index=index)
+        frame_rows = None
+        if self.USES_FRAME:
+            start_idx, end_idx = self.get_frame_range(index, len(partition_rows))
+            frame_rows = partition_rows[start_idx : end_idx + 1]
+
+        context = ExecutionContext(
+            row=context.row,
+            rows=frame_rows,
+            row_index=index,
+            partition=partition_rows,
+        )
 
         return self._eval(context)
 
@@ -144,5 +254,9 @@ class TableFunction:
     def generate(self):
         raise NotImplementedError()
 
+    def generate_batches(self):
+        "Optional: yield RecordBatches instead of rows from generate()"
+        return None
+
     def details(self):
         return {}
@@ -1,7 +1,15 @@
 from dbdb.expressions.functions.base import ScalarFunction
+from dbdb.expressions.vector_math import (
+    CannotVectorize,
+    truthy,
+    vec_float_func,
+    vec_pow,
+    vec_where,
+)
 from dbdb.tuples.context import ExecutionContext
 
 import math
+import numpy as np
 
 
 class FunctionSin(ScalarFunction):
@@ -11,6 +19,13 @@ class FunctionSin(ScalarFunction):
         value = self.expr[0].eval(context)
         return math.sin(value)
 
+    def can_eval_batch(self):
+        return True
+
+    def eval_batch(self, batch):
+        column = self.expr[0].eval_batch(batch)
+        return vec_float_func(np.sin, column), None
+
 
 class FunctionCos(ScalarFunction):
     NAMES = ["cos"]
@@ -19,6 +34,13 @@ class FunctionCos(ScalarFunction):
         value = self.expr[0].eval(context)
         return math.cos(value)
 
+    def can_eval_batch(self):
+        return True
+
+    def eval_batch(self, batch):
+        column = self.expr[0].eval_batch(batch)
+        return vec_float_func(np.cos, column), None
+
 
 class FunctionSquare(ScalarFunction):
     NAMES = ["sqr"]
@@ -31,6 +53,14 @@ class FunctionSquare(ScalarFunction):
         else:
             return -1
 
+    def can_eval_batch(self):
+        return True
+
+    def eval_batch(self, batch):
+        column = self.expr[0].eval_batch(batch)
+        values = vec_float_func(np.sin, column)
+        return np.where(values > 0, 1, -1), None
+
 
 class FunctionIff(ScalarFunction):
     NAMES = ["iff"]
@@ -45,6 +75,18 @@ class FunctionIff(ScalarFunction):
         else:
             return self.expr[2].eval(context)
 
+    def can_eval_batch(self):
+        return len(self.expr) == 3
+
+    def eval_batch(self, batch):
+        if len(self.expr) != 3:
+            raise CannotVectorize("IFF requires 3 args")
+
+        mask = truthy(self.expr[0].eval_batch(batch))
+        return vec_where(
+            mask, self.expr[1].eval_batch(batch), self.expr[2].eval_batch(batch)
+        )
+
 
 class FunctionPow(ScalarFunction):
     NAMES = ["pow"]
@@ -57,3 +99,12 @@ class FunctionPow(ScalarFunction):
         exp = self.expr[1].eval(context)
 
         return base**exp
+
+    def can_eval_batch(self):
+        return len(self.expr) == 2
+
+    def eval_batch(self, batch):
+        if len(self.expr) != 2:
+            raise CannotVectorize("POW requires 2 args")
+
+        return vec_pow(self.expr[0].eval_batch(batch), self.expr[1].eval_batch(batch))
@@ -1,5 +1,8 @@
 import asyncio
 from dbdb.expressions.functions.base import TableFunction
+from dbdb.tuples.batch import RecordBatch, BATCH_SIZE
+
+import numpy as np
 
 
 class GenerateSeriesTableFunction(TableFunction):
@@ -19,3 +22,16 @@ class GenerateSeriesTableFunction(TableFunction):
         for i in range(self.count):
             yield (int(i),)
             await asyncio.sleep(self.delay)
+
+    def generate_batches(self):
+        # Delayed series are meant to trickle out one row at a time
+        if self.delay:
+            return None
+
+        return self.make_batches()
+
+    async def make_batches(self):
+        for start in range(0, self.count, BATCH_SIZE):
+            end = min(start + BATCH_SIZE, self.count)
+            yield RecordBatch(["i"], [np.arange(start, end, dtype=np.int64)])
+            await asyncio.sleep(0)
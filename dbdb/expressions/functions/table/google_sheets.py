@@ -66,7 +66,9 @@ class GoogleSheetsTableFunction(TableFunction):
 
     async def fields(self):
         try:
-            return self.list_fields()
+            # The API client blocks, so call it from a thread to let other
+            # parts of the query run in the meantime
+            return await asyncio.to_thread(self.list_fields)
 
         except HttpError as e:
             err_data = json.loads(e.content).get("error", {})
@@ -85,11 +87,8 @@ class GoogleSheetsTableFunction(TableFunction):
         prefix = f"{tab}!" if tab else ""
         tab_range = f"{prefix}{start}2:{end}"
 
-        result = (
-            self.sheet.values()
-            .get(spreadsheetId=self.sheet_id, range=tab_range)
-            .execute()
-        )
+        request = self.sheet.values().get(spreadsheetId=self.sheet_id, range=tab_range)
+        result = await asyncio.to_thread(request.execute)
 
         for row in result.get("values", []):
             yield row
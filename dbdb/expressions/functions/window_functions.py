@@ -1,85 +1,442 @@
-from dbdb.expressions.functions.base import WindowFunction
+from dbdb.expressions.functions.base import WindowFunction, WindowStream
+from dbdb.expressions.expressions import Literal
 from dbdb.tuples.context import ExecutionContext
 
+from collections import deque
 
-class WindowCount(WindowFunction):
+
+class FrameAggregate(WindowFunction):
+    """
+    Aggregates the values of `expr` over each row's frame. From one row to
+    the next, both ends of a ROWS frame can only move forward. So rather
+    than re-scanning the frame for every row, values are added to a state
+    as they enter the frame and removed from it as they leave.
+    """
+
+    def init(self):
+        raise NotImplementedError()
+
+    def add(self, state, index, value):
+        raise NotImplementedError()
+
+    def remove(self, state, index, value):
+        raise NotImplementedError()
+
+    def result(self, state, frame_size):
+        raise NotImplementedError()
+
+    def frame_value(self, row):
+        return self.expr[0].eval(ExecutionContext(row=row))
+
+    def frame_values(self, partition_rows):
+        return [self.frame_value(row) for row in partition_rows]
+
+    def slide(self, values):
+        "Returns the result for each row's frame over `values`"
+        state = self.init()
+        results = []
+
+        # values[left:right] are in the current frame
+        left = 0
+        right = 0
+        for index in range(len(values)):
+            start, end = self.get_frame_range(index, len(values))
+            while right <= end:
+                state = self.add(state, right, values[right])
+                right += 1
+
+            while left < start:
+                state = self.remove(state, left, values[left])
+                left += 1
+
+            results.append(self.result(state, end - start + 1))
+
+        return results
+
+    def eval_partition(self, partition_rows):
+        return self.slide(self.frame_values(partition_rows))
+
+    def can_stream(self):
+        return True
+
+    def stream(self):
+        return FrameStream(self)
+
+
+class FrameStream(WindowStream):
+    """
+    Slides a FrameAggregate's frame over rows as they arrive. A row's result
+    is known once the end of its frame has arrived, so rows whose frame runs
+    to the end of the partition wait for finish(). Values are only kept
+    until they leave the frame, or until they enter it if the start of the
+    frame never moves.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.state = function.init()
+
+        frame_start = function.frame_start
+        frame_end = function.frame_end
+        has_frame = bool(frame_start and frame_end)
+
+        self.start_moves = has_frame and frame_start[0] != "UNBOUNDED"
+
+        # How many rows after a row its frame ends, if it ends before the
+        # end of the partition
+        self.end_offset = None
+        if has_frame and frame_end[0] == "CURRENT":
+            self.end_offset = 0
+        elif has_frame and frame_end[0] != "UNBOUNDED":
+            self.end_offset = frame_end[0]
+
+        # values[0] is the value of row `first`
+        self.values = deque()
+        self.first = 0
+        self.num_rows = 0
+        self.num_results = 0
+
+        # Rows left:right are in the current frame
+        self.left = 0
+        self.right = 0
+
+    def value(self, index):
+        return self.values[index - self.first]
+
+    def add(self, index, value):
+        self.state = self.function.add(self.state, index, value)
+
+    def remove(self, index, value):
+        self.state = self.function.remove(self.state, index, value)
+
+    def result(self, frame_size):
+        return self.function.result(self.state, frame_size)
+
+    def slide(self, num_results):
+        "Returns results until the first num_results rows have one"
+        results = []
+        while self.num_results < num_results:
+            index = self.num_results
+            start, end = self.function.get_frame_range(index, self.num_rows)
+            while self.right <= end:
+                self.add(self.right, self.value(self.right))
+                self.right += 1
+
+            while self.left < start:
+                self.remove(self.left, self.value(self.left))
+                self.left += 1
+
+            results.append(self.result(end - start + 1))
+            self.num_results += 1
+
+        keep_from = self.left if self.start_moves else self.right
+        while self.first < keep_from:
+            self.values.popleft()
+            self.first += 1
+
+        return results
+
+    def push(self, row):
+        self.values.append(self.function.frame_value(row))
+        self.num_rows += 1
+
+        if self.end_offset is None:
+            return []
+
+        return self.slide(self.num_rows - self.end_offset)
+
+    def finish(self):
+        return self.slide(self.num_rows)
+
+
+class SumState:
+    """
+    Ints and floats are totalled separately. Removing a float from a sum
+    can leave it slightly off, but ints stay exact (and stay ints) once
+    every float has left the frame.
+    """
+
+    def __init__(self):
+        self.int_total = 0
+        self.float_total = 0.0
+        self.num_floats = 0
+
+    def add(self, value):
+        if isinstance(value, float):
+            self.float_total += value
+            self.num_floats += 1
+        else:
+            self.int_total += value
+
+    def remove(self, value):
+        if isinstance(value, float):
+            self.float_total -= value
+            self.num_floats -= 1
+            if self.num_floats == 0:
+                self.float_total = 0.0
+        else:
+            self.int_total -= value
+
+    def total(self):
+        if self.num_floats == 0:
+            return self.int_total
+
+        return self.int_total + self.float_total
+
+
+class MonotonicDeque:
+    """
+    Tracks the min (or max) of a sliding frame. Values are kept in frame
+    order, and a value is dropped as soon as a later one beats it, since
+    it can never be the result again. The front is the result, and it is
+    the first of any equal values in the frame.
+    """
+
+    def __init__(self, beats):
+        self.beats = beats
+        self.entries = deque()
+
+    def add(self, index, value):
+        while self.entries and self.beats(value, self.entries[-1][1]):
+            self.entries.pop()
+        self.entries.append((index, value))
+
+    def remove(self, index):
+        if self.entries and self.entries[0][0] == index:
+            self.entries.popleft()
+
+    def front(self):
+        return self.entries[0][1]
+
+
+class WindowCount(FrameAggregate):
     NAMES = ["COUNT"]
 
-    def _eval(self, context: ExecutionContext):
-        return len(context.rows)
+    # Every row in the frame is counted, so only its size matters
+    def frame_value(self, row):
+        return None
+
+    def init(self):
+        return None
+
+    def add(self, state, index, value):
+        return state
+
+    def remove(self, state, index, value):
+        return state
+
+    def result(self, state, frame_size):
+        return frame_size
+
+
+class RowNumberStream(WindowStream):
+    def __init__(self):
+        self.num_rows = 0
+
+    def push(self, row):
+        self.num_rows += 1
+        return [self.num_rows]
 
 
 class WindowRowNumber(WindowFunction):
     NAMES = ["ROW_NUMBER"]
+    USES_FRAME = False
 
     def _eval(self, context: ExecutionContext):
-        index = context.rows.index(context.row)
-        return index + 1
+        return context.row_index + 1
+
+    def can_stream(self):
+        return True
+
+    def stream(self):
+        return RowNumberStream()
 
 
-class WindowSum(WindowFunction):
+class WindowSum(FrameAggregate):
     NAMES = ["SUM"]
 
-    def _eval(self, context: ExecutionContext):
-        total = 0
-        for row in context.rows:
-            ctx = ExecutionContext(row=row)
-            value = self.expr[0].eval(ctx)
-            total += value
+    def init(self):
+        return SumState()
 
-        return total
+    def add(self, state, index, value):
+        state.add(value)
+        return state
 
+    def remove(self, state, index, value):
+        state.remove(value)
+        return state
 
-class WindowMin(WindowFunction):
-    NAMES = ["MIN"]
+    def result(self, state, frame_size):
+        return state.total()
 
-    def _eval(self, context: ExecutionContext):
-        min_val = None
 
-        for row in context.rows:
-            ctx = ExecutionContext(row=row)
-            value = self.expr[0].eval(ctx)
-            if min_val is None or value < min_val:
-                min_val = value
+class WindowMinMax(FrameAggregate):
+    def beats(self, value, other):
+        raise NotImplementedError()
 
-        return min_val
+    def init(self):
+        return MonotonicDeque(self.beats)
 
+    def add(self, state, index, value):
+        state.add(index, value)
+        return state
 
-class WindowMax(WindowFunction):
-    NAMES = ["MAX"]
+    def remove(self, state, index, value):
+        state.remove(index)
+        return state
+
+    def result(self, state, frame_size):
+        return state.front()
+
+    def fold(self, values):
+        # A null is skipped until there is a result, and raises after that
+        result = None
+        for value in values:
+            if result is None or self.beats(value, result):
+                result = value
+
+        return result
 
     def _eval(self, context: ExecutionContext):
-        max_val = None
-        for row in context.rows:
-            ctx = ExecutionContext(row=row)
-            value = self.expr[0].eval(ctx)
-            if max_val is None or value > max_val:
-                max_val = value
+        return self.fold(self.frame_values(context.rows))
+
+    def stream(self):
+        return MinMaxStream(self)
+
+    def eval_partition(self, partition_rows):
+        values = self.frame_values(partition_rows)
+        if any(value is None for value in values):
+            # Whether comparing a null raises depends on where it is in the
+            # frame, so evaluate each frame from scratch
+            return None
+
+        return self.slide(values)
+
+
+class MinMaxStream(FrameStream):
+    """
+    Nulls are kept out of the deque. While one is in the frame, the result
+    is found by folding over the frame, as _eval() does. If the start of
+    the frame never moves, the fold is kept up to date as values are added
+    instead.
+    """
+
+    def __init__(self, function):
+        super().__init__(function)
+        self.num_nulls = 0
+        self.folded = None
+
+    def add(self, index, value):
+        if not self.start_moves:
+            if self.folded is None or self.function.beats(value, self.folded):
+                self.folded = value
+        elif value is None:
+            self.num_nulls += 1
+        else:
+            super().add(index, value)
+
+    def remove(self, index, value):
+        if value is None:
+            self.num_nulls -= 1
+        else:
+            super().remove(index, value)
+
+    def result(self, frame_size):
+        if not self.start_moves:
+            return self.folded
+        elif self.num_nulls > 0:
+            values = [self.value(i) for i in range(self.left, self.right)]
+            return self.function.fold(values)
+
+        return super().result(frame_size)
+
+
+class WindowMin(WindowMinMax):
+    NAMES = ["MIN"]
+
+    def beats(self, value, other):
+        return value < other
 
-        return max_val
 
+class WindowMax(WindowMinMax):
+    NAMES = ["MAX"]
+
+    def beats(self, value, other):
+        return value > other
 
-class WindowAverage(WindowFunction):
+
+class WindowAverage(WindowSum):
     NAMES = ["AVG", "MEAN"]
 
-    def _eval(self, context: ExecutionContext):
-        total = 0
-        seen = 0
-        for row in context.rows:
-            ctx = ExecutionContext(row=row)
-            value = self.expr[0].eval(ctx)
-            total += value
-            seen += 1
-
-        if seen == 0:
+    def result(self, state, frame_size):
+        return state.total() / frame_size
+
+
+class OffsetFunction(WindowFunction):
+    USES_FRAME = False
+
+    def offset_value(self, row):
+        return self.expr[0].eval(ExecutionContext(row=row))
+
+    def constant_offset(self):
+        "The offset, if it is the same non-negative number for every row"
+        if len(self.expr) < 2:
+            return 1
+
+        offset_expr = self.expr[1]
+        if not isinstance(offset_expr, Literal) or not isinstance(offset_expr.val, int):
+            return None
+        elif offset_expr.val < 0:
             return None
 
-        return total / seen
+        return offset_expr.val
+
+    def can_stream(self):
+        return self.constant_offset() is not None
 
 
-class WindowLag(WindowFunction):
+class LagStream(WindowStream):
+    "Keeps the values of the last `offset` rows"
+
+    def __init__(self, function, offset):
+        self.function = function
+        self.values = deque(maxlen=offset + 1)
+
+    def push(self, row):
+        self.values.append(self.function.offset_value(row))
+        if len(self.values) == self.values.maxlen:
+            return [self.values[0]]
+
+        return [None]
+
+
+class LeadStream(WindowStream):
+    "A row's result is the value of the row `offset` rows later, once it arrives"
+
+    def __init__(self, function, offset):
+        self.function = function
+        self.offset = offset
+        self.num_rows = 0
+        self.num_results = 0
+
+    def push(self, row):
+        self.num_rows += 1
+        if self.num_rows <= self.offset:
+            return []
+
+        self.num_results += 1
+        return [self.function.offset_value(row)]
+
+    def finish(self):
+        return [None] * (self.num_rows - self.num_results)
+
+
+class WindowLag(OffsetFunction):
     NAMES = ["LAG"]
 
+    def stream(self):
+        return LagStream(self, self.constant_offset())
+
     def _eval(self, context: ExecutionContext):
         if len(self.expr) == 2:
             offset_expr = self.expr[1]
@@ -88,18 +445,21 @@ class WindowLag(WindowFunction):
             offset = 1
 
         row_idx = context.row_index - offset
-        if row_idx < 0 or row_idx >= len(context.rows):
+        if row_idx < 0 or row_idx >= len(context.partition):
             return None
 
-        row = context.rows[row_idx]
+        row = context.partition[row_idx]
         ctx = ExecutionContext(row=row)
         value = self.expr[0].eval(ctx)
         return value
 
 
-class WindowLead(WindowFunction):
+class WindowLead(OffsetFunction):
     NAMES = ["LEAD"]
 
+    def stream(self):
+        return LeadStream(self, self.constant_offset())
+
     def _eval(self, context: ExecutionContext):
         if len(self.expr) == 2:
             offset_expr = self.expr[1]
@@ -108,10 +468,10 @@ class WindowLead(WindowFunction):
             offset = 1
 
         row_idx = context.row_index + offset
-        if row_idx < 0 or row_idx >= len(context.rows):
+        if row_idx < 0 or row_idx >= len(context.partition):
             return None
 
-        row = context.rows[row_idx]
+        row = context.partition[row_idx]
         ctx = ExecutionContext(row=row)
         value = self.expr[0].eval(ctx)
         return value
@@ -1,5 +1,67 @@
-from dbdb.expressions.expressions import Expression
+from dbdb.expressions.expressions import (
+    Expression,
+    BinaryOperator,
+    ColumnIdentifier,
+    split_conjuncts,
+    join_conjuncts,
+)
 from dbdb.tuples.context import ExecutionContext
+from dbdb.tuples.rows import find_field_index
+
+
+def resolves_in(fields, name):
+    try:
+        find_field_index(fields, name)
+        return True
+    except RuntimeError:
+        return False
+
+
+def find_join_side(expr, left_fields, right_fields):
+    "Returns 'left' or 'right' if expr only references one side of a join"
+    sides = set()
+    for node in expr.walk(lambda e: e):
+        if not isinstance(node, ColumnIdentifier):
+            continue
+
+        name = node.qualify()
+        in_left = resolves_in(left_fields, name)
+        in_right = resolves_in(right_fields, name)
+
+        if in_left and not in_right:
+            sides.add("left")
+        elif in_right and not in_left:
+            sides.add("right")
+        else:
+            # Ambiguous or missing. The nested loop join reports these
+            return None
+
+    if len(sides) == 1:
+        return sides.pop()
+
+    return None
+
+
+def is_equality(expr):
+    return isinstance(expr, BinaryOperator) and expr.operator == "="
+
+
+class EquiJoinKeys:
+    """
+    The part of a join condition that can be answered with a hash table:
+    `left_exprs` are evaluated against rows from the left side of the
+    join, `right_exprs` against the right side, and rows join when every
+    pair of keys is equal. Anything else in the condition is kept in
+    `residual` and evaluated against the joined row.
+    """
+
+    def __init__(self, left_exprs, right_exprs, residual, nulls_match):
+        self.left_exprs = left_exprs
+        self.right_exprs = right_exprs
+        self.residual = residual
+
+        # `a = b` is null if either side is, but USING compares with !=
+        self.nulls_match = nulls_match
 
 
 class JoinClause(Expression):
@@ -17,7 +79,15 @@ class JoinClause(Expression):
         return cls(to, join_type, on=True)
 
 
-class JoinCondition: ...
+class JoinCondition:
+    def bind(self, fields):
+        pass
+
+    def has_equi_keys(self):
+        return False
+
+    def find_equi_keys(self, left_fields, right_fields):
+        return None
 
 
 class JoinConditionOn(JoinCondition):
@@ -27,6 +97,40 @@ class JoinConditionOn(JoinCondition):
     def eval(self, context: ExecutionContext):
         return self.join_expr.eval(context)
 
+    def bind(self, fields):
+        self.join_expr.bind(fields)
+
+    def has_equi_keys(self):
+        return any(is_equality(expr) for expr in split_conjuncts(self.join_expr))
+
+    def find_equi_keys(self, left_fields, right_fields):
+        left_exprs = []
+        right_exprs = []
+        residual = []
+
+        for expr in split_conjuncts(self.join_expr):
+            if is_equality(expr):
+                lhs_side = find_join_side(expr.lhs, left_fields, right_fields)
+                rhs_side = find_join_side(expr.rhs, left_fields, right_fields)
+
+                if (lhs_side, rhs_side) == ("left", "right"):
+                    left_exprs.append(expr.lhs)
+                    right_exprs.append(expr.rhs)
+                    continue
+                elif (lhs_side, rhs_side) == ("right", "left"):
+                    left_exprs.append(expr.rhs)
+                    right_exprs.append(expr.lhs)
+                    continue
+
+            residual.append(expr)
+
+        if len(left_exprs) == 0:
+            return None
+
+        return EquiJoinKeys(
+            left_exprs, right_exprs, join_conjuncts(residual), nulls_match=False
+        )
+
     @classmethod
     def from_tokens(cls, toks):
         on, expr = toks
@@ -37,9 +141,27 @@ class JoinConditionUsing(JoinConditionOn):
     def __init__(self, fields):
         self.fields = fields
 
+        # Set by bind()
+        self._bound_fields = None
+        self._indexes = None
+
+    def bind(self, fields):
+        self._bound_fields = fields
+        self._indexes = [
+            [i for i, field in enumerate(fields) if field.is_match(name)]
+            for name in self.fields
+        ]
+
+    def iter_values(self, row):
+        if row.fields is self._bound_fields:
+            for indexes in self._indexes:
+                yield [row.data[i] for i in indexes]
+        else:
+            for field in self.fields:
+                yield list(row.iter_values_for_field(field))
+
     def eval(self, context: ExecutionContext):
-        for field in self.fields:
-            values = list(context.row.iter_values_for_field(field))
+        for values in self.iter_values(context.row):
             if len(values) != 2:
                 raise RuntimeError(
                     f"Unexpected results while processing join: {values}, {self.fields}"
@@ -50,6 +172,19 @@ class JoinConditionUsing(JoinConditionOn):
 
         return True
 
+    def has_equi_keys(self):
+        return True
+
+    def find_equi_keys(self, left_fields, right_fields):
+        for name in self.fields:
+            in_left = resolves_in(left_fields, name)
+            in_right = resolves_in(right_fields, name)
+            if not in_left or not in_right:
+                return None
+
+        keys = [ColumnIdentifier(table=None, column=name) for name in self.fields]
+        return EquiJoinKeys(keys, keys, residual=None, nulls_match=True)
+
     @classmethod
     def from_tokens(cls, toks):
         return JoinConditionUsing(toks.fields)
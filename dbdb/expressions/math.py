@@ -1,4 +1,9 @@
+import functools
+
+
 def nullcheck(inner):
+    # wraps() keeps the name of the operator, so expressions can be pickled
+    @functools.wraps(inner)
     def check_nulls(*args):
         if None in args:
             return None
@@ -0,0 +1,388 @@
+from dbdb.tuples.batch import make_column, make_object_column
+
+import functools
+import numpy as np
+import operator
+import os
+
+
+"""
+Vectorized versions of the operators in math.py. Expressions evaluate a
+whole RecordBatch at once with eval_batch(), which returns a "column":
+a (values, validity) tuple of numpy arrays. `validity` is a boolean mask
+where True means the value is present, or None if every value is.
+
+Operators only compute results for the valid rows of their inputs, so
+nulls are never added, divided, etc. Object columns (strings, mixed
+types) fall back to python semantics element by element.
+
+The results have to match the row-by-row interpreter exactly. Anything
+that numpy would do differently (int overflow, division by zero,
+negating a null, ...) raises CannotVectorize instead, and the caller
+evaluates the batch one row at a time. That path then returns the
+same values (or raises the same errors) that it always has.
+
+Set DBDB_VECTORIZE_EXPRESSIONS=0 to evaluate every batch row by row.
+"""
+
+ENABLED = os.getenv("DBDB_VECTORIZE_EXPRESSIONS", "1") != "0"
+
+INT64_MAX = 2**63 - 1
+
+
+class CannotVectorize(Exception):
+    pass
+
+
+# Errors which mean "use the row path for this batch instead"
+VECTOR_ERRORS = (CannotVectorize, TypeError, ValueError, ArithmeticError)
+
+
+def can_vectorize(expr):
+    return ENABLED and expr.can_eval_batch()
+
+
+def merge_validity(*masks):
+    merged = None
+    for mask in masks:
+        if mask is None:
+            continue
+        merged = mask if merged is None else merged & mask
+
+    return merged
+
+
+def has_nulls(validity):
+    return validity is not None and not validity.all()
+
+
+def as_number(values):
+    # Python treats bools as ints in arithmetic
+    if values.dtype == np.bool_:
+        return values.astype(np.int64)
+    return values
+
+
+def is_numeric(values):
+    return values.dtype.kind in "biuf"
+
+
+def int_bound(values):
+    "Largest absolute value in an int array, as a python int"
+    if len(values) == 0:
+        return 0
+    return max(abs(int(values.min())), abs(int(values.max())))
+
+
+def load_column(values, validity):
+    "Normalize a column from a RecordBatch for use in vector operations"
+    if values.dtype.kind in "iu" and values.dtype != np.int64:
+        # Small ints and dates would overflow much sooner than python ints
+        values = values.astype(np.int64)
+    elif values.dtype == object and validity is None:
+        # Object columns store nulls as None, so find them
+        validity = np.not_equal(values, None)
+        if validity.all():
+            validity = None
+
+    return values, validity
+
+
+def make_constant(value, num_rows):
+    if value is None:
+        return np.zeros(num_rows, dtype=np.int64), np.zeros(num_rows, dtype=bool)
+
+    try:
+        values = np.full(num_rows, value)
+    except OverflowError:
+        values = None
+
+    # eg. strings become "<U5" arrays, which behave differently
+    if values is None or not is_numeric(values):
+        values = np.full(num_rows, value, dtype=object)
+
+    return values, None
+
+
+def to_batch_column(column):
+    "Convert a column to the (values, validity) layout that RecordBatch uses"
+    values, validity = column
+    if values.dtype == object:
+        # Re-type the values, eg. if a string column was cast to ints
+        values = values.tolist()
+        if validity is not None:
+            for index in np.flatnonzero(~validity).tolist():
+                values[index] = None
+        return make_column(values)
+
+    if validity is not None and validity.all():
+        validity = None
+
+    return values, validity
+
+
+def to_objects(column):
+    "Convert a column to an object array of python values"
+    values, validity = column
+    values = make_object_column(values.tolist())
+    if validity is not None:
+        values[~validity] = None
+
+    return values
+
+
+def truthy(column):
+    "Mask of the values which python considers to be true"
+    values, validity = column
+    if values.dtype == np.bool_:
+        result = values
+    elif is_numeric(values):
+        result = values != 0
+    else:
+        result = np.fromiter(map(bool, values.tolist()), dtype=bool, count=len(values))
+
+    if validity is not None:
+        result = result & validity
+
+    return result
+
+
+def apply_valid(func, validity, *values):
+    "Apply `func` to the valid rows only"
+    if validity is None:
+        return func(*values)
+
+    result = func(*[column[validity] for column in values])
+    if result.dtype == object:
+        out = np.full(len(validity), None, dtype=object)
+    else:
+        out = np.zeros(len(validity), dtype=result.dtype)
+
+    out[validity] = result
+    return out
+
+
+def vec_nullcheck(inner):
+    @functools.wraps(inner)
+    def check_nulls(lhs, rhs):
+        (lvalues, lvalidity), (rvalues, rvalidity) = lhs, rhs
+        validity = merge_validity(lvalidity, rvalidity)
+        return apply_valid(inner, validity, lvalues, rvalues), validity
+
+    return check_nulls
+
+
+def arithmetic(op, lhs, rhs):
+    lhs = as_number(lhs)
+    rhs = as_number(rhs)
+
+    # Python ints never overflow, but numpy's do
+    if lhs.dtype.kind == "i" and rhs.dtype.kind == "i":
+        lbound, rbound = int_bound(lhs), int_bound(rhs)
+        bound = lbound * rbound if op is operator.mul else lbound + rbound
+        if bound > INT64_MAX:
+            raise CannotVectorize("Integer overflow")
+
+    return op(lhs, rhs)
+
+
+def compare(op, lhs, rhs):
+    result = op(lhs, rhs)
+    if result.dtype != np.bool_:
+        result = result.astype(bool)
+    return result
+
+
+@vec_nullcheck
+def vec_add(l, r):
+    return arithmetic(operator.add, l, r)
+
+
+@vec_nullcheck
+def vec_sub(l, r):
+    return arithmetic(operator.sub, l, r)
+
+
+@vec_nullcheck
+def vec_mul(l, r):
+    return arithmetic(operator.mul, l, r)
+
+
+@vec_nullcheck
+def vec_div(l, r):
+    if is_numeric(r) and not r.all():
+        raise CannotVectorize("Division by zero")
+    return operator.truediv(as_number(l), as_number(r))
+
+
+def vec_and(lhs, rhs):
+    return truthy(lhs) & truthy(rhs), None
+
+
+@vec_nullcheck
+def vec_or(l, r):
+    # `l or r` returns one of its operands, so only bools are simple
+    if l.dtype != np.bool_ or r.dtype != np.bool_:
+        raise CannotVectorize("OR of non-boolean values")
+    return l | r
+
+
+@vec_nullcheck
+def vec_eq(l, r):
+    return compare(operator.eq, l, r)
+
+
+@vec_nullcheck
+def vec_neq(l, r):
+    return compare(operator.ne, l, r)
+
+
+@vec_nullcheck
+def vec_lt(l, r):
+    return compare(operator.lt, l, r)
+
+
+@vec_nullcheck
+def vec_gt(l, r):
+    return compare(operator.gt, l, r)
+
+
+@vec_nullcheck
+def vec_lte(l, r):
+    return compare(operator.le, l, r)
+
+
+@vec_nullcheck
+def vec_gte(l, r):
+    return compare(operator.ge, l, r)
+
+
+def vec_is(lhs, rhs):
+    # Only `x IS NULL` can be answered with the validity masks
+    (_, lvalidity), (_, rvalidity) = lhs, rhs
+    num_rows = len(lhs[0])
+
+    if rvalidity is not None and not rvalidity.any():
+        result = np.zeros(num_rows, dtype=bool) if lvalidity is None else ~lvalidity
+    elif lvalidity is not None and not lvalidity.any():
+        result = np.zeros(num_rows, dtype=bool) if rvalidity is None else ~rvalidity
+    else:
+        raise CannotVectorize("IS comparison of non-null values")
+
+    return result, None
+
+
+def vec_is_not(lhs, rhs):
+    result, validity = vec_is(lhs, rhs)
+    return ~result, validity
+
+
+def cast_values(values, ttype):
+    if ttype is float and is_numeric(values):
+        return as_number(values).astype(np.float64)
+
+    elif ttype is int and is_numeric(values):
+        values = as_number(values)
+        if values.dtype.kind == "f":
+            if not np.isfinite(values).all() or np.abs(values).max() >= 2**63:
+                raise CannotVectorize("Cannot cast float to int")
+        return values.astype(np.int64)
+
+    return make_object_column([ttype(value) for value in values.tolist()])
+
+
+def vec_cast(lhs, rhs):
+    values, validity = lhs
+    ttype, _ = rhs
+
+    return apply_valid(lambda v: cast_values(v, ttype), validity, values), validity
+
+
+def vec_negate(column):
+    values, validity = column
+    if has_nulls(validity):
+        # -None raises in the row path
+        raise CannotVectorize("Cannot negate a null")
+
+    if is_numeric(values):
+        values = as_number(values)
+        if values.dtype.kind == "i" and int_bound(values) > INT64_MAX:
+            raise CannotVectorize("Integer overflow")
+
+    return -values, None
+
+
+def vec_float_func(func, column):
+    "Evaluate a math function which takes a single number, eg. sin()"
+    values, validity = column
+    if has_nulls(validity) or not is_numeric(values):
+        raise CannotVectorize(f"Cannot vectorize {func.__name__}")
+
+    values = as_number(values).astype(np.float64)
+    if not np.isfinite(values).all():
+        raise CannotVectorize(f"Cannot vectorize {func.__name__}")
+
+    return func(values)
+
+
+def vec_pow(base, exp):
+    (base, base_validity), (exp, exp_validity) = base, exp
+    if has_nulls(base_validity) or has_nulls(exp_validity):
+        raise CannotVectorize("pow() of a null")
+
+    base = as_number(base)
+    exp = as_number(exp)
+
+    if base.dtype.kind == "i" and exp.dtype.kind == "i":
+        if len(exp) > 0 and int(exp.min()) < 0:
+            raise CannotVectorize("Negative integer exponent")
+
+        base_bound = int_bound(base)
+        exp_bound = int_bound(exp)
+        if base_bound > 1 and (exp_bound > 63 or base_bound**exp_bound > INT64_MAX):
+            raise CannotVectorize("Integer overflow")
+
+        return np.power(base, exp), None
+
+    # numpy's float pow() can differ from python's in the last bit
+    values = [b**e for b, e in zip(base.tolist(), exp.tolist())]
+    return make_object_column(values), None
+
+
+def vec_where(mask, lhs, rhs):
+    (lvalues, lvalidity), (rvalues, rvalidity) = lhs, rhs
+
+    if lvalues.dtype != rvalues.dtype:
+        values = np.where(mask, to_objects(lhs), to_objects(rhs))
+        return load_column(values, None)
+
+    values = np.where(mask, lvalues, rvalues)
+    if lvalidity is None and rvalidity is None:
+        return values, None
+
+    num_rows = len(mask)
+    if lvalidity is None:
+        lvalidity = np.ones(num_rows, dtype=bool)
+    if rvalidity is None:
+        rvalidity = np.ones(num_rows, dtype=bool)
+
+    return values, np.where(mask, lvalidity, rvalidity)
+
+
+VECTOR_OP_MAP = {
+    "+": vec_add,
+    "-": vec_sub,
+    "*": vec_mul,
+    "/": vec_div,
+    "AND": vec_and,
+    "OR": vec_or,
+    "=": vec_eq,
+    "!=": vec_neq,
+    "IS": vec_is,
+    "IS_NOT": vec_is_not,
+    "<": vec_lt,
+    ">": vec_gt,
+    "<=": vec_lte,
+    ">=": vec_gte,
+    "::": vec_cast,
+}
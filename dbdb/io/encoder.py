@@ -1,6 +1,9 @@
 from dbdb.io.types import DataEncoding, DataType
 from dbdb.io import compressor
+from dbdb.io.predicates import clip_ranges, merge_ranges
+from dbdb.tuples.batch import vector_to_list
 from itertools import chain
+import numpy as np
 import struct
 
 
@@ -86,6 +89,112 @@ def decode_null_bitmap(bitfield_buffer, data, num_records):
                 break
 
 
+def decode_validity(bitfield_buffer, num_records):
+    # Vectorized version of decode_null_bitmap. Returns a boolean array
+    # where True means that the value at that position is present
+    bitfield = np.frombuffer(bitfield_buffer, dtype=np.uint8)
+    bits = np.unpackbits(bitfield, count=num_records, bitorder="little")
+    return bits.view(bool)
+
+
+class PageHeader:
+    """
+    Every data page is prefixed with an uncompressed header:
+
+        int32   number of values in the page (including nulls)
+        int32   number of null values in the page
+        bool    are min/max stats present?
+        <type>  min value (only for types that support stats)
+        <type>  max value (only for types that support stats)
+        int32   size of the (compressed) page body in bytes
+
+    The header is fixed-width for a given column, so it can be read (and
+    the page body skipped over) without decompressing or decoding data.
+    """
+
+    def __init__(
+        self,
+        num_values,
+        null_count,
+        min_val=None,
+        max_val=None,
+        page_size=0,
+    ):
+        self.num_values = num_values
+        self.null_count = null_count
+        self.min_val = min_val
+        self.max_val = max_val
+        self.page_size = page_size
+
+    @property
+    def has_stats(self):
+        return self.min_val is not None and self.max_val is not None
+
+    @classmethod
+    def pack_format(cls, column_info):
+        column_type = column_info.column_type
+        if column_type.supports_column_stats():
+            pack_string = DataType.pack_string(column_type, column_info.column_width)
+            stats_f = f"{pack_string}{pack_string}"
+        else:
+            stats_f = ""
+
+        return f">ii?{stats_f}i"
+
+    @classmethod
+    def size(cls, column_info):
+        return struct.calcsize(cls.pack_format(column_info))
+
+    @classmethod
+    def for_page(cls, column_info, page_data, present_data):
+        min_val = None
+        max_val = None
+        if column_info.column_type.supports_column_stats() and present_data:
+            min_val = min(present_data)
+            max_val = max(present_data)
+
+        return cls(
+            num_values=len(page_data),
+            null_count=len(page_data) - len(present_data),
+            min_val=min_val,
+            max_val=max_val,
+        )
+
+    def serialize(self, column_info):
+        pack_f = self.pack_format(column_info)
+        values = [self.num_values, self.null_count, self.has_stats]
+
+        if column_info.column_type.supports_column_stats():
+            if self.has_stats:
+                values += [self.min_val, self.max_val]
+            else:
+                values += [0, 0]
+
+        values.append(self.page_size)
+        return struct.pack(pack_f, *values)
+
+    @classmethod
+    def deserialize(cls, column_info, buffer, offset=0):
+        pack_f = cls.pack_format(column_info)
+        unpacked = struct.unpack_from(pack_f, buffer, offset=offset)
+
+        num_values, null_count, has_stats = unpacked[:3]
+        page_size = unpacked[-1]
+
+        min_val = None
+        max_val = None
+        if has_stats:
+            min_val, max_val = unpacked[3:5]
+
+        return cls(
+            num_values=num_values,
+            null_count=null_count,
+            min_val=min_val,
+            max_val=max_val,
+            page_size=page_size,
+        )
+
+
 class DataEncoder:
     def __init__(self, column_info):
         self.column_info = column_info
@@ -109,31 +218,42 @@ class DataEncoder:
         return pages
 
     def from_pages(self, buffer):
+        header_size = PageHeader.size(self.column_info)
+
         i = 0
         while i < len(buffer):
-            # Read number of bytes in page
-            (page_size,) = struct.unpack_from(">i", buffer, offset=i)
+            header = PageHeader.deserialize(self.column_info, buffer, offset=i)
 
-            # Advance past page_size
-            page_start = i + 4
-            page_end = page_start + page_size
-            # Read page_size_p bytes from buffer. This is a page
+            # Advance past the page header
+            page_start = i + header_size
+            page_end = page_start + header.page_size
 
-            # TODO: Will this work with a file pointer? prolly now?
-            # can we read from a buffer?
             compressed_page_data = buffer[page_start:page_end]
 
             decompressed = self.decompress_page(compressed_page_data)
-            yield decompressed
+            yield header, decompressed
 
             i = page_end
 
+    @property
+    def numpy_dtype(self):
+        dtype = DataType.numpy_dtype(self.col_type)
+        if dtype is None:
+            return None
+
+        return np.dtype(dtype)
+
     def _encode(self, page):
         raise NotImplementedError()
 
     def _decode(self, page):
         raise NotImplementedError()
 
+    def _decode_vector(self, page):
+        # Returns a numpy array of the (non-null) values in the page, or
+        # None if this encoding can only be decoded value-by-value
+        return None
+
     def compress_page(self, page):
         compression_type = self.column_info.compression
         return compressor.compress(compression_type, page)
@@ -143,18 +263,15 @@ class DataEncoder:
         return compressor.decompress(compression_type, page)
 
     def format_page(self, pages):
-        # Pages is a list of bytearrays
-        # Write page header here....
-        # Should we be collecting stats as we encode? probably..
+        # Pages is a list of (PageHeader, bytearray) tuples
         buffer = bytearray()
 
-        for page in pages:
+        for header, page in pages:
             # Compress first so that we know the page size
             compressed = self.compress_page(page)
 
-            page_size = len(compressed)
-            page_size_p = struct.pack(">i", page_size)
-            buffer.extend(page_size_p)
+            header.page_size = len(compressed)
+            buffer.extend(header.serialize(self.column_info))
             buffer.extend(compressed)
 
         return buffer
@@ -198,9 +315,10 @@ class DataEncoder:
         pages = []
         for page_data in chunked:
             bitfield, present_data = encode_null_bitmap(page_data)
+            header = PageHeader.for_page(self.column_info, page_data, present_data)
             encoded = self._encode(present_data)
             encoded_with_bitfield = self.encode_bitfield(bitfield, encoded)
-            pages.append(encoded_with_bitfield)
+            pages.append((header, encoded_with_bitfield))
 
         return self.format_page(pages)
 
@@ -208,45 +326,148 @@ class DataEncoder:
         self.validate()
 
         flat = []
-        for page in self.from_pages(buffer):
-            bitfield_buffer, data_buffer = self.decode_bitfield(page)
-            decoded = self._decode(data_buffer)
-            # TODO : I don't think i did this right... it should be #
-            # of records in a page, not number of records in one column.
-            with_nulls = decode_null_bitmap(bitfield_buffer, decoded, num_records)
-            flat.extend(with_nulls)
+        for header, page in self.from_pages(buffer):
+            flat.extend(self.decode_page(header, page))
 
         return flat
 
-    def iter_pages(self, fh, start, end):
-        pos = start
-        while pos < end:
-            fh.seek(pos)
-            # Read number of bytes in page
-            buffer = fh.read(4)
-            (page_size,) = struct.unpack(">i", buffer)
+    def read_page_header(self, fh, pos):
+        header_size = PageHeader.size(self.column_info)
+        buffer = fh.read_at(pos, header_size)
+        return PageHeader.deserialize(self.column_info, buffer)
 
-            # Advance past page_size
-            buffer = fh.read(page_size)
+    def iter_page_headers(self, fh, start, end):
+        # Walk the page headers for a column without reading page bodies.
+        # Yields (header, position of page body) tuples
+        header_size = PageHeader.size(self.column_info)
 
-            # Kind of a hack to make sure that other iterators which
-            # use this file handle don't throw us off of our pointer
+        pos = start
+        while pos < end:
+            header = self.read_page_header(fh, pos)
+            body_start = pos + header_size
+            yield header, body_start
+            pos = body_start + header.page_size
+
+    def iter_pages(self, fh, start, end, row_ranges=None):
+        # Yields (header, first row in page, decompressed page) tuples.
+        # If row_ranges are provided, pages which do not contain any of
+        # the requested rows are skipped without reading the page body
+        page_row_start = 0
+        for header, body_start in self.iter_page_headers(fh, start, end):
+            page_row_end = page_row_start + header.num_values
+            row_start = page_row_start
+            page_row_start = page_row_end
+
+            if row_ranges is not None:
+                if not clip_ranges(row_ranges, row_start, page_row_end):
+                    continue
+
+            # Read from an explicit offset so that other iterators which
+            # use this file handle don't throw us off of our pointer. For
+            # memory-mapped files, this is a view into the file, not a copy
             # TODO: Would it be smarter to use one file handler per
             # column? That might be better if the data is coming from
             # a remote system over the network....
-            pos = fh.tell()
+            buffer = fh.read_at(body_start, header.page_size)
 
             decompressed = self.decompress_page(buffer)
-            yield decompressed
+            yield header, row_start, decompressed
+
+    def decode_vector(self, header, page):
+        """
+        Decode a page into a (values, validity) tuple of numpy arrays with
+        one element per row in the page. Null slots in `values` are zeroed
+        and `validity` is None if the page contains no nulls. Returns None
+        for columns which cannot be decoded into a typed array.
+        """
+        if self.numpy_dtype is None:
+            return None
+
+        bitfield_buffer, data_buffer = self.decode_bitfield(page)
+        present = self._decode_vector(data_buffer)
+        if present is None:
+            return None
+
+        # Always copies, so the result does not point into a mapped file
+        dtype = self.numpy_dtype.newbyteorder("=")
+        if header.null_count == 0:
+            return present.astype(dtype), None
+
+        validity = decode_validity(bitfield_buffer, header.num_values)
+        values = np.zeros(header.num_values, dtype=dtype)
+        values[validity] = present
+        return values, validity
+
+    def decode_page(self, header, page):
+        vector = self.decode_vector(header, page)
+        if vector is not None:
+            return vector_to_list(*vector)
+
+        bitfield_buffer, data_buffer = self.decode_bitfield(page)
+        decoded = self._decode(data_buffer)
+        return list(decode_null_bitmap(bitfield_buffer, decoded, header.num_values))
+
+    def iter_decode(self, fh, num_records, start, end, row_ranges=None):
+        self.validate()
+
+        pages = self.iter_pages(fh, start, end, row_ranges)
+        for header, row_start, page in pages:
+            values = self.decode_page(header, page)
+
+            if row_ranges is None:
+                yield from values
+                continue
 
-    def iter_decode(self, fh, num_records, start, end):
+            row_end = row_start + header.num_values
+            for clip_start, clip_end in clip_ranges(row_ranges, row_start, row_end):
+                yield from values[clip_start - row_start : clip_end - row_start]
+
+    def iter_decode_vectors(self, fh, start, end, row_ranges=None):
+        # Like iter_decode, but yields a (values, validity) tuple of numpy
+        # arrays for each page. Columns which can't be decoded into typed
+        # arrays are returned as object arrays which contain None for nulls
         self.validate()
 
-        for page in self.iter_pages(fh, start, end):
-            bitfield_buffer, data_buffer = self.decode_bitfield(page)
-            decoded = self._decode(data_buffer)
-            with_nulls = decode_null_bitmap(bitfield_buffer, decoded, num_records)
-            yield from with_nulls
+        pages = self.iter_pages(fh, start, end, row_ranges)
+        for header, row_start, page in pages:
+            vector = self.decode_vector(header, page)
+            if vector is None:
+                decoded = self.decode_page(header, page)
+                values = np.fromiter(decoded, dtype=object, count=len(decoded))
+                validity = None
+            else:
+                values, validity = vector
+
+            if row_ranges is None:
+                yield values, validity
+                continue
+
+            row_end = row_start + header.num_values
+            clipped = clip_ranges(row_ranges, row_start, row_end)
+            if clipped == [(row_start, row_end)]:
+                yield values, validity
+                continue
+
+            indexes = np.concatenate(
+                [
+                    np.arange(clip_start - row_start, clip_end - row_start)
+                    for clip_start, clip_end in clipped
+                ]
+            )
+
+            yield values[indexes], None if validity is None else validity[indexes]
+
+    def matching_row_ranges(self, fh, start, end, predicate):
+        # Use page headers to find the rows which could match predicate
+        ranges = []
+        row_start = 0
+        for header, _ in self.iter_page_headers(fh, start, end):
+            row_end = row_start + header.num_values
+            if predicate.may_match(header):
+                ranges.append((row_start, row_end))
+            row_start = row_end
+
+        return merge_ranges(ranges)
 
     def valid_type(self):
         return True
@@ -284,6 +505,9 @@ class RawEncoder(DataEncoder):
         unpacked = struct.iter_unpack(pack_f, page)
         return [el[0] for el in unpacked]
 
+    def _decode_vector(self, page):
+        return np.frombuffer(page, dtype=self.numpy_dtype)
+
 
 class RunLengthEncoder(DataEncoder):
     def valid_type(self):
@@ -345,6 +569,11 @@ class RunLengthEncoder(DataEncoder):
 
         return res
 
+    def _decode_vector(self, page):
+        run_dtype = np.dtype([("repeat", "u1"), ("value", self.numpy_dtype)])
+        runs = np.frombuffer(page, dtype=run_dtype)
+        return np.repeat(runs["value"], runs["repeat"])
+
 
 class DeltaEncoder(DataEncoder):
     def valid_type(self):
@@ -401,6 +630,11 @@ class DeltaEncoder(DataEncoder):
 
         return res
 
+    def _decode_vector(self, page):
+        deltas = np.frombuffer(page, dtype=self.numpy_dtype)
+        # Accumulate in 64 bits so that intermediate sums can't overflow
+        return np.cumsum(deltas, dtype=np.int64)
+
 
 class DictionaryEncoder(DataEncoder):
     def valid_type(self):
@@ -480,6 +714,10 @@ class DictionaryEncoder(DataEncoder):
         return buffer
 
     def _decode(self, page):
+        # Pages which only contain nulls have no dictionary
+        if len(page) == 0:
+            return []
+
         dictionary, page = self._unpack_header(page)
 
         unpacked = struct.iter_unpack(">B", page)
@@ -515,6 +753,16 @@ def decode(column_info, num_records, buffer):
     return encoder.decode(num_records, buffer)
 
 
-def iter_decode(fh, column_info, num_records, start, end):
+def iter_decode(fh, column_info, num_records, start, end, row_ranges=None):
+    encoder = get_encoder(column_info)
+    yield from encoder.iter_decode(fh, num_records, start, end, row_ranges)
+
+
+def iter_decode_vectors(fh, column_info, start, end, row_ranges=None):
+    encoder = get_encoder(column_info)
+    yield from encoder.iter_decode_vectors(fh, start, end, row_ranges)
+
+
+def matching_row_ranges(fh, column_info, start, end, predicate):
     encoder = get_encoder(column_info)
-    yield from encoder.iter_decode(fh, num_records, start, end)
+    return encoder.matching_row_ranges(fh, start, end, predicate)
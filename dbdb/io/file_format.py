@@ -10,8 +10,12 @@ from dbdb.logger import logger
 
 from dbdb.io import constants
 from dbdb.io import encoder
+from dbdb.io.predicates import intersect_ranges
+from dbdb.tuples.batch import RecordBatch, BATCH_SIZE
 from typing import Optional
 
+import numpy as np
+
 
 """
 Describe file format here...
@@ -23,8 +27,10 @@ def sort_together(sort_index, to_sort):
 
 
 def chomp(pack_s, buffer, unpack_single=True):
+    # Slicing a memoryview does not copy the rest of the buffer
+    buffer = memoryview(buffer)
     size = struct.calcsize(pack_s)
-    res = struct.unpack(pack_s, buffer[:size])
+    res = struct.unpack_from(pack_s, buffer)
     if len(res) == 1 and unpack_single:
         res = res[0]
     return res, buffer[size:]
@@ -135,14 +141,6 @@ class ColumnInfo(object):
 
         return column_info, buffer
 
-    def _serialize_stats(self):
-        if self.column_type.supports_column_stats():
-            p_min_max = struct.pack(">ii", min_val, max_val)
-        else:
-            p_min_max = struct.pack(">8x")
-
-        return p_min_max
-
     def is_sorted(self):
         return self.sorting == DataSorting.SORTED
 
@@ -235,21 +233,9 @@ class Column(object):
         return self.column_info.serialize()
 
     def serialize_block_header(self):
+        # Column stats (value counts, null counts, min/max) are stored
+        # in the header of each data page. See encoder.PageHeader
         return bytearray()
-        # packed_bytes = bytearray()
-
-        # Column start byte - not used, but helpful in hexdump
-        # p_column_ident = struct.pack(">1s", constants.COLUMN_IDENT)
-        # packed_bytes.extend(p_column_ident)
-
-        # TODO : Include column stats! Put this somewhere else
-        # so that we can call the same func in page data...
-        # Min and max of full dataset
-        # min_val = min(self.column_data.data)
-        # max_val = max(self.column_data.data)
-        # p_min_max = self._serialize_stats(min_val, max_val)
-        # packed_bytes.extend(p_min_max)
-        # return packed_bytes
 
     def serialize_data_pages(self):
         return self.column_data.serialize(self.column_info)
@@ -421,8 +407,16 @@ class Table(object):
         return column_info_list, num_rows
 
     @classmethod
-    def iter_pages(cls, fh, column, num_records, start, end):
-        yield from encoder.iter_decode(fh, column, num_records, start, end)
+    def iter_pages(cls, fh, column, num_records, start, end, row_ranges=None):
+        yield from encoder.iter_decode(fh, column, num_records, start, end, row_ranges)
+
+    @classmethod
+    def iter_vectors(cls, fh, column, start, end, row_ranges=None):
+        yield from encoder.iter_decode_vectors(fh, column, start, end, row_ranges)
+
+    @classmethod
+    def find_row_ranges(cls, fh, column, start, end, predicate):
+        return encoder.matching_row_ranges(fh, column, start, end, predicate)
 
 
 def read_header(reader):
@@ -432,37 +426,158 @@ def read_header(reader):
     return column_info_list
 
 
-def read_pages(reader, columns):
+class ColumnVectorReader:
+    """
+    Pages for different columns hold different numbers of values, so
+    this re-chunks the per-page vectors of one column into pieces with
+    an exact number of rows. That lets the pieces for every column in
+    a scan line up into a single RecordBatch.
+    """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.values = []
+        self.validity = []
+        self.num_buffered = 0
+
+    def take(self, count):
+        while self.num_buffered < count:
+            values, validity = next(self.vectors)
+            self.values.append(values)
+            self.validity.append(validity)
+            self.num_buffered += len(values)
+
+        if len(self.values) == 1:
+            values = self.values[0]
+        else:
+            values = np.concatenate(self.values)
+
+        if all(mask is None for mask in self.validity):
+            validity = None
+        else:
+            validity = np.concatenate(
+                [
+                    np.ones(len(piece), dtype=bool) if mask is None else mask
+                    for piece, mask in zip(self.values, self.validity)
+                ]
+            )
+
+        # Hold on to whatever is left over for the next batch
+        self.num_buffered -= count
+        if self.num_buffered > 0:
+            self.values = [values[count:]]
+            self.validity = [None if validity is None else validity[count:]]
+        else:
+            self.values = []
+            self.validity = []
+
+        if validity is not None:
+            validity = validity[:count]
+
+        return values[:count], validity
+
+
+def read_num_rows(reader):
     with reader.open() as fh:
         column_info_list, num_rows = Table.read_header(fh)
 
-        start = 0
-        selected = {}
-        for column_info in column_info_list:
-            end = start + column_info.column_data_size
-            if column_info.column_name in columns:
-                selected[column_info.column_name] = (start, end, column_info)
+    return num_rows
 
-            start = end
 
+def read_batches(
+    reader, columns, predicates=None, row_range=None, batch_size=BATCH_SIZE
+):
+    """
+    Yields RecordBatches containing the values in `columns`. If predicates
+    are provided, only rows which satisfy every predicate are returned.
+    If a (start, end) `row_range` is provided, only rows in that range
+    are read.
+    """
+    predicates = predicates or []
+
+    with reader.open() as fh:
+        column_info_list, num_rows = Table.read_header(fh)
         data_start = fh.tell()
 
-        # file pointer is now at the end of the column header...
-        # start simple, yield one page from each column at a time....
-        page_iterators = []
-        for col_name in columns:
-            (start, end, column) = selected[col_name]
-            iterator = Table.iter_pages(
-                fh,
-                column,
-                num_rows,
+        start = 0
+        spans = {}
+        for column_info in column_info_list:
+            end = start + column_info.column_data_size
+            spans[column_info.column_name] = (
                 data_start + start,
                 data_start + end,
+                column_info,
             )
 
-            page_iterators.append(iterator)
+            start = end
 
-        yield from zip(*page_iterators)
+        # Use page headers to narrow down the rows which can satisfy
+        # every predicate. Pages outside of these ranges are not read
+        row_ranges = None
+        if row_range is not None:
+            start, end = row_range
+            row_ranges = [(start, min(end, num_rows))]
+        elif predicates:
+            row_ranges = [(0, num_rows)]
+
+        for predicate in predicates:
+            (start, end, column) = spans[predicate.column_name]
+            matched = Table.find_row_ranges(fh, column, start, end, predicate)
+            row_ranges = intersect_ranges(row_ranges, matched)
+
+        if row_ranges is None:
+            rows_to_read = num_rows
+        else:
+            rows_to_read = sum(end - start for (start, end) in row_ranges)
+
+        # Predicates can reference columns that were not selected, so
+        # decode those too, but leave them out of the output batches
+        decoded_columns = list(columns)
+        for predicate in predicates:
+            if predicate.column_name not in decoded_columns:
+                decoded_columns.append(predicate.column_name)
+
+        column_readers = []
+        for col_name in decoded_columns:
+            (start, end, column) = spans[col_name]
+            vectors = Table.iter_vectors(fh, column, start, end, row_ranges)
+            column_readers.append(ColumnVectorReader(vectors))
+
+        checks = [
+            (decoded_columns.index(predicate.column_name), predicate)
+            for predicate in predicates
+        ]
+        output_columns = list(range(len(columns)))
+
+        rows_read = 0
+        while rows_read < rows_to_read:
+            count = min(batch_size, rows_to_read - rows_read)
+            rows_read += count
+
+            values = []
+            validity = []
+            for column_reader in column_readers:
+                column_values, column_validity = column_reader.take(count)
+                values.append(column_values)
+                validity.append(column_validity)
+
+            batch = RecordBatch(decoded_columns, values, validity, count)
+            if not checks:
+                yield batch
+                continue
+
+            mask = np.ones(count, dtype=bool)
+            for i, predicate in checks:
+                mask &= predicate.eval_vector(values[i], validity[i])
+
+            batch = batch.filter(mask).select(output_columns)
+            if len(batch) > 0:
+                yield batch
+
+
+def read_pages(reader, columns, predicates=None):
+    for batch in read_batches(reader, columns, predicates):
+        yield from batch.iter_records()
 
 
 def infer_type(value):
@@ -478,3 +593,16 @@ def infer_type(value):
         raise RuntimeError(
             f"Cannot infer column type for value: {value} ({type(value)})"
         )
+
+
+def infer_sorting(values):
+    "Columns without nulls whose values never decrease are marked as sorted"
+    if None in values:
+        return DataSorting.UNSORTED
+
+    try:
+        is_sorted = all(a <= b for a, b in zip(values, values[1:]))
+    except TypeError:
+        is_sorted = False
+
+    return DataSorting.SORTED if is_sorted else DataSorting.UNSORTED
@@ -2,8 +2,10 @@
 # Records stats
 
 from contextlib import contextmanager
+import mmap
 import os
 from pathlib import Path
+import uuid
 
 if os.path.exists("/dbdb-data"):
     DATA_DIR = "/dbdb-data"
@@ -40,6 +42,10 @@ class FileHandleProxy:
 
         return self.fh.read(count)
 
+    def read_at(self, pos, count):
+        self.seek(pos)
+        return self.read(count)
+
     def write(self, data):
         if data is None:
             raise RuntimeError("called write() with no data")
@@ -56,6 +62,9 @@ class FileHandleProxy:
     def seek(self, place):
         return self.fh.seek(place)
 
+    def close(self):
+        pass
+
     def stats(self):
         return {
             # Reads
@@ -66,14 +75,68 @@ class FileHandleProxy:
             "writes": self.writes,
             # Progress (reads)
             "bytes_total": self.size,
-            "bytes_read_pct": self.bytes_read / self.size,
+            "bytes_read_pct": self.bytes_read / self.size if self.size else 0,
         }
 
 
+class MappedFileHandleProxy(FileHandleProxy):
+    """
+    Read-only file handle backed by a memory map. Reads return memoryview
+    slices of the mapped file rather than copying bytes out of it, so
+    decoders can unpack values straight from the page cache.
+    """
+
+    def __init__(self, fh):
+        super().__init__(fh)
+
+        self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.pos = 0
+
+    def read_size(self):
+        self.size = len(self.mmap)
+
+    def read(self, count):
+        data = self.read_at(self.pos, count)
+        self.pos += len(data)
+        return data
+
+    def read_at(self, pos, count):
+        if count is None:
+            raise NotImplementedError()
+
+        # Keep track of scans
+        self.bytes_read += count
+        self.reads += 1
+
+        return self.view[pos : pos + count]
+
+    def write(self, data):
+        raise RuntimeError("Cannot write to a memory-mapped file")
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, place):
+        self.pos = place
+        return self.pos
+
+    def close(self):
+        self.view.release()
+
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Something is still holding a slice of the map. It will be
+            # unmapped once that slice is garbage collected
+            pass
+
+
 class FileReader:
-    def __init__(self, table):
+    def __init__(self, table, use_mmap=False):
         self.table_ref = str(table)
         self.table_path = self.make_path(table)
+        self.use_mmap = use_mmap
         self.handle = None
 
     @classmethod
@@ -94,22 +157,56 @@ class FileReader:
 
     @contextmanager
     def open(self, mode="rb"):
-        if mode == "wb" and not self.table_path.exists():
-            dir_path = self.table_path.parent
-            dir_path.mkdir(parents=True, exist_ok=True)
+        if mode == "wb":
+            with self.open_replacement() as handle:
+                yield handle
+            return
 
         try:
             with open(self.table_path, mode) as fh:
-                self.handle = FileHandleProxy(fh)
+                self.handle = self.make_handle(fh, mode)
                 if mode == "rb":
                     self.handle.read_size()
-                yield self.handle
+
+                try:
+                    yield self.handle
+                finally:
+                    self.handle.close()
         except FileNotFoundError:
             table_name = str(self.table_ref)
             raise RuntimeError(f"Table `{table_name}` does not exist")
 
+    @contextmanager
+    def open_replacement(self):
+        # Scans may have the table mapped into memory. Truncating the file
+        # under them would crash the process, so write the new table to a
+        # temp file and swap it in. Open maps keep reading the old file
+        dir_path = self.table_path.parent
+        dir_path.mkdir(parents=True, exist_ok=True)
+
+        temp_path = self.table_path.with_name(f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, "xb") as fh:
+                self.handle = self.make_handle(fh, "wb")
+                try:
+                    yield self.handle
+                finally:
+                    self.handle.close()
+
+            os.replace(temp_path, self.table_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def make_handle(self, fh, mode):
+        # Empty files cannot be memory-mapped
+        if self.use_mmap and mode == "rb" and os.fstat(fh.fileno()).st_size > 0:
+            return MappedFileHandleProxy(fh)
+        else:
+            return FileHandleProxy(fh)
+
     def read(self, count=None):
-        self.handle.read(count)
+        return self.handle.read(count)
 
     def write(self, data):
         self.handle.write(data)
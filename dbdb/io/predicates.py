@@ -0,0 +1,197 @@
+from dbdb.expressions.math import OP_MAP
+
+import bisect
+import numpy as np
+import operator
+
+
+"""
+Predicates which can be pushed down into a table scan. A pushed-down
+predicate compares a single column to a literal value, eg:
+
+    WHERE my_date > 20220101
+
+These predicates are used twice: first, the page headers for the
+column are checked to find the ranges of rows which could possibly
+match the predicate. Pages outside of those ranges are never read. Then,
+the predicate is applied to each decoded value in the surviving pages.
+
+Row ranges are represented as sorted lists of non-overlapping
+(start, end) tuples where `end` is exclusive.
+"""
+
+
+COMPARISON_OPERATORS = {"=", "!=", "<", ">", "<=", ">="}
+NULL_OPERATORS = {"IS", "IS_NOT"}
+
+VECTOR_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+FLIPPED_OPERATORS = {
+    "=": "=",
+    "!=": "!=",
+    "<": ">",
+    ">": "<",
+    "<=": ">=",
+    ">=": "<=",
+    "IS": "IS",
+    "IS_NOT": "IS_NOT",
+}
+
+
+class ColumnPredicate:
+    def __init__(self, column_name, operator, value):
+        self.column_name = column_name
+        self.operator = operator
+        self.value = value
+
+        self._op = OP_MAP[operator]
+
+    @classmethod
+    def can_push(cls, operator, value):
+        if operator in NULL_OPERATORS:
+            # Only `x IS NULL` and `x IS NOT NULL` can use page stats
+            return value is None
+
+        # Comparisons against null are never true, so there is nothing
+        # to gain from pushing them into the scan
+        return operator in COMPARISON_OPERATORS and value is not None
+
+    @classmethod
+    def flipped(cls, column_name, operator, value):
+        # Turn `<literal> <op> <column>` into `<column> <op'> <literal>`
+        return cls(column_name, FLIPPED_OPERATORS[operator], value)
+
+    def eval(self, value):
+        return bool(self._op(value, self.value))
+
+    def eval_vector(self, values, validity):
+        "Returns a boolean mask of the values which satisfy this predicate"
+        if values.dtype == object:
+            return np.fromiter(
+                (self.eval(value) for value in values), dtype=bool, count=len(values)
+            )
+
+        if validity is None:
+            validity = np.ones(len(values), dtype=bool)
+
+        if self.operator == "IS":
+            return ~validity
+        elif self.operator == "IS_NOT":
+            return validity
+
+        try:
+            matched = VECTOR_OPERATORS[self.operator](values, self.value)
+        except TypeError:
+            # Mismatched types, eg. comparing an int column to a string.
+            # Let the row-level comparison decide what to do
+            return np.fromiter(
+                (self.eval(value) for value in values.tolist()),
+                dtype=bool,
+                count=len(values),
+            )
+
+        # Comparisons with null are never true
+        return np.asarray(matched, dtype=bool) & validity
+
+    def may_match(self, header):
+        "Returns False if no value in the page can satisfy this predicate"
+
+        if self.operator == "IS":
+            return header.null_count > 0
+        elif self.operator == "IS_NOT":
+            return header.null_count < header.num_values
+
+        # Comparisons with null are never true
+        if header.null_count == header.num_values:
+            return False
+        elif not header.has_stats:
+            return True
+
+        min_val = header.min_val
+        max_val = header.max_val
+        value = self.value
+
+        try:
+            if self.operator == "=":
+                return min_val <= value <= max_val
+            elif self.operator == "!=":
+                return not (min_val == max_val == value)
+            elif self.operator == "<":
+                return min_val < value
+            elif self.operator == "<=":
+                return min_val <= value
+            elif self.operator == ">":
+                return max_val > value
+            elif self.operator == ">=":
+                return max_val >= value
+        except TypeError:
+            # Let the row-level comparison decide what to do with
+            # mismatched types
+            return True
+
+        return True
+
+    def __str__(self):
+        return f"{self.column_name} {self.operator} {self.value!r}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in ranges:
+        if start >= end:
+            continue
+        elif merged and merged[-1][1] >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def intersect_ranges(left, right):
+    intersected = []
+    i = 0
+    j = 0
+    while i < len(left) and j < len(right):
+        start = max(left[i][0], right[j][0])
+        end = min(left[i][1], right[j][1])
+        if start < end:
+            intersected.append((start, end))
+
+        if left[i][1] < right[j][1]:
+            i += 1
+        else:
+            j += 1
+
+    return intersected
+
+
+def clip_ranges(ranges, start, end):
+    "Returns the parts of `ranges` which fall between start and end"
+
+    # Start from the last range which begins at or before `start`
+    index = max(0, bisect.bisect_right(ranges, (start, float("inf"))) - 1)
+
+    clipped = []
+    while index < len(ranges):
+        range_start, range_end = ranges[index]
+        index += 1
+
+        if range_start >= end:
+            break
+        elif range_end <= start:
+            continue
+
+        clipped.append((max(range_start, start), min(range_end, end)))
+
+    return clipped
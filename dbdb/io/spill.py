@@ -0,0 +1,191 @@
+from dbdb.io.file_wrapper import DATA_DIR
+
+from pathlib import Path
+
+import os
+import pickle
+import sys
+import tempfile
+
+
+"""
+Temporary files for operators which hold on to more rows than fit in
+memory (joins, sorts, aggregates). Once a query outgrows its memory
+budget, the operator whose rows are growing writes them to spill files
+and reads them back later, one file at a time.
+
+Spill files live in DATA_DIR/spill and are deleted as soon as they are
+closed, or when the process exits. The budget is per query and is set
+in bytes with DBDB_MEMORY_BUDGET. Every operator in a query which holds
+on to rows draws from the same budget, so one operator can start spilling
+because another is holding most of it. Aggregate worker processes split
+the budget evenly between them.
+"""
+
+MEMORY_BUDGET = int(os.getenv("DBDB_MEMORY_BUDGET", 256 * 1024 * 1024))
+
+SPILL_DIR = Path(DATA_DIR) / "spill"
+
+# Number of records pickled together in a spill file
+CHUNK_SIZE = 4096
+
+
+# Number of records sampled to estimate the size of a list of records
+SAMPLE_SIZE = 8
+
+
+def value_size(value, seen=None):
+    "Bytes used by a value, including the values it contains"
+    # Sort and join keys are often the same objects as the record's values,
+    # so only count each object once
+    if seen is None:
+        seen = set()
+    elif id(value) in seen:
+        return 0
+
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(value_size(v, seen) for v in value)
+    elif hasattr(value, "__dict__"):
+        # eg. sort keys wrapped in ReverseSort
+        attrs = vars(value)
+        size += sys.getsizeof(attrs)
+        size += sum(value_size(v, seen) for v in attrs.values())
+
+    return size
+
+
+def estimate_size(records, count=None):
+    """
+    Rough number of bytes used by `count` records like these (by default,
+    all of them). Sizes are based on the largest of a few records spread
+    across the list
+    """
+    if count is None:
+        count = len(records)
+
+    if len(records) == 0:
+        return 0
+
+    step = max(len(records) // SAMPLE_SIZE, 1)
+    sample = records[::step][:SAMPLE_SIZE]
+    return max(value_size(record) for record in sample) * count
+
+
+class MemoryBudget:
+    """
+    Bytes of memory shared by the operators of a query. Each operator
+    which holds on to rows takes a reservation, and grows it as it reads
+    more rows. Once the query is over budget, the operator that is growing
+    spills its rows and gives its reservation back.
+    """
+
+    def __init__(self, limit=MEMORY_BUDGET):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self):
+        return MemoryReservation(self)
+
+
+class MemoryReservation:
+    "The part of a query's memory budget held by one operator"
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+
+    def resize(self, size):
+        "Returns False if this puts the query over budget"
+        self.budget.used += size - self.size
+        self.size = size
+        return self.budget.used <= self.budget.limit
+
+    def grow(self, size):
+        return self.resize(self.size + size)
+
+    def fits(self, size):
+        "Whether `size` more bytes would fit in what is left of the budget"
+        return self.budget.used + size <= self.budget.limit
+
+    def release(self):
+        self.resize(0)
+
+
+class SpillFile:
+    """
+    An append-only temporary file of records. Records are buffered and
+    pickled in chunks, then read back in the order they were written.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        SPILL_DIR.mkdir(parents=True, exist_ok=True)
+        self.fh = tempfile.TemporaryFile(dir=SPILL_DIR)
+        self.buffer = []
+        self.chunk_size = chunk_size
+
+        self.num_records = 0
+        self.size = 0
+
+    def write(self, record):
+        self.buffer.append(record)
+        self.num_records += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        self.size += estimate_size(self.buffer)
+        pickle.dump(self.buffer, self.fh, protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffer = []
+
+    def estimated_size(self):
+        "Approximate size of the records in memory once they are read back"
+        self.flush()
+        return self.size
+
+    def read_chunks(self):
+        self.flush()
+        self.fh.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.fh)
+            except EOFError:
+                break
+
+    def __iter__(self):
+        for chunk in self.read_chunks():
+            yield from chunk
+
+    def close(self):
+        self.fh.close()
+
+
+class SpillPartitions:
+    "Records split across a fixed number of spill files by the hash of a key"
+
+    def __init__(self, num_partitions, salt=0):
+        self.salt = salt
+
+        # Buffer about as many records in total as a single file would
+        chunk_size = max(CHUNK_SIZE // num_partitions, 1)
+        self.files = [SpillFile(chunk_size) for _ in range(num_partitions)]
+
+    def write(self, key, record):
+        # Salting the hash lets a partition be split again differently
+        index = hash((self.salt, key)) % len(self.files)
+        self.files[index].write((key, record))
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def close(self):
+        for spill_file in self.files:
+            spill_file.close()
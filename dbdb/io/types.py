@@ -50,6 +50,35 @@ class DataType(BinEnum):
 
         return pack_f
 
+    @classmethod
+    def numpy_dtype(cls, data_type):
+        # Big-endian numpy dtypes matching pack_string. Strings are
+        # decoded one value at a time, so they have no dtype here
+        if data_type == DataType.BOOL:
+            return "?"
+        elif data_type == DataType.INT8:
+            return "i1"
+        elif data_type == DataType.INT32:
+            return ">i4"
+        elif data_type == DataType.DATE:
+            return ">u4"
+        elif data_type == DataType.FLOAT64:
+            return ">f8"
+        else:
+            return None
+
+    def supports_column_stats(self):
+        # Fixed-width, orderable types can carry min/max stats in page
+        # headers. Strings are padded out to their column width, so
+        # storing two of them per page would cost more than it saves
+        return self in (
+            DataType.BOOL,
+            DataType.INT8,
+            DataType.INT32,
+            DataType.DATE,
+            DataType.FLOAT64,
+        )
+
     @classmethod
     def as_bytes(cls, data_type, value):
         if data_type == DataType.STR:
@@ -127,7 +127,7 @@ DESC = pp.CaselessKeyword("DESC")
 
 LEFT_OUTER = pp.CaselessKeyword("LEFT") + pp.Opt(pp.CaselessKeyword("OUTER"))
 RIGHT_OUTER = pp.CaselessKeyword("RIGHT") + pp.Opt(pp.CaselessKeyword("OUTER"))
-FULL_OUTER = pp.CaselessKeyword("FULL") + pp.CaselessKeyword("OUTER")
+FULL_OUTER = pp.CaselessKeyword("FULL") + pp.Opt(pp.CaselessKeyword("OUTER"))
 INNER = pp.CaselessKeyword("INNER")
 CROSS = pp.CaselessKeyword("CROSS")
 NATURAL = pp.CaselessKeyword("NATURAL")
@@ -189,6 +189,7 @@ RESERVED = pp.Group(
     | LIMIT
     | LEFT_OUTER
     | RIGHT_OUTER
+    | FULL_OUTER
     | INNER
     | CROSS
     | NATURAL
@@ -431,6 +432,10 @@ def case_when(string, loc, toks):
     when_conds = toks[0].when_conds
     else_expr = toks[0].else_cond
 
+    # A CASE without an ELSE evaluates to null if no condition matches
+    if else_expr == "":
+        else_expr = Null()
+
     when_exprs = [(w.when_expr, w.then_expr) for w in when_conds]
     return CaseWhen(when_exprs, else_expr)
 
@@ -516,11 +521,9 @@ def make_join(string, loc, toks):
         return JoinType.INNER
     elif toks[0] == "LEFT":
         return JoinType.LEFT_OUTER
-    elif toks[0] == "LEFT" and toks[1] == "OUTER":
-        return JoinType.LEFT_OUTER
-    elif toks[0] == "RIGHT" and toks[1] == "OUTER":
+    elif toks[0] == "RIGHT":
         return JoinType.RIGHT_OUTER
-    elif toks[0] == "FULL" and toks[1] == "OUTER":
+    elif toks[0] == "FULL":
         return JoinType.FULL_OUTER
     elif toks[0] == "NATURAL":
         return JoinType.NATURAL
@@ -681,6 +684,7 @@ def make_table_source(table_source):
     return SelectFileSource(
         table=table_id,
         columns=columns,
+        column_info=column_data,
     )
 
 
@@ -836,7 +840,6 @@ def make_select_from_ast(ast_select, scopes):
     wheres = extract_wheres(ast_select)
     joins = extract_joins(ast_select, scopes)
     group_by = extract_group_by(ast_select, projections)
-    limit = extract_limit(ast_select)
     is_distinct = ast_select.distinct != ""
 
     source = None
@@ -849,7 +852,6 @@ def make_select_from_ast(ast_select, scopes):
         source=source,
         joins=joins,
         group_by=group_by,
-        limit=limit,
         is_distinct=is_distinct,
         scopes=scopes,
     )
@@ -869,6 +871,7 @@ def make_select_from_scope(ast, scopes):
     unions = [make_select_from_ast(u, scopes) for u in unions]
     select.unions = unions
     select.order_by = extract_order_by(ast)
+    select.limit = extract_limit(ast)
 
     return select
 
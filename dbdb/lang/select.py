@@ -1,19 +1,33 @@
 from dbdb.operators.file_operator import TableScanOperator, TableGenOperator
-from dbdb.operators.sorting import SortOperator
+from dbdb.operators.sorting import SortOperator, TopNOperator
 from dbdb.operators.limit import LimitOperator
 from dbdb.operators.filter import FilterOperator
 from dbdb.operators.project import ProjectOperator
 from dbdb.operators.union import UnionOperator
-from dbdb.operators.joins import JoinStrategy
+from dbdb.operators.joins import (
+    JoinStrategy,
+    JoinType,
+    HASH_JOIN_TYPES,
+    MERGE_JOIN_TYPES,
+)
 
 from dbdb.operators.rename import RenameScopeOperator
-from dbdb.operators.aggregate import AggregateOperator
+from dbdb.operators.aggregate import AggregateOperator, SortedAggregateOperator
 from dbdb.operators.distinct import DistinctOperator
 from dbdb.operators.create import CreateTableAsOperator
 from dbdb.operators.table_function import TableFunctionOperator
 from dbdb.tuples.context import ExecutionContext
-from dbdb.expressions.expressions import Star
+from dbdb.expressions.expressions import (
+    Star,
+    Literal,
+    ColumnIdentifier,
+    BinaryOperator,
+    split_conjuncts,
+    join_conjuncts,
+)
+from dbdb.expressions.join import JoinCondition, JoinConditionOn, JoinConditionUsing
 from dbdb.expressions.sort import ReverseSort
+from dbdb.io.predicates import ColumnPredicate
 
 from dbdb.expressions.expressions import AggregateFunctionCall, WindowFunctionCall
 
@@ -51,6 +65,51 @@ class Select:
         self._plan = None
         self._output_op = None
 
+    def input_is_sorted_by(self, source_op, exprs):
+        "True if rows reach the WHERE clause already sorted by exprs"
+        if len(self.joins) > 0 or len(exprs) == 0:
+            return False
+
+        if isinstance(source_op, TableScanOperator):
+            return source_op.is_sorted_by(exprs)
+
+        # eg. a CTE with an ORDER BY
+        elif isinstance(source_op, RenameScopeOperator):
+            parent_op = self.scopes.get(self.source.name())
+            return isinstance(parent_op, SortOperator) and parent_op.is_sorted_by(exprs)
+
+        return False
+
+    def input_is_in_window_order(self, source_op, window):
+        "True if rows reach the WHERE clause in the order a window function needs"
+        if len(self.joins) > 0:
+            return False
+
+        exprs = [
+            ColumnIdentifier(table=None, column=col) for col in window.partition_cols
+        ]
+        order = []
+        if window.order_cols:
+            order = [
+                (sort_field.ascending, sort_field.expression)
+                for sort_field in window.order_cols.order_by_list
+            ]
+
+        # Without a PARTITION BY or ORDER BY, any order will do
+        if len(exprs) == 0 and len(order) == 0:
+            return True
+
+        if isinstance(source_op, TableScanOperator):
+            return source_op.is_ordered_by(exprs, order)
+
+        elif isinstance(source_op, RenameScopeOperator):
+            parent_op = self.scopes.get(self.source.name())
+            return isinstance(parent_op, SortOperator) and parent_op.is_ordered_by(
+                exprs, order
+            )
+
+        return False
+
     def make_plan(self, plan=None):
         plan = plan or nx.DiGraph()
 
@@ -75,27 +134,39 @@ class Select:
 
         # JOIN
         output_op = source_op
+        join_to_ops = []
         for join in self.joins:
-            join_op = join.as_operator()
-            plan.add_node(join_op, label="JOIN")
-            plan.add_edge(output_op, join_op, input_arg="left_rows")
-
             join_to_op = resolve_internal_reference(join.to, label="FROM (join)")
-            plan.add_edge(join_to_op, join_op, input_arg="right_rows")
+            join_op = join.add_to_plan(plan, output_op, join_to_op)
+            join_to_ops.append(join_to_op)
 
             # Future operations are on the output of this operation
             output_op = join_op
 
         # WHERE
+        predicate = None
         if self.where:
-            filter_op = self.where.as_operator()
-            plan.add_node(filter_op, label="Filter")
-            plan.add_edge(output_op, filter_op, input_arg="rows")
-            output_op = filter_op
+            scans = self.find_pushdown_scans(source_op, join_to_ops)
+            predicate = self.where.push_down(scans, is_joined=len(self.joins) > 0)
+
+            # If every predicate was pushed into a scan, then there is
+            # no need for a filter operator at all
+            if predicate is not None:
+                filter_op = FilterOperator(predicate=predicate)
+                plan.add_node(filter_op, label="Filter")
+                plan.add_edge(output_op, filter_op, input_arg="rows")
+                output_op = filter_op
 
         # GROUP BY
         if self.group_by:
-            aggregate_op = self.group_by.as_operator()
+            if self.input_is_sorted_by(source_op, self.group_by.group_exprs()):
+                aggregate_op = self.group_by.as_sorted_operator()
+            else:
+                aggregate_op = self.group_by.as_operator()
+                if isinstance(source_op, TableScanOperator) and not self.joins:
+                    # The scan and filter can be re-run over parts of the table
+                    aggregate_op.set_parallel_source(source_op, predicate)
+
             plan.add_node(aggregate_op, label="Aggregate")
             plan.add_edge(output_op, aggregate_op, input_arg="rows")
             output_op = aggregate_op
@@ -105,6 +176,10 @@ class Select:
         else:
             # Scalar projections
             project_op = self.projections.as_operator()
+            window = project_op.streaming_window()
+            if window and self.input_is_in_window_order(source_op, window):
+                project_op.set_streaming()
+
             plan.add_node(project_op, label="Project")
             plan.add_edge(output_op, project_op, input_arg="rows")
             output_op = project_op
@@ -119,7 +194,15 @@ class Select:
 
             output_op = union_op
 
-        if self.order_by:
+        # ORDER BY + LIMIT only needs to hold on to the first N rows. Doing
+        # DISTINCT before the sort returns the same rows in the same order
+        use_top_n = (
+            self.order_by
+            and self.limit
+            and self.limit.limit.val <= TopNOperator.MAX_ROWS
+        )
+
+        if self.order_by and not use_top_n:
             order_by_op = self.order_by.as_operator()
             plan.add_node(order_by_op, label="Order")
             plan.add_edge(output_op, order_by_op, input_arg="rows")
@@ -131,14 +214,76 @@ class Select:
             plan.add_edge(output_op, distinct_op, input_arg="rows")
             output_op = distinct_op
 
-        if self.limit:
+        if use_top_n:
+            top_n_op = self.order_by.as_top_n_operator(self.limit.limit.val)
+            plan.add_node(top_n_op, label="Order")
+            plan.add_edge(output_op, top_n_op, input_arg="rows")
+            output_op = top_n_op
+
+        elif self.limit:
             limit_op = self.limit.as_operator()
             plan.add_node(limit_op, label="Limit")
             plan.add_edge(output_op, limit_op, input_arg="rows")
             output_op = limit_op
 
+        # Only read the columns which are referenced somewhere in this query
+        referenced = self.find_referenced_columns(predicate)
+        if referenced is not None:
+            for scan_op in [source_op] + join_to_ops:
+                if isinstance(scan_op, TableScanOperator):
+                    scan_op.prune_columns(referenced)
+
         return plan, output_op
 
+    def find_referenced_columns(self, predicate):
+        """
+        Returns the names of every column referenced by this query, or None
+        if every column is needed (eg. for a `select *`). Predicates which
+        were pushed into a scan are evaluated by the scan itself, so only
+        the residual `predicate` is considered here.
+        """
+        exprs = []
+        for projection in self.projections.projections:
+            if projection.is_star():
+                return None
+            exprs.append(projection.expr)
+
+        if predicate is not None:
+            exprs.append(predicate)
+
+        names = set()
+        for join in self.joins:
+            if isinstance(join.expression, JoinConditionUsing):
+                names.update(join.expression.fields)
+            elif isinstance(join.expression, JoinConditionOn):
+                exprs.append(join.expression.join_expr)
+
+        if self.group_by:
+            exprs.extend(self.group_by.group_by_list)
+
+        if self.order_by:
+            exprs.extend(o.expression for o in self.order_by.order_by_list)
+
+        for expr in exprs:
+            names.update(find_column_references(expr))
+
+        return names
+
+    def find_pushdown_scans(self, source_op, join_to_ops):
+        # Filtering the input to an outer join changes which rows are
+        # null-extended, so only push predicates into scans when the
+        # filter could be applied either before or after the join
+        preserved = (JoinType.INNER, JoinType.LEFT_OUTER, JoinType.CROSS)
+        if any(join.join_type not in preserved for join in self.joins):
+            return []
+
+        scans = [source_op]
+        for join, join_to_op in zip(self.joins, join_to_ops):
+            if join.join_type in (JoinType.INNER, JoinType.CROSS):
+                scans.append(join_to_op)
+
+        return [scan for scan in scans if isinstance(scan, TableScanOperator)]
+
     def save_plan(self, plan):
         plan, output_op = self.make_plan(plan)
         self._plan = plan
@@ -155,6 +300,21 @@ class Select:
         """
 
 
+def find_column_references(expr):
+    names = set()
+    for node in expr.walk(lambda e: e):
+        if isinstance(node, ColumnIdentifier):
+            names.add(node.qualify())
+        elif isinstance(node, WindowFunctionCall):
+            processor = node.processor
+            names.update(processor.partition_cols)
+            if processor.order_cols:
+                for order_by in processor.order_cols.order_by_list:
+                    names.update(find_column_references(order_by.expression))
+
+    return names
+
+
 class CreateTableAs:
     def __init__(
         self,
@@ -239,6 +399,71 @@ class SelectFilter(SelectClause):
     def as_operator(self):
         return FilterOperator(predicate=self.expr)
 
+    def find_scan_column(self, scans, column, is_joined):
+        # Unqualified column names could refer to any joined relation
+        # (including ones whose fields we don't know until runtime)
+        if is_joined and column.table is None:
+            return None
+
+        name = column.qualify()
+        matches = [
+            (scan, field)
+            for scan in scans
+            for field in scan.config.columns
+            if field.is_match(name)
+        ]
+
+        if len(matches) != 1:
+            return None
+
+        return matches[0]
+
+    def make_column_predicate(self, expr, scans, is_joined):
+        # Returns (scan, predicate) if expr compares a scanned column to a literal
+        if not isinstance(expr, BinaryOperator):
+            return None
+
+        lhs, rhs = expr.lhs, expr.rhs
+        if isinstance(lhs, ColumnIdentifier) and isinstance(rhs, Literal):
+            column, literal, flip = lhs, rhs, False
+        elif isinstance(lhs, Literal) and isinstance(rhs, ColumnIdentifier):
+            column, literal, flip = rhs, lhs, True
+        else:
+            return None
+
+        if not ColumnPredicate.can_push(expr.operator, literal.value()):
+            return None
+
+        match = self.find_scan_column(scans, column, is_joined)
+        if match is None:
+            return None
+
+        scan, field = match
+        operator = expr.operator
+        if flip:
+            predicate = ColumnPredicate.flipped(field.name, operator, literal.value())
+        else:
+            predicate = ColumnPredicate(field.name, operator, literal.value())
+
+        return scan, predicate
+
+    def push_down(self, scans, is_joined):
+        """
+        Push conjuncts which compare a single scanned column to a literal
+        into the scan for that column. Returns the residual predicate
+        which still needs to be evaluated by a filter (or None)
+        """
+        residual = []
+        for conjunct in split_conjuncts(self.expr):
+            pushed = self.make_column_predicate(conjunct, scans, is_joined)
+            if pushed is None:
+                residual.append(conjunct)
+            else:
+                scan, predicate = pushed
+                scan.push_predicates([predicate])
+
+        return join_conjuncts(residual)
+
 
 class SelectReferenceSource(SelectClause):
     def __init__(self, table_identifier):
@@ -271,15 +496,20 @@ class SelectFunctionSource(SelectClause):
 
 
 class SelectFileSource(SelectClause):
-    def __init__(self, table, columns):
+    def __init__(self, table, columns, column_info=None):
         self.table = table
         self.columns = columns
+        self.column_info = column_info
 
     def name(self):
         return self.table.name
 
     def as_operator(self):
-        return TableScanOperator(table_ref=self.table, columns=self.columns)
+        return TableScanOperator(
+            table_ref=self.table,
+            columns=self.columns,
+            column_info=self.column_info,
+        )
 
 
 class SelectMemorySource(SelectClause):
@@ -301,15 +531,58 @@ class SelectJoin(SelectClause):
         self.join_type = join_type
         self.join_strategy = join_strategy
 
-    def as_operator(self):
-        return self.join_strategy.create(
+    def as_operator(self, join_strategy=None):
+        join_strategy = join_strategy or self.join_strategy
+        return join_strategy.create(
             join_type=self.join_type, expression=self.expression
         )
 
+    def find_merge_keys(self, left_op, right_op):
+        # The fields of a table scan are known before the query runs, so
+        # joins between two scans can be checked for sorted join keys
+        is_scan = isinstance(left_op, TableScanOperator) and isinstance(
+            right_op, TableScanOperator
+        )
+        is_condition = isinstance(self.expression, JoinCondition)
+        if not is_scan or not is_condition or self.join_type not in MERGE_JOIN_TYPES:
+            return None
+
+        return self.expression.find_equi_keys(
+            left_op.config.columns, right_op.config.columns
+        )
+
+    def add_to_plan(self, plan, left_op, right_op):
+        join_strategy = self.join_strategy
+
+        # A merge join over tables which are already sorted by the join
+        # keys doesn't need to hold either side in memory
+        merge_keys = self.find_merge_keys(left_op, right_op)
+        if merge_keys is not None:
+            left_sorted = left_op.is_sorted_by(merge_keys.left_exprs)
+            right_sorted = right_op.is_sorted_by(merge_keys.right_exprs)
+            if left_sorted and right_sorted:
+                join_strategy = JoinStrategy.MergeJoin
+
+        join_op = self.as_operator(join_strategy)
+        plan.add_node(join_op, label="JOIN")
+        plan.add_edge(left_op, join_op, input_arg="left_rows")
+        plan.add_edge(right_op, join_op, input_arg="right_rows")
+
+        return join_op
+
     @classmethod
     def new(cls, to, expression, join_type):
-        # TODO: Pick this dynamically?
-        join_strategy = JoinStrategy.NestedLoop
+        # Equality conditions can be answered with a hash table instead of
+        # comparing every pair of rows. The hash join works out which side
+        # each key belongs to once it knows the input fields, and falls back
+        # to a nested loop if that doesn't pan out
+        is_condition = isinstance(expression, JoinCondition)
+        has_keys = is_condition and expression.has_equi_keys()
+        if has_keys and join_type in HASH_JOIN_TYPES:
+            join_strategy = JoinStrategy.HashJoin
+        else:
+            join_strategy = JoinStrategy.NestedLoop
+
         return cls(to, expression, join_type, join_strategy)
 
 
@@ -318,12 +591,25 @@ class SelectGroupBy(SelectClause):
         self.group_by_list = group_by_list
         self.projections = projections
 
+    def group_exprs(self):
+        return [
+            projection.expr
+            for projection in self.projections.projections
+            if len(projection.get_non_aggregated_fields()) > 0
+        ]
+
     def as_operator(self):
         return AggregateOperator(
             group_by_list=self.group_by_list,
             projections=self.projections,
         )
 
+    def as_sorted_operator(self):
+        return SortedAggregateOperator(
+            group_by_list=self.group_by_list,
+            projections=self.projections,
+        )
+
 
 class SelectOrder(SelectClause):
     def __init__(self, order_by_list):
@@ -333,6 +619,10 @@ class SelectOrder(SelectClause):
         order = [o.as_tuple() for o in self.order_by_list]
         return SortOperator(order=order)
 
+    def as_top_n_operator(self, limit):
+        order = [o.as_tuple() for o in self.order_by_list]
+        return TopNOperator(order=order, limit=limit)
+
     def as_comparator(self, row):
         vals = []
         for sort_field in self.order_by_list:
@@ -1,8 +1,207 @@
 from dbdb.operators.base import Operator, OperatorConfig
+from dbdb.operators.file_operator import TableScanOperator
+from dbdb.operators.filter import FilterOperator
+from dbdb.expressions.compiler import compile_expression
+from dbdb.expressions.expressions import AggregateFunctionCall
+from dbdb.io import file_format, spill
 from dbdb.tuples.rows import Rows
 from dbdb.tuples.identifiers import TableIdentifier
 from dbdb.tuples.context import ExecutionContext
 
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+
+"""
+Aggregates which read straight from a table (optionally through a
+filter) can be computed in parallel. The table is split into ranges of
+rows, and a worker process runs the scan, filter and aggregate over each
+range. Workers return the accumulator states for the groups they saw,
+then this process merges them together with each accumulator's merge()
+and finalizes the results.
+
+Ranges are merged in table order, so groups come out in the same order
+as a serial aggregate. Float sums can differ from the serial result in
+the last bit since they are added up in a different order.
+
+Set DBDB_AGGREGATE_WORKERS to the number of worker processes (defaults
+to the number of CPUs; 1 disables this) and DBDB_AGGREGATE_CHUNK_ROWS
+to the number of rows each worker aggregates at a time. Tables with
+fewer rows than that are always aggregated serially. Workers are started
+with "spawn", so scripts which run queries need the usual
+`if __name__ == "__main__":` guard.
+"""
+
+NUM_WORKERS = int(os.getenv("DBDB_AGGREGATE_WORKERS", os.cpu_count() or 1))
+
+CHUNK_ROWS = int(os.getenv("DBDB_AGGREGATE_CHUNK_ROWS", 64 * 1024))
+
+WORKER_POOL = None
+
+
+def get_worker_pool():
+    global WORKER_POOL
+    if WORKER_POOL is None:
+        # Forking a process with a running event loop (or a web server's
+        # threads) isn't safe, so start workers from scratch
+        context = multiprocessing.get_context("spawn")
+        WORKER_POOL = ProcessPoolExecutor(max_workers=NUM_WORKERS, mp_context=context)
+
+    return WORKER_POOL
+
+
+def split_rows(num_rows, chunk_rows):
+    return [
+        (start, min(start + chunk_rows, num_rows))
+        for start in range(0, num_rows, chunk_rows)
+    ]
+
+
+async def aggregate_fragment(
+    scan_config, predicate, aggregate_config, row_range, memory_limit
+):
+    scan_op = TableScanOperator(**vars(scan_config))
+    scan_op.config.row_range = row_range
+    rows = await scan_op.run()
+
+    if predicate is not None:
+        rows = await FilterOperator(predicate=predicate).run(rows)
+
+    aggregate_op = AggregateOperator(**vars(aggregate_config))
+    aggregate_op.set_memory_budget(spill.MemoryBudget(memory_limit))
+    aggregate_op.bind(rows.fields)
+    table = await aggregate_op.aggregate(rows)
+    try:
+        groups = list(table)
+    finally:
+        table.close()
+
+    return groups, scan_op.reader.stats()
+
+
+def aggregate_row_range(
+    scan_config, predicate, aggregate_config, row_range, memory_limit
+):
+    "Runs in a worker process. Returns partial states for one range of rows"
+    return asyncio.run(
+        aggregate_fragment(
+            scan_config, predicate, aggregate_config, row_range, memory_limit
+        )
+    )
+
+
+class GroupTable:
+    """
+    Accumulator states by group key. Rows are added as the values to
+    aggregate for each group, and partial states (eg. from a worker) are
+    merged in with each accumulator's merge().
+
+    If the states outgrow the memory budget, they are written out to hash
+    partitioned spill files, followed by everything that is added after
+    that. Iterating over the table then aggregates one partition at a
+    time, splitting partitions again if they are still too big.
+    """
+
+    NUM_PARTITIONS = 16
+    MAX_PARTITION_DEPTH = 3
+
+    def __init__(self, accumulators, memory_budget, depth=0):
+        self.accumulators = accumulators
+        self.memory_budget = memory_budget
+        self.memory = memory_budget.reserve()
+        self.depth = depth
+
+        self.groups = dict()
+        self.partitions = None
+
+    def get_states(self, key):
+        states = self.groups.get(key)
+        if states is None:
+            states = self.groups[key] = [acc.init() for acc in self.accumulators]
+
+        return states
+
+    def add_rows(self, keyed_values):
+        if self.partitions is not None:
+            for key, row_values in keyed_values:
+                self.partitions.write(key, (False, row_values))
+            return
+
+        accumulators = self.accumulators
+        for key, row_values in keyed_values:
+            states = self.get_states(key)
+            for i, value in enumerate(row_values):
+                states[i] = accumulators[i].update(states[i], value)
+
+        self.check_size()
+
+    def add_states(self, keyed_states):
+        if self.partitions is not None:
+            for key, partial_states in keyed_states:
+                self.partitions.write(key, (True, partial_states))
+            return
+
+        accumulators = self.accumulators
+        for key, partial_states in keyed_states:
+            states = self.get_states(key)
+            for i, partial_state in enumerate(partial_states):
+                states[i] = accumulators[i].merge(states[i], partial_state)
+
+        self.check_size()
+
+    def add_spilled(self, chunk):
+        # Keep rows and states in the order they were written, so that
+        # order-sensitive aggregates like LIST_AGG see them in order
+        for key, (is_state, values) in chunk:
+            if is_state:
+                self.add_states([(key, values)])
+            else:
+                self.add_rows([(key, values)])
+
+    def estimated_size(self):
+        groups = itertools.islice(self.groups.items(), spill.SAMPLE_SIZE)
+        sample = [key + tuple(states) for key, states in groups]
+        return spill.estimate_size(sample, count=len(self.groups))
+
+    def check_size(self):
+        fits = self.memory.resize(self.estimated_size())
+        if fits or self.depth >= self.MAX_PARTITION_DEPTH:
+            return
+
+        # Salting by depth splits a spilled partition differently
+        self.partitions = spill.SpillPartitions(self.NUM_PARTITIONS, salt=self.depth)
+        for key, states in self.groups.items():
+            self.partitions.write(key, (True, states))
+
+        self.groups = dict()
+        self.memory.release()
+
+    def __iter__(self):
+        if self.partitions is None:
+            yield from self.groups.items()
+            return
+
+        for spill_file in self.partitions:
+            table = GroupTable(
+                self.accumulators, self.memory_budget, depth=self.depth + 1
+            )
+            try:
+                for chunk in spill_file.read_chunks():
+                    table.add_spilled(chunk)
+                spill_file.close()
+
+                yield from table
+            finally:
+                table.close()
+
+    def close(self):
+        self.memory.release()
+        if self.partitions is not None:
+            self.partitions.close()
+
 
 class AggregateConfig(OperatorConfig):
     def __init__(
@@ -14,13 +213,32 @@ class AggregateConfig(OperatorConfig):
         self.projections = projections
 
 
+class ParallelSource:
+    """
+    The scan (and filter predicate) that feed an aggregate. The planner
+    sets this when they can be re-run in worker processes over ranges of
+    the table instead of being read here.
+    """
+
+    def __init__(self, scan_op, predicate=None):
+        self.scan_op = scan_op
+        self.predicate = predicate
+
+
 class AggregateOperator(Operator):
     Config = AggregateConfig
 
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.parallel_source = None
+
     def name(self):
         return "Aggregate"
 
-    async def make_iterator(self, rows):
+    def set_parallel_source(self, scan_op, predicate=None):
+        self.parallel_source = ParallelSource(scan_op, predicate)
+
+    def split_projections(self):
         projections = self.config.projections.projections
 
         group_projections = []
@@ -40,47 +258,134 @@ class AggregateOperator(Operator):
                 agg_projections.append(projection)
                 column_agg_list.append(False)
 
-        group_exprs = dict()
-        proj_results = dict()
-        async for row in rows:
-            context = ExecutionContext(row=row)
-            self.stats.update_row_processed(row)
-
-            grouping = tuple([proj.eval(context) for proj in group_projections])
-
-            # It's a new grouping set
-            if grouping not in group_exprs:
-                for projection in agg_projections:
-                    group_exprs[grouping] = [proj.copy() for proj in agg_projections]
-
-            # Process incremental step for aggregate functions
-            # This is kind of dumb because we are processing and _saving the results_
-            # of the expression, even if it's an incomplete aggregation! I think that's
-            # a singal that this isn't The Right Way To Do This. But, it does work because
-            # the partial agg results are overwritten for each row, and the final output
-            # for the last row is indeed the correct response to pass onto the next operator.
-            #
-            # My guess is that i should partition the execution graph up-front and then calculate
-            # all of the aggs independently before computing scalar transformations over the results.
-            for proj in group_exprs[grouping]:
-                proj_results[proj] = proj.eval(context)
-
-        for key, agg_projections in group_exprs.items():
-            grouped = list(key)
-            aggregated = [proj_results[p] for p in agg_projections]
-
-            # Reconsitute an output row in the order described
-            # by the input list of projections. Both groups and
-            # aggs retain order, so we just need to splice them
-            # together in the same order that they were pulled apart
-            mapped = []
-            for is_group in column_agg_list:
-                if is_group:
-                    mapped.append(grouped.pop(0))
-                else:
-                    mapped.append(aggregated.pop(0))
+        return group_projections, agg_projections, column_agg_list
+
+    def find_aggregate_calls(self, agg_projections):
+        calls = []
+        for projection in agg_projections:
+            for expr in projection.expr.walk(lambda e: e):
+                if isinstance(expr, AggregateFunctionCall):
+                    calls.append(expr)
+
+        return calls
+
+    def iter_group_values(self, fields, records):
+        "Yields the group key and the values to aggregate for each record"
+        num_records = len(records)
+        if len(self.group_keys) > 0:
+            keys = zip(*[key.eval_records(fields, records) for key in self.group_keys])
+        else:
+            keys = [()] * num_records
+
+        if len(self.values) > 0:
+            values = zip(
+                *[value.eval_records(fields, records) for value in self.values]
+            )
+        else:
+            # eg. `select color from table group by 1`
+            values = [()] * num_records
+
+        return zip(keys, values)
+
+    def make_output_row(self, key, states):
+        aggregates = {
+            id(call): acc.finalize(state)
+            for call, acc, state in zip(self.calls, self.accumulators, states)
+        }
+        context = ExecutionContext(row=None, aggregates=aggregates)
+
+        grouped = list(key)
+        aggregated = [proj.expr.eval(context) for proj in self.agg_projections]
+
+        # Reconsitute an output row in the order described
+        # by the input list of projections. Both groups and
+        # aggs retain order, so we just need to splice them
+        # together in the same order that they were pulled apart
+        mapped = []
+        for is_group in self.column_agg_list:
+            if is_group:
+                mapped.append(grouped.pop(0))
+            else:
+                mapped.append(aggregated.pop(0))
+
+        return mapped
+
+    async def aggregate(self, rows):
+        "Returns a GroupTable of the accumulator states for every row"
+        table = GroupTable(self.accumulators, self.memory_budget)
+        async for batch in rows.iter_batches():
+            self.stats.update_batch_processed(batch)
+            records = list(batch.iter_records())
+            table.add_rows(self.iter_group_values(rows.fields, records))
+
+        return table
+
+    def find_row_ranges(self):
+        "Ranges of rows to aggregate in worker processes, or None"
+        if self.parallel_source is None or NUM_WORKERS <= 1:
+            return None
+
+        scan_op = self.parallel_source.scan_op
+        num_rows = file_format.read_num_rows(scan_op.reader)
+        if num_rows <= CHUNK_ROWS:
+            return None
+
+        return split_rows(num_rows, CHUNK_ROWS)
+
+    async def aggregate_in_workers(self, row_ranges):
+        scan_op = self.parallel_source.scan_op
+        pool = get_worker_pool()
+        loop = asyncio.get_running_loop()
+
+        # Workers run at the same time, so each gets a share of the budget
+        memory_limit = self.memory_budget.limit // NUM_WORKERS
+
+        futures = [
+            loop.run_in_executor(
+                pool,
+                aggregate_row_range,
+                scan_op.config,
+                self.parallel_source.predicate,
+                self.config,
+                row_range,
+                memory_limit,
+            )
+            for row_range in row_ranges
+        ]
+
+        results = await asyncio.gather(*futures)
+
+        table = GroupTable(self.accumulators, self.memory_budget)
+        read_stats = {}
+        for partial_groups, reader_stats in results:
+            table.add_states(partial_groups)
+            for name in ("bytes_read", "reads"):
+                read_stats[name] = read_stats.get(name, 0) + reader_stats[name]
+
+        # The scan in this process never reads anything, so report
+        # what the workers read instead
+        scan_op.stats.update_custom_stats(read_stats)
+        scan_op.stats.update_done_running()
+
+        return table
 
-            yield mapped
+    async def make_iterator(self, rows):
+        row_ranges = self.find_row_ranges()
+        if row_ranges is None:
+            table = await self.aggregate(rows)
+        else:
+            # Nothing needs to be read here. Closing the input closes the
+            # filter and scan that feed it before they start
+            await rows.close()
+            table = await self.aggregate_in_workers(row_ranges)
+
+        try:
+            for key, states in table:
+                mapped = self.make_output_row(key, states)
+                yield mapped
+                self.stats.update_row_emitted(mapped)
+        finally:
+            table.close()
 
         self.stats.update_done_running()
 
@@ -97,8 +402,7 @@ class AggregateOperator(Operator):
             fields.append(table.field(field_name))
         return fields
 
-    async def run(self, rows):
-        self.stats.update_start_running()
+    def bind(self, fields):
         from dbdb.lang.lang import Literal
 
         # Check group by fields against aggregate fields
@@ -145,6 +449,31 @@ class AggregateOperator(Operator):
             if len(scalar) > 0:
                 scalar_fields.append(i)
 
+        for projection in projections:
+            projection.expr.bind(fields)
+
+        (
+            group_projections,
+            self.agg_projections,
+            self.column_agg_list,
+        ) = self.split_projections()
+
+        self.group_keys = [
+            compile_expression(proj.expr, fields) for proj in group_projections
+        ]
+
+        # Each aggregate function call gets an accumulator and the
+        # expression whose values it aggregates
+        self.calls = self.find_aggregate_calls(self.agg_projections)
+        self.accumulators = [call.processor for call in self.calls]
+        self.values = [
+            compile_expression(acc.value_expr(), fields) for acc in self.accumulators
+        ]
+
+    async def run(self, rows):
+        self.stats.update_start_running()
+        self.bind(rows.fields)
+
         table_identifier = TableIdentifier.temporary()
         fields = self.field_names(table_identifier)
 
@@ -158,3 +487,43 @@ class AggregateOperator(Operator):
         iterator = self.add_exit_check(iterator)
 
         return Rows(table_identifier, fields, iterator)
+
+
+class SortedAggregateOperator(AggregateOperator):
+    """
+    Aggregates input which is already sorted by the group keys, so every
+    group's rows arrive together. Each group is emitted as soon as the
+    key changes, and only the current group's states are kept in memory.
+    """
+
+    def name(self):
+        return "Sorted Aggregate"
+
+    async def make_iterator(self, rows):
+        accumulators = self.accumulators
+        current_key = None
+        states = None
+
+        async for batch in rows.iter_batches():
+            self.stats.update_batch_processed(batch)
+            records = list(batch.iter_records())
+
+            for key, row_values in self.iter_group_values(rows.fields, records):
+                if states is None or key != current_key:
+                    if states is not None:
+                        mapped = self.make_output_row(current_key, states)
+                        yield mapped
+                        self.stats.update_row_emitted(mapped)
+
+                    current_key = key
+                    states = [acc.init() for acc in accumulators]
+
+                for i, value in enumerate(row_values):
+                    states[i] = accumulators[i].update(states[i], value)
+
+        if states is not None:
+            mapped = self.make_output_row(current_key, states)
+            yield mapped
+            self.stats.update_row_emitted(mapped)
+
+        self.stats.update_done_running()
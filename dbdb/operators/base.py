@@ -1,4 +1,5 @@
 from dbdb.operators.operator_stats import OperatorStats
+from dbdb.io.spill import MemoryBudget
 from dbdb.logger import logger
 
 import tabulate
@@ -28,10 +29,6 @@ class SafeIterator:
     def should_exit(self):
         self.exit_next_tick = True
 
-    def check_raise(self):
-        if self.exit_next_tick:
-            raise StopIteration()
-
     def __iter__(self):
         return self.iterator
 
@@ -39,13 +36,20 @@ class SafeIterator:
         return self.iterator
 
     def __next__(self):
-        self.check_raise()
+        if self.exit_next_tick:
+            raise StopIteration()
         return self.iterator.__next__()
 
     async def __anext__(self):
-        self.check_raise()
+        if self.exit_next_tick:
+            await self.aclose()
+            raise StopAsyncIteration()
         return await self.iterator.__anext__()
 
+    async def aclose(self):
+        if hasattr(self.iterator, "aclose"):
+            await self.iterator.aclose()
+
 
 class Operator:
     Config = OperatorConfig
@@ -60,6 +64,12 @@ class Operator:
         self.exit_next_tick = False
         self.safe_iterator = None
 
+        # Replaced by the engine with a budget shared by the whole query
+        self.memory_budget = MemoryBudget()
+
+    def set_memory_budget(self, memory_budget):
+        self.memory_budget = memory_budget
+
     def exit(self):
         self.safe_iterator.should_exit()
 
@@ -77,6 +87,10 @@ class Operator:
     def is_mutation(self):
         return False
 
+    def waits_on_io(self):
+        "True if other operators can run while this one waits for its rows"
+        return False
+
     def details(self):
         return {}
 
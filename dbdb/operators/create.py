@@ -1,6 +1,7 @@
 from dbdb.io import file_format
 from dbdb.io.file_format import ColumnInfo, ColumnData, Column, Table
 from dbdb.io.file_wrapper import FileReader
+from dbdb.io.types import DataSorting
 
 from dbdb.operators.base import Operator, OperatorConfig, pipeline
 from dbdb.tuples.rows import Rows
@@ -33,25 +34,32 @@ class CreateTableAsOperator(Operator):
     def status_line(self):
         return f"CREATE {self.rows_written}"
 
-    def make_columns_from_data(self, records):
-        row = records[0]
+    def make_columns_from_batches(self, fields, batches):
         columns = []
-        for i, field in enumerate(row.fields):
-            field_name = field.name
+        has_sort_key = False
+        for i, field in enumerate(fields):
+            values = []
+            for batch in batches:
+                values.extend(batch.column_values(i))
 
-            field_value = row.data[i]
-            field_type = file_format.infer_type(field_value)
+            field_type = file_format.infer_type(values[0])
+
+            # Tables can have one sort key. If a column is already in
+            # order, record that so that joins can merge on it later
+            sorting = None
+            if not has_sort_key:
+                sorting = file_format.infer_sorting(values)
+                has_sort_key = sorting == DataSorting.SORTED
 
             column_info = file_format.ColumnInfo(
                 column_type=field_type,
-                column_name=field_name,
+                column_name=field.name,
+                sorting=sorting,
             )
 
-            column_data = ColumnData([row.data[i] for row in records])
-
             column = Column(
                 column_info=column_info,
-                column_data=column_data,
+                column_data=ColumnData(values),
             )
 
             columns.append(column)
@@ -59,18 +67,20 @@ class CreateTableAsOperator(Operator):
         return columns
 
     async def make_iterator(self, tuples):
-        records = []
-        async for record in tuples:
-            self.stats.update_row_processed(record)
-            records.append(record)
+        batches = []
+        async for batch in tuples.iter_batches():
+            self.stats.update_batch_processed(batch)
+            batches.append(batch)
+
+        num_rows = sum(len(batch) for batch in batches)
 
         # This is dumb, but if there are no rows, then we
         # cannot infer column types. Need to go back and add
         # typing to operators to propagate types through the graph
-        if len(records) == 0:
+        if num_rows == 0:
             raise RuntimeError("Cannot create empty table")
 
-        columns = self.make_columns_from_data(records)
+        columns = self.make_columns_from_batches(tuples.fields, batches)
         table = Table(columns=columns)
         table_data = table.serialize()
 
@@ -89,7 +99,7 @@ class CreateTableAsOperator(Operator):
 
         logger.info(f"Done writing table {self.config.table}")
 
-        self.rows_written = len(records)
+        self.rows_written = num_rows
 
         self.stats.update_row_emitted([])
         yield []
@@ -0,0 +1,118 @@
+from dbdb.operators.base import Operator, OperatorConfig
+from dbdb.tuples.rows import Rows, wait_blocked
+
+import asyncio
+import os
+
+
+"""
+Operators are iterators, so a plan normally runs in a single task: rows
+are only produced when the operator above asks for them. An operator with
+several inputs (eg. a join) reads them one after another, and while one
+input waits on I/O, nothing else can run.
+
+An exchange reads its input in a task of its own, and hands rows over to
+the operator above through a bounded queue. When an operator has more
+than one input (eg. a join or a union), the engine puts an exchange in
+front of each input which waits on I/O, so that those inputs are produced
+at the same time. Once the queue is full, the task waits for the operator
+above to catch up.
+"""
+
+# Number of items (rows, or batches if batched) buffered in an exchange
+QUEUE_SIZE = int(os.getenv("DBDB_EXCHANGE_QUEUE_SIZE", 8))
+
+# Put on the queue once the input runs out
+END_OF_ROWS = object()
+
+
+class ProducerError:
+    "Put on the queue if reading the input raised an error"
+
+    def __init__(self, error):
+        self.error = error
+
+
+class ExchangeIterator:
+    "Reads items from the queue. Closing it stops the producer task"
+
+    def __init__(self, queue, task):
+        self.queue = queue
+        self.task = task
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await wait_blocked(self.queue.get())
+        if item is END_OF_ROWS:
+            raise StopAsyncIteration()
+        elif isinstance(item, ProducerError):
+            raise item.error
+
+        return item
+
+    async def aclose(self):
+        # The task closes its input itself, so wait for it to finish
+        self.task.cancel()
+        await asyncio.wait([self.task])
+
+
+class ExchangeConfig(OperatorConfig):
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+
+
+class ExchangeOperator(Operator):
+    Config = ExchangeConfig
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.task = None
+
+    def name(self):
+        return "Exchange"
+
+    async def iter_items(self, rows):
+        if rows.batched:
+            async for batch in rows.iter_batches():
+                self.stats.update_batch_processed(batch)
+                yield batch
+                self.stats.update_batch_emitted(batch)
+        else:
+            async for row in rows:
+                self.stats.update_row_processed(row)
+                yield row.data
+                self.stats.update_row_emitted(row)
+
+    async def produce(self, rows, queue):
+        try:
+            async for item in self.iter_items(rows):
+                await wait_blocked(queue.put(item))
+
+            await wait_blocked(queue.put(END_OF_ROWS))
+            self.stats.update_done_running()
+
+        except asyncio.CancelledError:
+            await rows.close()
+            raise
+
+        except Exception as e:
+            await wait_blocked(queue.put(ProducerError(e)))
+
+    def close(self):
+        # Called by the engine once the query is over, in case the rows
+        # were never read to the end
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self, rows):
+        self.stats.update_start_running()
+
+        # Start reading right away, rather than when the rows are first read
+        queue = asyncio.Queue(maxsize=self.config.queue_size)
+        self.task = asyncio.create_task(self.produce(rows, queue))
+
+        iterator = ExchangeIterator(queue, self.task)
+        iterator = self.add_exit_check(iterator)
+        return Rows(rows.table, rows.fields, iterator, batched=rows.batched)
@@ -2,7 +2,8 @@ from dbdb.io import file_format
 from dbdb.io.file_wrapper import FileReader
 
 from dbdb.operators.base import Operator, OperatorConfig, pipeline
-from dbdb.tuples.rows import Rows
+from dbdb.expressions.expressions import ColumnIdentifier
+from dbdb.tuples.rows import Rows, find_field_index
 
 import itertools
 
@@ -14,11 +15,19 @@ class TableScanConfig(OperatorConfig):
         columns,
         limit=None,
         order=None,
+        predicates=None,
+        column_info=None,
+        row_range=None,
     ):
         self.table_ref = table_ref
         self.limit = limit
         self.order = order
         self.columns = columns
+        self.predicates = predicates or []
+        self.column_info = column_info or []
+
+        # Only scan these (start, end) rows. Used to split up a table
+        self.row_range = row_range
 
 
 class TableScanOperator(Operator):
@@ -32,26 +41,90 @@ class TableScanOperator(Operator):
             "table": self.config.table_ref,
             "qualified_table_name": str(self.config.table_ref),
             "columns": self.config.columns,
+            "predicates": [str(p) for p in self.config.predicates],
         }
 
-    async def make_iterator(self, tuples):
-        for record in tuples:
-            self.stats.update_row_processed(record)
+    def push_predicates(self, predicates):
+        self.config.predicates.extend(predicates)
+
+    def prune_columns(self, referenced):
+        "Only scan the columns which match one of the `referenced` names"
+        columns = [
+            field
+            for field in self.config.columns
+            if any(field.is_match(name) for name in referenced)
+        ]
+
+        # Queries like `select count(*) from table` don't reference any
+        # columns, but still need to know how many rows there are. Read
+        # the column that takes up the least space on disk.
+        if len(columns) == 0 and len(self.config.column_info) > 0:
+            smallest = min(self.config.column_info, key=lambda c: c.column_data_size)
+            columns = [
+                field
+                for field in self.config.columns
+                if field.name == smallest.column_name
+            ]
+        elif len(columns) == 0:
+            columns = self.config.columns[:1]
+
+        self.config.columns = columns
+
+    def is_sorted_by(self, exprs):
+        "True if the table's header says its rows are sorted by every expr"
+        sorted_columns = {
+            info.column_name for info in self.config.column_info if info.is_sorted()
+        }
 
-            yield record
-            self.stats.update_custom_stats(self.reader.stats())
-            self.stats.update_row_emitted(record)
+        for expr in exprs:
+            if not isinstance(expr, ColumnIdentifier):
+                return False
 
-        self.stats.update_done_running()
+            try:
+                index = find_field_index(self.config.columns, expr.qualify())
+            except RuntimeError:
+                return False
+
+            if self.config.columns[index].name not in sorted_columns:
+                return False
+
+        return True
+
+    def is_ordered_by(self, exprs, order):
+        "Like SortOperator.is_ordered_by(). Sorted columns are only ever ascending"
+        if not all(ascending for ascending, _ in order):
+            return False
+
+        return self.is_sorted_by(exprs + [expr for _, expr in order])
+
+    async def make_iterator(self, batches):
+        try:
+            for batch in batches:
+                batch = batch.with_fields(self.config.columns)
+                self.stats.update_batch_processed(batch)
+
+                yield batch
+                self.stats.update_custom_stats(self.reader.stats())
+                self.stats.update_batch_emitted(batch)
+
+        finally:
+            # Stop reading the file if the scan is closed early
+            batches.close()
+
+            # Make sure stats are reported even if every page was skipped
+            self.stats.update_custom_stats(self.reader.stats())
+            self.stats.update_done_running()
 
     async def run(self):
         self.stats.update_start_running()
 
-        self.reader = FileReader(self.config.table_ref)
+        self.reader = FileReader(self.config.table_ref, use_mmap=True)
 
+        column_names = [field.name for field in self.config.columns]
         column_data = file_format.read_header(self.reader)
-        scanned_columns = [c.to_dict() for c in column_data]
-        column_names = [c.column_name for c in column_data]
+        scanned_columns = [
+            c.to_dict() for c in column_data if c.column_name in column_names
+        ]
 
         self.stats.update_custom_stats(
             {
@@ -60,15 +133,21 @@ class TableScanOperator(Operator):
             }
         )
 
-        tuples = file_format.read_pages(reader=self.reader, columns=column_names)
+        batches = file_format.read_batches(
+            reader=self.reader,
+            columns=column_names,
+            predicates=self.config.predicates,
+            row_range=self.config.row_range,
+        )
 
-        iterator = self.make_iterator(tuples)
+        iterator = self.make_iterator(batches)
         self.iterator = iterator
 
         return Rows(
             self.config.table_ref,
             self.config.columns,
             iterator,
+            batched=True,
         )
 
 
@@ -1,33 +1,28 @@
 from dbdb.operators.base import Operator, OperatorConfig
-from dbdb.tuples.context import ExecutionContext
+from dbdb.expressions.compiler import compile_expression
+from dbdb.expressions.vector_math import can_vectorize, truthy, VECTOR_ERRORS
 
+import numpy as np
 
-"""
-To do this for real, we'd need/want to be able to push
-these predicates down into the file decoder. That would
-let us skip pages based on metadata... we can't really
-do that up at this level of abstraction. Best approach
-is probably to make some reusable logic that can either
-1) be pushed down into the encoder/decoder level OR
-2) be applied to a stream of decoded data for predicates
-   which cannot be applied at the decoder
 
-Also: it's important that we're able to preserve information
-about these predicates. An example predicate might look like:
+"""
+Predicates which compare a single column of a table scan to a literal
+are pushed down into the scan by the planner (see Select.make_plan and
+dbdb/io/predicates.py). The scan uses page header stats to skip pages
+which cannot match, then applies the predicate to the decoded values.
+This operator handles whatever is left over. An example predicate
+might look like:
 
-    WHERE my_date > '2022-01-01' AND color = 'red'
+    WHERE my_date > 20220101 AND color = 'red'
 
-If we have a sort key on my_date, then we can push this down
-to the data pages for filtering. We'd want to push down _that_
-predicate, but not the color predicate. If the logic is instead
+Both of these conjuncts get pushed down to the scan. If the logic is
+instead
 
-    WHERE my_date > '2022-01-01' OR color = 'red'
+    WHERE my_date > 20220101 OR color = 'red'
 
 Then we're kind of out of luck... need to read all of the pages
 out of the my_date column and process them up here. I just don't
 see any way around doing that....
-
-It's fine for now, but let's circle back here...
 """
 
 
@@ -45,19 +40,37 @@ class FilterOperator(Operator):
     def name(self):
         return "Filter"
 
+    def evaluate(self, fields, batch):
+        # Returns a mask of the rows in the batch which match the predicate
+        if self.vectorize:
+            try:
+                column = self.config.predicate.eval_batch(batch.with_fields(fields))
+                return truthy(column)
+            except VECTOR_ERRORS:
+                # Evaluate one row at a time, which raises any real errors
+                pass
+
+        matches = self.predicate.eval_records(fields, batch.iter_records())
+        return np.fromiter(map(bool, matches), dtype=bool, count=len(batch))
+
     async def make_iterator(self, tuples):
-        predicate = self.config.predicate
-        async for row in tuples:
-            context = ExecutionContext(row=row)
-            self.stats.update_row_processed(row)
-            if predicate.eval(context):
-                yield row
-                self.stats.update_row_emitted(row)
+        async for batch in tuples.iter_batches():
+            self.stats.update_batch_processed(batch)
+
+            mask = self.evaluate(tuples.fields, batch)
+            filtered = batch.filter(mask)
+            if len(filtered) > 0:
+                yield filtered
+                self.stats.update_batch_emitted(filtered)
 
         self.stats.update_done_running()
 
     async def run(self, rows):
         self.stats.update_start_running()
+        self.config.predicate.bind(rows.fields)
+        self.predicate = compile_expression(self.config.predicate, rows.fields)
+        self.vectorize = can_vectorize(self.config.predicate)
+
         iterator = self.make_iterator(rows)
         iterator = self.add_exit_check(iterator)
-        return rows.new(iterator)
+        return rows.new(iterator, batched=True)
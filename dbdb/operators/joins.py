@@ -1,9 +1,10 @@
 from dbdb.operators.base import Operator, OperatorConfig
-from dbdb.tuples.rows import Rows
+from dbdb.io import spill
+from dbdb.expressions.compiler import compile_expression
+from dbdb.expressions.join import JoinCondition
+from dbdb.tuples.rows import Rows, RowTuple
 from dbdb.tuples.context import ExecutionContext
 
-# from dbdb.expressions import EqualityTypes
-
 from enum import Enum
 
 import enum
@@ -27,16 +28,29 @@ JoinTypeNames = {
     JoinType.CROSS: "Cross Join",
 }
 
+# Join types which the hash and merge joins know how to run
+HASH_JOIN_TYPES = (
+    JoinType.INNER,
+    JoinType.LEFT_OUTER,
+    JoinType.RIGHT_OUTER,
+    JoinType.FULL_OUTER,
+)
+
+MERGE_JOIN_TYPES = HASH_JOIN_TYPES
+
 
 class JoinStrategy(Enum):
     NestedLoop = 1
     HashJoin = 2
+    MergeJoin = 3
 
     def create(self, *args, **kwargs):
         if self == JoinStrategy.NestedLoop:
             JoinClass = NestedLoopJoinOperator
         elif self == JoinStrategy.HashJoin:
             JoinClass = HashJoinOperator
+        elif self == JoinStrategy.MergeJoin:
+            JoinClass = MergeJoinOperator
         else:
             raise NotImplementedError()
 
@@ -90,46 +104,59 @@ class NestedLoopJoinOperator(JoinOperator):
                 yield merged
                 self.stats.update_row_emitted(merged)
 
-    async def regular_join(self, left_row, right_row, is_outer):
+    async def regular_join(self, left_row, right_row, keep_left, keep_right):
         await left_row.materialize()
         await right_row.materialize()
 
         lvals = left_row.data
         rvals = right_row.data
 
-        for i, lval in enumerate(lvals):
+        # Every merged row shares the same fields, so column references
+        # in the join condition can be resolved once up-front
+        fields = tuple(list(left_row.fields) + list(right_row.fields))
+        expression = self.config.expression
+        if isinstance(expression, JoinCondition):
+            expression.bind(fields)
+
+        # Right rows which matched anything, for right and full outer joins
+        right_matched = bytearray(len(rvals))
+
+        for lval in lvals:
             self.stats.update_row_processed(lval)
             matched = False
-            for rval in rvals:
+            for i, rval in enumerate(rvals):
                 self.stats.update_row_processed(rval)
-                merged = lval.merge(rval)
+                merged = RowTuple(fields, tuple(lval.data) + tuple(rval.data))
                 context = ExecutionContext(row=merged)
-                if self.config.expression.eval(context):
+                if expression.eval(context):
                     matched = True
+                    right_matched[i] = True
                     yield merged
                     self.stats.update_row_emitted(merged)
 
             # If there was not match & it's an outer join,
             # emit a row w/ right side null
-            if not matched and is_outer:
-                merged = lval.as_tuple() + right_row.nulls()
-                # self.stats.update_row_emitted(merged)
+            if not matched and keep_left:
+                merged = RowTuple(fields, lval.as_tuple() + right_row.nulls())
                 yield merged
+                self.stats.update_row_emitted(merged)
+
+        if keep_right:
+            for rval, matched in zip(rvals, right_matched):
+                if not matched:
+                    merged = RowTuple(fields, left_row.nulls() + rval.as_tuple())
+                    yield merged
+                    self.stats.update_row_emitted(merged)
 
     async def _join(self, left_rows, right_rows):
         iterator = None
         if self.config.join_type == JoinType.CROSS:
             iterator = self.cross_join(left_rows, right_rows)
-        elif self.config.join_type == JoinType.FULL_OUTER:
-            raise NotImplementedError()
-        elif self.config.join_type == JoinType.RIGHT_OUTER:
-            raise NotImplementedError()
         else:
-            is_outer = self.config.join_type in [
-                JoinType.LEFT_OUTER,
-                JoinType.RIGHT_OUTER,
-            ]
-            iterator = self.regular_join(left_rows, right_rows, is_outer)
+            join_type = self.config.join_type
+            keep_left = join_type in (JoinType.LEFT_OUTER, JoinType.FULL_OUTER)
+            keep_right = join_type in (JoinType.RIGHT_OUTER, JoinType.FULL_OUTER)
+            iterator = self.regular_join(left_rows, right_rows, keep_left, keep_right)
 
         async for row in iterator:
             yield row
@@ -137,59 +164,402 @@ class NestedLoopJoinOperator(JoinOperator):
         self.stats.update_done_running()
 
 
-class HashJoinOperator(JoinOperator):
+class HashTable:
+    """
+    The right side of a hash join, grouped by join key. Keeps a bitmap of
+    which rows were matched for each key, so that right and full outer
+    joins can emit the rest once the left side has been read.
+    """
+
+    def __init__(self, nulls_match, keep_unmatched):
+        self.rows = {}
+        self.nulls_match = nulls_match
+
+        self.matched = {} if keep_unmatched else None
+        # Rows with keys that can never match, eg. `null = null`
+        self.unmatchable = []
+
+    def add(self, keyed_records):
+        for key, record in keyed_records:
+            if not self.nulls_match and None in key:
+                if self.matched is not None:
+                    self.unmatchable.append((key, record))
+                continue
+
+            if key not in self.rows:
+                self.rows[key] = []
+
+            self.rows[key].append(record)
+
+    def lookup(self, key):
+        return self.rows.get(key, [])
+
+    def mark_matched(self, key, index):
+        if self.matched is None:
+            return
+
+        bitmap = self.matched.get(key)
+        if bitmap is None:
+            bitmap = self.matched[key] = bytearray(len(self.rows[key]))
+
+        bitmap[index] = True
+
+    def iter_unmatched(self):
+        for _, record in self.unmatchable:
+            yield record
+
+        for key, records in self.rows.items():
+            bitmap = self.matched.get(key)
+            if bitmap is None:
+                yield from records
+                continue
+
+            for record, matched in zip(records, bitmap):
+                if not matched:
+                    yield record
+
+
+class HashJoinOperator(NestedLoopJoinOperator):
+    """
+    Joins rows on the equality conditions (`a.x = b.y`, `USING (x)`) in
+    the join expression. Rows from the right side are hashed on their join
+    keys up-front, then rows from the left side are streamed through and
+    matched by looking up their own keys. Any other conditions are checked
+    on the joined rows. Joins without usable keys fall back to a nested
+    loop.
+
+    If the right side outgrows the memory budget, this becomes a Grace
+    hash join: both sides are split into spill files by the hash of their
+    keys, and then each pair of files is joined on its own. Partitions
+    which are still too large are split again.
+    """
+
+    NUM_PARTITIONS = 16
+    MAX_PARTITION_DEPTH = 3
+
     def name(self):
         return "Hash Join"
 
-    def _hash_to_list(self, rows, expr):
-        hashed = {}
-        for row in rows:
-            val = expr.evaluate(row)
-            if val not in hashed:
-                hashed[val] = []
-
-            hashed[val].append(row)
-        return hashed
-
-    async def _join(self, left_values, right_values):
-        equality = self.config.expression
-
-        if equality.equality != EqualityTypes.EQ:
-            raise RuntimeError(
-                "HashJoin is only implemented for equi-joins. This is"
-                f" a join with operator: {equality.equality}"
-            )
-
-        lvals = await left_values.materialize()
-        lhash = await self._hash_to_list(lvals, equality.lexpr)
-
-        rvals = right_values.materialize()
-        rhash = self._hash_to_list(rvals, equality.rexpr)
-
-        # TODO : I think i can/should change this to only hash one side up-front...
-        for key, lrows in lhash.items():
-            rrows = rhash.get(key, [])
-            for lval in lrows:
-                self.stats.update_row_processed(lval)
-                included = False
-                for rval in rrows:
-                    self.stats.update_row_processed(rval)
-                    included = True
-                    merged = lval.merge(rval)
+    def eval_keys(self, keys, fields, records):
+        values = [key.eval_records(fields, records) for key in keys]
+        return list(zip(*values))
+
+    async def iter_keyed(self, rows, keys):
+        "Yields lists of (key, record) for each batch of rows"
+        async for batch in rows.iter_batches():
+            records = [tuple(record) for record in batch.iter_records()]
+            for record in records:
+                self.stats.update_row_processed(record)
+
+            yield list(zip(self.eval_keys(keys, rows.fields, records), records))
+
+    def new_table(self):
+        return HashTable(self.nulls_match, keep_unmatched=self.keep_right)
+
+    async def build(self, right_rows, right_keys):
+        """
+        Returns the hashed right side, or the spill files that it was
+        partitioned into if it didn't fit in memory
+        """
+        table = self.new_table()
+
+        batches = self.iter_keyed(right_rows, right_keys)
+        async for keyed_records in batches:
+            table.add(keyed_records)
+
+            if not self.memory.grow(spill.estimate_size(keyed_records)):
+                break
+        else:
+            return table, None
+
+        partitions = spill.SpillPartitions(self.NUM_PARTITIONS)
+        for key, records in table.rows.items():
+            for record in records:
+                partitions.write(key, record)
+
+        for key, record in table.unmatchable:
+            partitions.write(key, record)
+
+        del table
+        self.memory.release()
+
+        async for keyed_records in batches:
+            for key, record in keyed_records:
+                partitions.write(key, record)
+
+        return None, partitions
+
+    def probe(self, table, keyed_records):
+        for key, lrecord in keyed_records:
+            matched = False
+
+            for i, rrecord in enumerate(table.lookup(key)):
+                merged = RowTuple(self.fields, lrecord + rrecord)
+                if self.residual is not None and not self.residual.eval_row(merged):
+                    continue
+
+                matched = True
+                table.mark_matched(key, i)
+                yield merged
+                self.stats.update_row_emitted(merged)
+
+            if not matched and self.keep_left:
+                merged = RowTuple(self.fields, lrecord + self.right_nulls)
+                yield merged
+                self.stats.update_row_emitted(merged)
+
+    def emit_unmatched(self, table):
+        if not self.keep_right:
+            return
+
+        for rrecord in table.iter_unmatched():
+            merged = RowTuple(self.fields, self.left_nulls + rrecord)
+            yield merged
+            self.stats.update_row_emitted(merged)
+
+    def partition(self, spill_file, salt):
+        partitions = spill.SpillPartitions(self.NUM_PARTITIONS, salt=salt)
+        for key, record in spill_file:
+            partitions.write(key, record)
+
+        return partitions
+
+    def join_partitions(self, left_partitions, right_partitions, depth):
+        for left_file, right_file in zip(left_partitions, right_partitions):
+            size = right_file.estimated_size()
+            if not self.memory.fits(size) and depth < self.MAX_PARTITION_DEPTH:
+                left_split = self.partition(left_file, salt=depth)
+                right_split = self.partition(right_file, salt=depth)
+                left_file.close()
+                right_file.close()
+
+                yield from self.join_partitions(left_split, right_split, depth + 1)
+                continue
+
+            table = self.new_table()
+            self.memory.resize(size)
+            for chunk in right_file.read_chunks():
+                table.add(chunk)
+            right_file.close()
+
+            for chunk in left_file.read_chunks():
+                yield from self.probe(table, chunk)
+            left_file.close()
+
+            yield from self.emit_unmatched(table)
+            self.memory.release()
+
+    async def hash_join(self, left_rows, right_rows, join_keys):
+        join_type = self.config.join_type
+        self.keep_left = join_type in (JoinType.LEFT_OUTER, JoinType.FULL_OUTER)
+        self.keep_right = join_type in (JoinType.RIGHT_OUTER, JoinType.FULL_OUTER)
+        self.nulls_match = join_keys.nulls_match
+
+        self.fields = tuple(list(left_rows.fields) + list(right_rows.fields))
+        self.left_nulls = left_rows.nulls()
+        self.right_nulls = right_rows.nulls()
+
+        self.residual = join_keys.residual
+        if self.residual is not None:
+            self.residual.bind(self.fields)
+            self.residual = compile_expression(self.residual, self.fields)
+
+        left_keys = [
+            compile_expression(expr, left_rows.fields) for expr in join_keys.left_exprs
+        ]
+        right_keys = [
+            compile_expression(expr, right_rows.fields)
+            for expr in join_keys.right_exprs
+        ]
+
+        table, right_partitions = await self.build(right_rows, right_keys)
+
+        if right_partitions is None:
+            async for keyed_records in self.iter_keyed(left_rows, left_keys):
+                for merged in self.probe(table, keyed_records):
                     yield merged
-                    self.stats.update_row_emitted(merged)
 
-                # TODO : Does this work?
-                if not self.config.inner and not included:
-                    yield lval.as_tuple() + right_values.nulls()
-                    self.stats.update_row_emitted(merged)
+            for merged in self.emit_unmatched(table):
+                yield merged
+
+            return
+
+        left_partitions = spill.SpillPartitions(self.NUM_PARTITIONS)
+        try:
+            async for keyed_records in self.iter_keyed(left_rows, left_keys):
+                for key, record in keyed_records:
+                    left_partitions.write(key, record)
+
+            # Salt 0 was used for the first split, so start from depth 1
+            for merged in self.join_partitions(
+                left_partitions, right_partitions, depth=1
+            ):
+                yield merged
+
+        finally:
+            left_partitions.close()
+            right_partitions.close()
+
+    async def _join(self, left_rows, right_rows):
+        expression = self.config.expression
+        join_keys = None
+        if isinstance(expression, JoinCondition):
+            join_keys = expression.find_equi_keys(left_rows.fields, right_rows.fields)
+
+        if join_keys is None or self.config.join_type not in HASH_JOIN_TYPES:
+            async for row in super()._join(left_rows, right_rows):
+                yield row
+            return
+
+        self.memory = self.memory_budget.reserve()
+        try:
+            async for row in self.hash_join(left_rows, right_rows, join_keys):
+                yield row
+        finally:
+            self.memory.release()
 
         self.stats.update_done_running()
 
 
-class MergeJoinOperator(JoinOperator):
+def merge_key(key):
+    # Sorts nulls first without ever comparing them to other values
+    return tuple((value is not None, value) for value in key)
+
+
+class MergeJoinOperator(NestedLoopJoinOperator):
+    """
+    Joins two inputs which are both sorted by their join keys, like a
+    merge sort: read the next group of rows with the same key from each
+    side and advance whichever side has the smaller key. Only one group
+    of rows from each side is held in memory at a time. The planner
+    only picks this join when the table files say that both inputs are
+    sorted by the join keys. Nulls are expected to sort first.
+    """
+
     def name(self):
         return "Merge Join"
 
-    def _join(self, left_values, right_values):
-        raise NotImplementedError()
+    async def iter_groups(self, rows, keys):
+        "Yields (key, records) for each run of records with the same key"
+        group_key = None
+        group = []
+
+        async for batch in rows.iter_batches():
+            records = list(batch.iter_records())
+            values = [key.eval_records(rows.fields, records) for key in keys]
+
+            for record, key in zip(records, zip(*values)):
+                self.stats.update_row_processed(record)
+                key = merge_key(key)
+
+                if group and key == group_key:
+                    group.append(tuple(record))
+                    continue
+                elif group and key < group_key:
+                    raise RuntimeError("Merge join input is not sorted by join keys")
+                elif group:
+                    yield group_key, group
+
+                group_key = key
+                group = [tuple(record)]
+
+        if group:
+            yield group_key, group
+
+    async def next_group(self, groups):
+        try:
+            return await groups.__anext__()
+        except StopAsyncIteration:
+            return None, None
+
+    async def merge_join(self, left_rows, right_rows, join_keys):
+        join_type = self.config.join_type
+        keep_left = join_type in (JoinType.LEFT_OUTER, JoinType.FULL_OUTER)
+        keep_right = join_type in (JoinType.RIGHT_OUTER, JoinType.FULL_OUTER)
+
+        fields = tuple(list(left_rows.fields) + list(right_rows.fields))
+        left_nulls = left_rows.nulls()
+        right_nulls = right_rows.nulls()
+
+        residual = join_keys.residual
+        if residual is not None:
+            residual.bind(fields)
+            residual = compile_expression(residual, fields)
+
+        left_keys = [
+            compile_expression(expr, left_rows.fields) for expr in join_keys.left_exprs
+        ]
+        right_keys = [
+            compile_expression(expr, right_rows.fields)
+            for expr in join_keys.right_exprs
+        ]
+
+        left_groups = self.iter_groups(left_rows, left_keys)
+        right_groups = self.iter_groups(right_rows, right_keys)
+
+        left_key, left_group = await self.next_group(left_groups)
+        right_key, right_group = await self.next_group(right_groups)
+
+        while left_group is not None or right_group is not None:
+            if right_group is None or (left_group is not None and left_key < right_key):
+                if keep_left:
+                    for lrecord in left_group:
+                        yield RowTuple(fields, lrecord + right_nulls)
+
+                left_key, left_group = await self.next_group(left_groups)
+                continue
+
+            elif left_group is None or right_key < left_key:
+                if keep_right:
+                    for rrecord in right_group:
+                        yield RowTuple(fields, left_nulls + rrecord)
+
+                right_key, right_group = await self.next_group(right_groups)
+                continue
+
+            # `a = b` is never true for nulls, but USING matches them
+            has_nulls = any(not present for present, _ in left_key)
+            can_match = join_keys.nulls_match or not has_nulls
+
+            right_matched = [False] * len(right_group)
+            for lrecord in left_group:
+                matched = False
+                for i, rrecord in enumerate(right_group):
+                    if not can_match:
+                        break
+
+                    merged = RowTuple(fields, lrecord + rrecord)
+                    if residual is not None and not residual.eval_row(merged):
+                        continue
+
+                    matched = True
+                    right_matched[i] = True
+                    yield merged
+                    self.stats.update_row_emitted(merged)
+
+                if not matched and keep_left:
+                    yield RowTuple(fields, lrecord + right_nulls)
+
+            if keep_right:
+                for rrecord, matched in zip(right_group, right_matched):
+                    if not matched:
+                        yield RowTuple(fields, left_nulls + rrecord)
+
+            left_key, left_group = await self.next_group(left_groups)
+            right_key, right_group = await self.next_group(right_groups)
+
+    async def _join(self, left_rows, right_rows):
+        expression = self.config.expression
+        join_keys = None
+        if isinstance(expression, JoinCondition):
+            join_keys = expression.find_equi_keys(left_rows.fields, right_rows.fields)
+
+        if join_keys is None:
+            async for row in super()._join(left_rows, right_rows):
+                yield row
+            return
+
+        async for row in self.merge_join(left_rows, right_rows, join_keys):
+            yield row
+
+        self.stats.update_done_running()
@@ -23,26 +23,28 @@ class LimitOperator(Operator):
         limit = self.config.limit
 
         # Do not read _any_ rows if limit is zero
-        if limit == 0:
-            raise StopIteration()
+        emitted = 0
+        if limit > 0:
+            batches = tuples.iter_batches()
+            async for batch in batches:
+                self.stats.update_batch_processed(batch)
 
-        i = 0
-        async for row in tuples:
-            self.stats.update_row_processed(row)
+                batch = batch.slice(0, limit - emitted)
+                emitted += len(batch)
+                yield batch
+                self.stats.update_batch_emitted(batch)
 
-            if i < limit:
-                yield row
-                self.stats.update_row_emitted(row)
+                if emitted >= limit:
+                    break
 
-            # This is dumb! We would ideally break, but we
-            # actually need to go back and drain our parent
-            # iterators or else they will "hang".
-            i += 1
+            await batches.aclose()
 
+        # Tell the operators upstream to stop instead of draining them
+        await tuples.close()
         self.stats.update_done_running()
 
     async def run(self, rows):
         self.stats.update_start_running()
         iterator = self.make_iterator(rows)
         iterator = self.add_exit_check(iterator)
-        return rows.new(iterator)
+        return rows.new(iterator, batched=True)
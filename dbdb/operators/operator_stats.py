@@ -101,6 +101,23 @@ class OperatorStats:
         if STAT_CALLBACK:
             STAT_CALLBACK("processing", self.get_stats())
 
+    def update_batch_processed(self, batch):
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        self.state = STATE_RUNNING
+
+        self.rows_processed += len(batch)
+
+        if STAT_CALLBACK:
+            STAT_CALLBACK("processing", self.get_stats())
+
+    def update_batch_emitted(self, batch):
+        self.rows_emitted += len(batch)
+
+        if STAT_CALLBACK:
+            STAT_CALLBACK("processing", self.get_stats())
+
     def update_custom_stats(self, stats_dict):
         self.custom_stats.update(stats_dict)
 
@@ -1,8 +1,17 @@
 from dbdb.operators.base import Operator, OperatorConfig
-from dbdb.tuples.rows import Rows
+from dbdb.expressions.compiler import compile_expression
+from dbdb.expressions.expressions import WindowFunctionCall
+from dbdb.expressions.vector_math import (
+    can_vectorize,
+    to_batch_column,
+    VECTOR_ERRORS,
+)
+from dbdb.tuples.batch import RecordBatch, make_column
+from dbdb.tuples.rows import Rows, RowTuple, find_field_index
 from dbdb.tuples.identifiers import FieldIdentifier
 from dbdb.tuples.context import ExecutionContext
 
+from collections import deque
 import asyncio
 
 
@@ -36,14 +45,16 @@ class WindowIterator:
 class ProjectOperator(Operator):
     Config = ProjectConfig
 
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.streaming = False
+
     def name(self):
         return "Projection"
 
-    async def make_iterator(self, tuples):
-        projections = self.config.project
-
+    def has_window(self):
         has_window = False
-        for projection in projections:
+        for projection in self.config.project:
             is_window = projection.is_window()
             is_agg = projection.is_aggregate()
 
@@ -54,29 +65,185 @@ class ProjectOperator(Operator):
             elif is_window:
                 has_window = True
 
-        if has_window:
-            rows = await tuples.materialize()
-            tuples = WindowIterator(rows)
-        else:
-            rows = tuples
+        return has_window
+
+    def window_calls(self):
+        calls = []
+        for projection in self.config.project:
+            if projection.is_star():
+                continue
+
+            for expr in projection.expr.walk(lambda e: e):
+                if isinstance(expr, WindowFunctionCall):
+                    calls.append(expr)
+
+        return calls
+
+    def streaming_window(self):
+        """
+        If every window function shares the same window and can be streamed,
+        returns one of them. The planner checks whether the input is already
+        in that window's order, and if so, calls set_streaming()
+        """
+        processors = [call.processor for call in self.window_calls()]
+        if len(processors) == 0:
+            return None
+
+        window = processors[0]
+        for processor in processors:
+            if processor.window_spec() != window.window_spec():
+                return None
+            elif not processor.can_stream():
+                return None
+
+        return window
+
+    def set_streaming(self):
+        self.streaming = True
+
+    def share_window_partitions(self, rows):
+        # Partition and sort the rows once for each distinct window, rather
+        # than once for every window function
+        windows = {}
+        for call in self.window_calls():
+            processor = call.processor
+            spec = processor.window_spec()
+            if spec not in windows:
+                windows[spec] = processor.make_partitions(rows)
 
+            processor.set_partitions(windows[spec])
+
+    def project_row(self, context):
+        projected = []
+        for projection in self.config.project:
+            if projection.is_star():
+                projected.extend(context.row.data)
+            else:
+                projected.append(projection.expr.eval(context))
+
+        return projected
+
+    async def make_iterator(self, tuples):
+        # Window functions need to see every row, so process them one
+        # row at a time after materializing the input
+        rows = await tuples.materialize()
+        self.share_window_partitions(rows)
+        tuples = WindowIterator(rows)
+
+        index = 0
         async for row in tuples:
-            context = ExecutionContext(row=row, rows=rows)
+            context = ExecutionContext(row=row, rows=rows, row_index=index)
+            index += 1
             self.stats.update_row_processed(row)
-            projected = []
-            for projection in projections:
-                if projection.is_star():
-                    for value in row.data:
-                        projected.append(value)
-                else:
-                    value = projection.expr.eval(context)
-                    projected.append(value)
 
+            projected = self.project_row(context)
             yield projected
             self.stats.update_row_emitted(projected)
             # self.stats.update_row_emitted(row)
         self.stats.update_done_running()
 
+    def pop_ready_rows(self, calls, pending, results):
+        "Projects rows from the front of pending once every call has a result"
+        while pending and all(results):
+            row = pending.popleft()
+            windows = {
+                id(call): values.popleft() for call, values in zip(calls, results)
+            }
+            yield self.project_row(ExecutionContext(row=row, windows=windows))
+
+    async def make_streaming_iterator(self, rows):
+        # The input is already in window order, so each partition's rows
+        # arrive together and in order. A row is only held back until every
+        # window function has a result for it
+        calls = self.window_calls()
+        window = calls[0].processor
+        key_indexes = [
+            find_field_index(rows.fields, col) for col in window.partition_cols
+        ]
+
+        pending = deque()
+        results = [deque() for _ in calls]
+        streams = None
+        current_key = None
+
+        async for batch in rows.iter_batches():
+            self.stats.update_batch_processed(batch)
+
+            for record in batch.iter_records():
+                key = tuple([record[i] for i in key_indexes])
+                if streams is None or key != current_key:
+                    if streams is not None:
+                        for stream, values in zip(streams, results):
+                            values.extend(stream.finish())
+
+                    current_key = key
+                    streams = [call.processor.stream() for call in calls]
+
+                row = RowTuple(rows.fields, record)
+                pending.append(row)
+                for stream, values in zip(streams, results):
+                    values.extend(stream.push(row))
+
+                for projected in self.pop_ready_rows(calls, pending, results):
+                    yield projected
+                    self.stats.update_row_emitted(projected)
+
+        if streams is not None:
+            for stream, values in zip(streams, results):
+                values.extend(stream.finish())
+
+        for projected in self.pop_ready_rows(calls, pending, results):
+            yield projected
+            self.stats.update_row_emitted(projected)
+
+        self.stats.update_done_running()
+
+    def eval_batch(self, projection, batch):
+        try:
+            return to_batch_column(projection.expr.eval_batch(batch))
+        except VECTOR_ERRORS:
+            # Evaluate one row at a time, which raises any real errors
+            return None
+
+    def project_batch(self, rows, fields, batch):
+        batch = batch.with_fields(rows.fields)
+        records = None
+
+        columns = []
+        validity = []
+        for projection, compiled in zip(self.config.project, self.compiled):
+            if projection.is_star():
+                columns.extend(batch.columns)
+                validity.extend(batch.validity)
+                continue
+
+            result = None
+            if projection in self.vectorized:
+                result = self.eval_batch(projection, batch)
+
+            if result is None:
+                if records is None:
+                    records = list(batch.iter_records())
+
+                values = compiled.eval_records(rows.fields, records, rows=rows)
+                result = make_column(values)
+
+            column, column_validity = result
+            columns.append(column)
+            validity.append(column_validity)
+
+        return RecordBatch(fields, columns, validity, len(batch))
+
+    async def make_batch_iterator(self, rows, fields):
+        async for batch in rows.iter_batches():
+            self.stats.update_batch_processed(batch)
+
+            projected = self.project_batch(rows, fields, batch)
+            yield projected
+            self.stats.update_batch_emitted(projected)
+
+        self.stats.update_done_running()
+
     def list_fields(self, rows):
         fields = []
         projections = self.config.project
@@ -102,6 +269,32 @@ class ProjectOperator(Operator):
 
         fields = self.list_fields(rows)
 
-        iterator = self.make_iterator(rows)
+        for projection in self.config.project:
+            if not projection.is_star():
+                projection.expr.bind(rows.fields)
+
+        if self.has_window() and self.streaming:
+            iterator = self.make_streaming_iterator(rows)
+            batched = False
+        elif self.has_window():
+            iterator = self.make_iterator(rows)
+            batched = False
+        else:
+            self.compiled = [
+                (
+                    None
+                    if projection.is_star()
+                    else compile_expression(projection.expr, rows.fields)
+                )
+                for projection in self.config.project
+            ]
+            self.vectorized = [
+                projection
+                for projection in self.config.project
+                if not projection.is_star() and can_vectorize(projection.expr)
+            ]
+            iterator = self.make_batch_iterator(rows, fields)
+            batched = True
+
         iterator = self.add_exit_check(iterator)
-        return Rows(rows.table, fields, iterator)
+        return Rows(rows.table, fields, iterator, batched=batched)
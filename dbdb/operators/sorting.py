@@ -1,7 +1,15 @@
 from dbdb.operators.base import Operator, OperatorConfig
-from dbdb.expressions.expressions import Literal
+from dbdb.io import spill
+from dbdb.expressions.compiler import compile_expression
+from dbdb.expressions.expressions import ColumnIdentifier, Literal
 from dbdb.expressions.sort import ReverseSort
-from dbdb.tuples.context import ExecutionContext
+from dbdb.tuples.batch import RecordBatch, BATCH_SIZE
+
+import heapq
+
+
+def sort_key(keyed_record):
+    return keyed_record[0]
 
 
 class SortingConfig(OperatorConfig):
@@ -12,46 +20,209 @@ class SortingConfig(OperatorConfig):
         self.order = order
 
 
+class TopNConfig(OperatorConfig):
+    def __init__(
+        self,
+        order,
+        limit,
+    ):
+        self.order = order
+        self.limit = limit
+
+
 class SortOperator(Operator):
+    """
+    Sorts its input in runs which fit in the memory budget. If the input
+    outgrows the budget, each run is written to a spill file as soon as it
+    is sorted, and the runs are then merged back together in order.
+    """
+
     Config = SortingConfig
 
+    MAX_MERGE_WIDTH = 64
+
     def name(self):
         return "Sort"
 
-    def sort_func(self, row):
-        # function that returns a tuple of sort orders...
-        # this will sort "ascending", so make sure that
-        # we account for sort order in here... somehow...
+    def is_sorted_by(self, exprs):
+        "True if rows with equal values for every expr come out together"
+        if len(exprs) > len(self.config.order):
+            return False
 
-        self.stats.update_row_processed(row)
-        sort_keys = []
-        context = ExecutionContext(row=row)
-        for ascending, projection in self.config.order:
-            if isinstance(projection, Literal):
-                key = row.data[projection.value() - 1]
+        # Any leading keys of the sort will do, in any order
+        sorted_names = set()
+        for _, projection in self.config.order[: len(exprs)]:
+            if not isinstance(projection, ColumnIdentifier):
+                return False
+            sorted_names.add(projection.column)
+
+        names = set()
+        for expr in exprs:
+            if not isinstance(expr, ColumnIdentifier):
+                return False
+            names.add(expr.column)
+
+        return names == sorted_names
+
+    def is_ordered_by(self, exprs, order):
+        """
+        True if rows with equal values for every expr come out together,
+        and are then sorted by `order`, a list of (ascending, expr)
+        """
+        if len(exprs) + len(order) > len(self.config.order):
+            return False
+        elif not self.is_sorted_by(exprs):
+            return False
+
+        sort_order = self.config.order[len(exprs) :]
+        for (ascending, expr), (sort_ascending, projection) in zip(order, sort_order):
+            if not isinstance(expr, ColumnIdentifier):
+                return False
+            elif not isinstance(projection, ColumnIdentifier):
+                return False
+            elif expr.column != projection.column or ascending != sort_ascending:
+                return False
+
+        return True
+
+    def sort_keys(self, fields, records):
+        "Returns the sort key for each record in a list"
+        columns = []
+        for ascending, projection, compiled in self.compiled:
+            if compiled is None:
+                index = projection.value() - 1
+                values = [record[index] for record in records]
             else:
-                key = projection.eval(context)
+                values = compiled.eval_records(fields, records)
 
             if not ascending:
-                key = ReverseSort(key)
+                values = [ReverseSort(value) for value in values]
 
-            sort_keys.append(key)
+            columns.append(values)
 
-        return sort_keys
+        return list(zip(*columns))
+
+    def spill_run(self, run):
+        spill_file = spill.SpillFile()
+        spill_file.write_many(run)
+        spill_file.flush()
+        return spill_file
+
+    def merge_runs(self, runs):
+        # Only read from so many spill files at once. Merge the rest into
+        # longer runs first
+        while len(runs) > self.MAX_MERGE_WIDTH:
+            merged = []
+            for i in range(0, len(runs), self.MAX_MERGE_WIDTH):
+                group = runs[i : i + self.MAX_MERGE_WIDTH]
+                merged.append(self.spill_run(heapq.merge(*group, key=sort_key)))
+                for spill_file in group:
+                    spill_file.close()
+
+            runs = merged
+
+        return runs
 
     async def make_iterator(self, rows):
-        data = await rows.materialize()
-        for row in sorted(
-            data,
-            key=self.sort_func,
-        ):
-            self.stats.update_row_emitted(row)
-            yield row
+        run = []
+        runs = []
+        memory = self.memory_budget.reserve()
+
+        try:
+            async for batch in rows.iter_batches():
+                self.stats.update_batch_processed(batch)
+                records = [tuple(record) for record in batch.iter_records()]
+                keyed_records = list(zip(self.sort_keys(rows.fields, records), records))
+                run.extend(keyed_records)
+
+                # Sort what fits in memory and write it out to a spill file
+                if not memory.grow(spill.estimate_size(keyed_records)):
+                    run.sort(key=sort_key)
+                    runs.append(self.spill_run(run))
+                    run = []
+                    memory.release()
+
+            # Sorting on the keys alone keeps rows with equal keys in order
+            run.sort(key=sort_key)
+            if len(runs) > 0:
+                runs = self.merge_runs(runs)
+                sorted_rows = heapq.merge(*runs, run, key=sort_key)
+            else:
+                sorted_rows = run
+
+            records = []
+            for _, record in sorted_rows:
+                records.append(record)
+                if len(records) >= BATCH_SIZE:
+                    batch = RecordBatch.from_records(rows.fields, records)
+                    yield batch
+                    self.stats.update_batch_emitted(batch)
+                    records = []
+
+            if len(records) > 0:
+                batch = RecordBatch.from_records(rows.fields, records)
+                yield batch
+                self.stats.update_batch_emitted(batch)
+
+        finally:
+            memory.release()
+            for spill_file in runs:
+                spill_file.close()
 
         self.stats.update_done_running()
 
     async def run(self, rows):
         self.stats.update_start_running()
+        self.compiled = []
+        for ascending, projection in self.config.order:
+            projection.bind(rows.fields)
+            if isinstance(projection, Literal):
+                compiled = None
+            else:
+                compiled = compile_expression(projection, rows.fields)
+
+            self.compiled.append((ascending, projection, compiled))
+
         iterator = self.make_iterator(rows)
         iterator = self.add_exit_check(iterator)
-        return rows.new(iterator)
+        return rows.new(iterator, batched=True)
+
+
+class TopNOperator(SortOperator):
+    """
+    ORDER BY with a LIMIT. Only the `limit` lowest rows seen so far are
+    kept, so this never holds more than `limit` + one batch of rows.
+    """
+
+    Config = TopNConfig
+
+    # Larger limits are planned as a sort + limit, which can spill
+    MAX_ROWS = 10000
+
+    def name(self):
+        return "Top N"
+
+    def details(self):
+        return {"Limit": self.config.limit}
+
+    async def make_iterator(self, rows):
+        limit = self.config.limit
+        top = []
+
+        async for batch in rows.iter_batches():
+            self.stats.update_batch_processed(batch)
+            if limit == 0:
+                continue
+
+            records = [tuple(record) for record in batch.iter_records()]
+            keyed = list(zip(self.sort_keys(rows.fields, records), records))
+
+            # nsmallest() is stable, and the rows kept so far come first
+            top = heapq.nsmallest(limit, top + keyed, key=sort_key)
+
+        if len(top) > 0:
+            batch = RecordBatch.from_records(rows.fields, [r for _, r in top])
+            yield batch
+            self.stats.update_batch_emitted(batch)
+
+        self.stats.update_done_running()
@@ -18,6 +18,10 @@ class TableFunctionOperator(Operator):
     def name(self):
         return "Generator"
 
+    def waits_on_io(self):
+        # eg. rows fetched from an API
+        return True
+
     @classmethod
     def function_name(cls):
         return self.function_name
@@ -30,20 +34,36 @@ class TableFunctionOperator(Operator):
 
         self.stats.update_done_running()
 
+    async def make_batch_iterator(self, batches, fields):
+        async for batch in batches:
+            batch = batch.with_fields(fields)
+            self.stats.update_batch_processed(batch)
+            yield batch
+            self.stats.update_batch_emitted(batch)
+
+        self.stats.update_done_running()
+
     async def run(self):
         self.stats.update_start_running()
 
         processor = self.config.function_class(self.config.function_args)
-        iterator = self.make_iterator(processor)
-        iterator = self.add_exit_check(iterator)
 
         fields = [
             self.config.table.field(field_name)
             for field_name in await processor.fields()
         ]
 
+        batches = processor.generate_batches()
+        if batches is not None:
+            iterator = self.make_batch_iterator(batches, fields)
+        else:
+            iterator = self.make_iterator(processor)
+
+        iterator = self.add_exit_check(iterator)
+
         return Rows(
             self.config.table,
             fields,
             iterator,
+            batched=batches is not None,
         )
@@ -0,0 +1,162 @@
+import numpy as np
+
+
+"""
+Operators which understand batches pass RecordBatches between each other
+instead of one RowTuple at a time. A batch stores its rows column by
+column: every column is a numpy array with one element per row.
+
+Columns of ints, floats and bools use typed arrays. Nulls in those
+columns are stored as zeros, and a boolean `validity` mask (True means
+present) says which values are real. Everything else (strings, mixed
+types) uses an object array which holds None for nulls directly, and has
+no validity mask.
+"""
+
+BATCH_SIZE = 1024
+
+COLUMN_DTYPES = {
+    bool: np.bool_,
+    int: np.int64,
+    float: np.float64,
+}
+
+
+def vector_to_list(values, validity):
+    "Convert a column to a list of python values, with None for nulls"
+    decoded = values.tolist()
+    if validity is not None:
+        for index in np.flatnonzero(~validity).tolist():
+            decoded[index] = None
+
+    return decoded
+
+
+def make_object_column(values):
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def make_column(values):
+    "Returns a (values, validity) tuple for a list of python values"
+    types = set(map(type, values))
+    has_nulls = type(None) in types
+    types.discard(type(None))
+
+    dtype = None
+    if len(types) == 1:
+        dtype = COLUMN_DTYPES.get(types.pop())
+
+    if dtype is None:
+        return make_object_column(values), None
+
+    try:
+        if not has_nulls:
+            return np.array(values, dtype=dtype), None
+
+        validity = np.fromiter(
+            (value is not None for value in values), dtype=bool, count=len(values)
+        )
+        column = np.zeros(len(values), dtype=dtype)
+        column[validity] = [value for value in values if value is not None]
+        return column, validity
+
+    except OverflowError:
+        # ints which don't fit into 64 bits
+        return make_object_column(values), None
+
+
+class RecordBatch:
+    def __init__(self, fields, columns, validity=None, num_rows=None):
+        self.fields = fields
+        self.columns = columns
+        self.validity = validity or [None] * len(columns)
+
+        if num_rows is None:
+            num_rows = len(columns[0]) if len(columns) > 0 else 0
+
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    @classmethod
+    def from_records(cls, fields, records):
+        columns = []
+        validity = []
+        for values in zip(*records):
+            column, column_validity = make_column(list(values))
+            columns.append(column)
+            validity.append(column_validity)
+
+        return cls(fields, columns, validity, num_rows=len(records))
+
+    def column_values(self, index):
+        return vector_to_list(self.columns[index], self.validity[index])
+
+    def iter_records(self):
+        if len(self.columns) == 0:
+            return (() for _ in range(self.num_rows))
+
+        values = [self.column_values(i) for i in range(len(self.columns))]
+        return zip(*values)
+
+    def with_fields(self, fields):
+        return RecordBatch(fields, self.columns, self.validity, self.num_rows)
+
+    def select(self, indexes):
+        "Returns a batch containing only the columns at `indexes`"
+        return RecordBatch(
+            [self.fields[i] for i in indexes],
+            [self.columns[i] for i in indexes],
+            [self.validity[i] for i in indexes],
+            self.num_rows,
+        )
+
+    def filter(self, mask):
+        "Returns a batch containing only the rows where `mask` is True"
+        if mask.all():
+            return self
+
+        return RecordBatch(
+            self.fields,
+            [column[mask] for column in self.columns],
+            [v if v is None else v[mask] for v in self.validity],
+            int(np.count_nonzero(mask)),
+        )
+
+    def slice(self, start, end):
+        end = min(end, self.num_rows)
+        return RecordBatch(
+            self.fields,
+            [column[start:end] for column in self.columns],
+            [v if v is None else v[start:end] for v in self.validity],
+            max(0, end - start),
+        )
+
+    @classmethod
+    def concat(cls, fields, batches):
+        "Combine batches with the same schema into a single batch"
+        if len(batches) == 1:
+            return batches[0].with_fields(fields)
+
+        columns = []
+        validity = []
+        for i in range(len(fields)):
+            pieces = [batch.columns[i] for batch in batches]
+            masks = [batch.validity[i] for batch in batches]
+
+            columns.append(np.concatenate(pieces))
+            if all(mask is None for mask in masks):
+                validity.append(None)
+            else:
+                validity.append(
+                    np.concatenate(
+                        [
+                            np.ones(len(piece), dtype=bool) if mask is None else mask
+                            for piece, mask in zip(pieces, masks)
+                        ]
+                    )
+                )
+
+        num_rows = sum(len(batch) for batch in batches)
+        return cls(fields, columns, validity, num_rows)
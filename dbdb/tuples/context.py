@@ -10,3 +10,12 @@ class ExecutionContext:
 
     row_index: Optional[int] = None
     rows: Optional[Rows] = None
+
+    # Final values of aggregate function calls, by id()
+    aggregates: Optional[dict] = None
+
+    # Every row in a window function's partition, in order
+    partition: Optional[list] = None
+
+    # Values of window function calls, by id(), if they were streamed
+    windows: Optional[dict] = None
@@ -1,10 +1,87 @@
 from dbdb.tuples.identifiers import TableIdentifier
+from dbdb.tuples.batch import RecordBatch, BATCH_SIZE
 from dbdb.logger import logger
 
 import asyncio
 import collections
+import contextlib
+import os
 import tabulate
 
+# How many items (rows, or batches if batched) a consumer can read ahead
+# of the slowest consumer of the same rows before it waits for it
+FANOUT_BUFFER_SIZE = int(os.getenv("DBDB_FANOUT_BUFFER_SIZE", 16))
+
+# Tasks which are waiting for another task to read rows, and the futures
+# which wake them up to check again
+BLOCKED_TASKS = set()
+WAKEUPS = set()
+
+
+def wake_blocked_tasks():
+    for wakeup in WAKEUPS:
+        if not wakeup.done():
+            wakeup.set_result(None)
+
+    WAKEUPS.clear()
+
+
+def can_wait_for(task):
+    """
+    Waiting for a task which is blocked itself could wait forever, as could
+    waiting for a task which runs on this one's behalf
+    """
+    if task is None or task.done():
+        return False
+
+    return task is not asyncio.current_task() and task not in BLOCKED_TASKS
+
+
+@contextlib.contextmanager
+def blocked():
+    "While this task is blocked, no other task waits for it"
+    # Tasks already waiting on this one should check again
+    wake_blocked_tasks()
+
+    task = asyncio.current_task()
+    BLOCKED_TASKS.add(task)
+    try:
+        yield
+    finally:
+        BLOCKED_TASKS.discard(task)
+
+
+async def wait_blocked(awaitable):
+    "Awaits something which only another task can make ready, like rows being read"
+    with blocked():
+        return await awaitable
+
+
+async def wait_until_woken():
+    "Blocks this task until wake_blocked_tasks() is called"
+    with blocked():
+        wakeup = asyncio.get_running_loop().create_future()
+        WAKEUPS.add(wakeup)
+        try:
+            await wakeup
+        finally:
+            WAKEUPS.discard(wakeup)
+
+
+def find_field_index(fields, name):
+    found = None
+    for i, field in enumerate(fields):
+        matched = field == "*" or field.is_match(name)
+        if matched and found is not None:
+            raise RuntimeError(f"Ambiguous column: {name}")
+        elif matched:
+            found = i
+
+    if found is None:
+        raise RuntimeError(f"field {name} not found in table")
+
+    return found
+
 
 class RowTuple:
     def __init__(self, fields, data):
@@ -18,18 +95,7 @@ class RowTuple:
             raise RuntimeError(f"bad input to RowTuple: {data}")
 
     def field(self, name):
-        found = None
-        for i, field in enumerate(self.fields):
-            matched = field == "*" or field.is_match(name)
-            if matched and found is not None:
-                raise RuntimeError(f"Ambiguous column: {name}")
-            elif matched:
-                found = i
-
-        if found is None:
-            raise RuntimeError(f"field {name} not found in table")
-
-        return self.data[found]
+        return self.data[find_field_index(self.fields, name)]
 
     def iter_values_for_field(self, name):
         for i, field in enumerate(self.fields):
@@ -58,55 +124,218 @@ class RowTuple:
         return tuple(self.data)
 
 
+class Cursor:
+    "The position of one consumer in the items produced by a Rows"
+
+    def __init__(self, position):
+        self.position = position
+
+        # The task which last read from this cursor
+        self.task = None
+
+
 class Rows:
-    def __init__(self, table, fields, iterator):
+    """
+    A stream of rows produced by an operator. If `batched` is True, the
+    underlying iterator yields RecordBatches instead of single records.
+    Either way, rows can be read one at a time with `async for row in rows`
+    or a batch at a time with `async for batch in rows.iter_batches()`.
+
+    Rows which are done reading before their input runs out (eg. LIMIT)
+    call close(). That stops the iterator, and releases the `sources`
+    that rows were read from. A source is closed in turn once every
+    reader has released it, all the way back up to the table scans.
+
+    Rows can be read by more than one consumer, see consume(). Items are
+    buffered until every consumer has read them, so consumers which read
+    at about the same pace only keep a few items in memory.
+    """
+
+    def __init__(self, table, fields, iterator, batched=False):
         self.table = table
         self.fields = fields
         self.iterator = iterator
+        self.batched = batched
         self.data = None
 
-        self.consumers = []
-        self.seen = []
+        # Items which some consumer has not read yet. buffer[0] is item
+        # number buffer_start
+        self.buffer = collections.deque()
+        self.buffer_start = 0
+        self.cursors = []
+
+        # Only one consumer at a time can read from the iterator
+        self.lock = asyncio.Lock()
+        self.exhausted = False
+
+        # Records from the current batch which have not been read yet
+        self.pending = collections.deque()
+
+        self.sources = []
+        self.readers = 0
+        self.closed = False
+
+        # Set if these rows are a consumer of other rows
+        self.cursor = None
+
+    def add_source(self, source):
+        self.sources.append(source)
+        source.readers += 1
+
+    async def release(self, reader):
+        "Called when one of the readers of these rows is closed"
+        self.remove_cursor(reader.cursor)
+
+        self.readers -= 1
+        if self.readers <= 0:
+            await self.close()
+
+    async def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if hasattr(self.iterator, "aclose"):
+            await self.iterator.aclose()
+
+        for source in self.sources:
+            await source.release(self)
 
     def __aiter__(self):
         return self
 
+    async def _next_item(self):
+        # Returns the next record, or the next batch if batched
+        return await self.iterator.__anext__()
+
     async def __anext__(self):
-        record = await self.iterator.__anext__()
-        row = self._make_row(record)
-        self.seen.append(row)
-        return row
+        if not self.batched:
+            record = await self._next_item()
+            return self._make_row(record)
+
+        while not self.pending:
+            batch = await self._next_item()
+            self.pending.extend(batch.iter_records())
+
+        return self._make_row(self.pending.popleft())
+
+    async def iter_batches(self, batch_size=BATCH_SIZE):
+        if self.batched:
+            while True:
+                try:
+                    yield await self._next_item()
+                except StopAsyncIteration:
+                    break
+
+            return
+
+        # Adapt operators which produce one row at a time
+        records = []
+        async for row in self:
+            records.append(row.data)
+            if len(records) >= batch_size:
+                yield RecordBatch.from_records(self.fields, records)
+                records = []
+
+        if len(records) > 0:
+            yield RecordBatch.from_records(self.fields, records)
 
     def _make_row(self, record):
         return RowTuple(self.fields, record)
 
-    def new(self, iterator):
-        return Rows(self.table, self.fields, iterator)
+    def new(self, iterator, batched=False):
+        return Rows(self.table, self.fields, iterator, batched=batched)
 
     def nulls(self):
         return (None,) * len(self.fields)
 
     def consume(self):
-        new_deque = collections.deque()
-        for val in self.seen:
-            new_deque.append(val)
+        """
+        Returns a new Rows which reads every item of these rows from the
+        start. Every consumer must be created before any of them has read
+        far enough for items to be released.
+        """
+        if self.buffer_start > 0:
+            raise RuntimeError("Cannot consume rows which were already read")
 
-        self.consumers.append(new_deque)
+        cursor = Cursor(position=0)
+        self.cursors.append(cursor)
 
-        async def gen(mydeque):
-            while True:
-                if not mydeque:
-                    try:
-                        newval = await self.__anext__()
-                    except StopAsyncIteration:
-                        break
+        consumer = Rows(
+            self.table, self.fields, self.read_from(cursor), batched=self.batched
+        )
+        consumer.cursor = cursor
+        consumer.add_source(self)
+        return consumer
+
+    def remove_cursor(self, cursor):
+        # Stop buffering items for consumers which are done
+        if cursor in self.cursors:
+            self.cursors.remove(cursor)
+            self.release_read_items()
+
+    def release_read_items(self):
+        "Frees items which every consumer has read"
+        if self.cursors:
+            slowest = min(cursor.position for cursor in self.cursors)
+        else:
+            slowest = self.buffer_start + len(self.buffer)
+
+        if slowest == self.buffer_start:
+            return
+
+        while self.buffer_start < slowest:
+            self.buffer.popleft()
+            self.buffer_start += 1
+
+        wake_blocked_tasks()
+
+    async def wait_for_slowest(self):
+        "Waits while the buffer is full, if the slowest consumer is able to catch up"
+        while len(self.buffer) >= FANOUT_BUFFER_SIZE:
+            slowest = min(self.cursors, key=lambda cursor: cursor.position)
+            if not can_wait_for(slowest.task):
+                break
+
+            await wait_until_woken()
 
-                    for consumer in self.consumers:
-                        consumer.append(newval)
+    async def read_item(self, cursor):
+        "Returns the next item for a cursor, reading a new one if needed"
+        if cursor.position == self.buffer_start + len(self.buffer):
+            await self.wait_for_slowest()
+
+        async with self.lock:
+            # Another consumer may have read it while this one waited
+            if cursor.position == self.buffer_start + len(self.buffer):
+                if self.exhausted:
+                    raise StopAsyncIteration()
+
+                try:
+                    item = await self._next_item()
+                except StopAsyncIteration:
+                    self.exhausted = True
+                    raise
+
+                self.buffer.append(item)
+
+        item = self.buffer[cursor.position - self.buffer_start]
+        cursor.position += 1
+        self.release_read_items()
+        return item
+
+    async def read_from(self, cursor):
+        try:
+            while True:
+                cursor.task = asyncio.current_task()
+                try:
+                    item = await self.read_item(cursor)
+                except StopAsyncIteration:
+                    break
 
-                yield mydeque.popleft()
+                yield item
 
-        return Rows(self.table, self.fields, gen(new_deque))
+        finally:
+            self.remove_cursor(cursor)
 
     async def iter_rows_batches(self, take=10):
         """